@@ -0,0 +1,217 @@
+"""
+Description: Times each step of the ESI workflow on a synthetic archive with a fake ClimateSERV server
+ (see synthetic_esi.py), so it runs offline, and keeps the results to compare between versions.
+
+File Name: esi_benchmark.py
+
+Usage example: python esi_benchmark.py
+Usage example: python esi_benchmark.py --width 800 --height 600 --dates 104 --stations 200 --latency 0.5 --workers 8
+Usage example: python esi_benchmark.py --stages clip point_extraction
+
+help: python esi_benchmark.py --help
+
+Steps timed (in this order):
+    point_fetch: get_ESI_select_pt.py --mode point (one fake 'Average' request per station)
+    tif_download: get_ESI_tif.py for the area of interest (fake 'Download' requests, tiles and mosaic)
+    clip: ESI_tif_clip.py on the downloaded zip file
+    point_extraction: tif2select_pts.py on the clipped tifs
+    xyz_merge: tif2xyz.py on the clipped tifs
+    comparison: ESI_output_comparison.py --batch
+
+Output:
+    A table of the seconds, throughput (files/s and station-dates/s) and peak memory of each step.
+    The results of each run are added (one JSON line) to --results (default ./benchmark_results.jsonl),
+    with the git commit and the settings. The last earlier run with the same settings is shown next to
+    this run, and steps that got more than --threshold slower are marked.
+
+NOTES:
+    - Each step runs in a new python process, so its peak memory (max resident set size of the
+      process and of the worker processes it started) is its own. Needs a Linux (or other unix) box.
+    - The steps that need the output of an earlier step (i.e. clip needs tif_download) run it too.
+    - --rate 0 (default) turns off the request rate limit, so only the fake --latency is timed.
+    - see GitHub for climateSERV_env.yml and other files
+        https://github.com/carol-rowe/ClimateSERV_ESI_data
+
+"""
+
+import sys
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import subprocess
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import redirect_stdout
+from datetime import datetime
+from pathlib import Path
+import pandas as pd
+
+# the scripts being timed are in the scripts and Comparison_SCRIPTS folders
+REPO = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(REPO / 'scripts'))
+sys.path.insert(0, str(REPO / 'Comparison_SCRIPTS'))
+from synthetic_esi import make_archive, FakeClimateSERV
+
+STAGES = ['point_fetch', 'tif_download', 'clip', 'point_extraction', 'xyz_merge', 'comparison']
+# the steps whose outputs each step reads
+NEEDS = {'clip': ['tif_download'], 'point_extraction': ['clip'], 'xyz_merge': ['clip'],
+         'comparison': ['point_fetch', 'point_extraction', 'xyz_merge']}
+
+def stage_paths(work):
+    return {'poly': work + 'poly_ESI_df.csv', 'zip': work + 'ESI_tif.zip', 'clipped': work + 'clipped_files/',
+            'tif_pts': work + 'ESI_tif2select_pt.csv', 'xyz': work + 'master_ESI_CLIP_xyz.csv',
+            'comparison': work + 'comparison_output.csv'}
+
+def run_stage(stage, ctx):
+    # one step, with the fake server for the steps that send requests
+    p = stage_paths(ctx['work'])
+    fake = FakeClimateSERV(ctx['work'], ctx['latency'], ctx['jitter'], ctx['fail_rate'])
+    start, end = pd.Timestamp(ctx['start']), pd.Timestamp(ctx['end'])
+    if stage == 'point_fetch':
+        from get_ESI_select_pt import get_ESI_select_pt
+        get_ESI_select_pt(ctx['metadata'], 0.00001, 'ESI_4', start, end, ctx['workers'], ctx['rate'],
+                          request_func=fake, outfile=p['poly'], mode='point')
+    elif stage == 'tif_download':
+        from get_ESI_tif import get_ESI_tif
+        from esi_pipeline import shapefile_box
+        xmin, xmax, ymin, ymax = shapefile_box(ctx['aoi'])
+        get_ESI_tif(xmin, xmax, ymin, ymax, 'ESI_4', start, end, outfile=p['zip'], request_func=fake,
+                    workers=ctx['workers'], rate=ctx['rate'])
+    elif stage == 'clip':
+        from ESI_tif_clip import tif_clip
+        tif_clip(p['zip'], ctx['aoi'], ctx['workers'])
+    elif stage == 'point_extraction':
+        from tif2select_pts import tif2select_pts
+        tif2select_pts(p['clipped'], ctx['metadata'], ctx['workers'], p['tif_pts'])
+    elif stage == 'xyz_merge':
+        from tif2xyz import tif2xyz
+        tif2xyz(p['clipped'], p['xyz'])
+    elif stage == 'comparison':
+        from ESI_output_comparison import batch_comparison
+        batch_comparison(ctx['metadata'], p['poly'], p['tif_pts'], p['xyz'], 8, p['comparison'])
+
+def measure(stage, ctx):
+    # runs in its own process: time the step and get the peak memory of this process and its workers
+    t0 = time.perf_counter()
+    if ctx['verbose']:
+        run_stage(stage, ctx)
+    else:
+        with open(os.devnull, 'w') as devnull, redirect_stdout(devnull):
+            run_stage(stage, ctx)
+    seconds = time.perf_counter() - t0
+    # ru_maxrss is in kilobytes on Linux
+    peak_kb = max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+                  resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+    return seconds, peak_kb / 1024.0
+
+def with_needs(stages):
+    # the requested steps plus the steps they need, in workflow order
+    wanted = set()
+    todo = list(stages)
+    while todo:
+        stage = todo.pop()
+        if stage not in wanted:
+            wanted.add(stage)
+            todo.extend(NEEDS.get(stage, []))
+    return [stage for stage in STAGES if stage in wanted]
+
+def git_commit():
+    try:
+        out = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=str(REPO),
+                             stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, check=True)
+        return out.stdout.decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def previous_run(results, config):
+    # the last run in the results file with the same settings
+    if not os.path.isfile(results):
+        return None
+    last = None
+    with open(results) as f:
+        for line in f:
+            if line.strip():
+                run = json.loads(line)
+                if run.get('config') == config:
+                    last = run
+    return last
+
+def esi_benchmark(width=400, height=300, dates=52, stations=50, latency=0.2, jitter=0.0, fail_rate=0.0,
+                  workers=4, rate=0.0, stages=STAGES, results='./benchmark_results.jsonl', threshold=0.2,
+                  workdir=None, verbose=False):
+    config = {'width': width, 'height': height, 'dates': dates, 'stations': stations, 'latency': latency,
+              'jitter': jitter, 'fail_rate': fail_rate, 'workers': workers, 'rate': rate}
+    tmp = None
+    if workdir is None:
+        tmp = tempfile.TemporaryDirectory()
+        workdir = tmp.name
+    work = os.path.join(os.path.abspath(workdir), '')
+    try:
+        print("Making a {} x {} archive with {} dates and {} stations in {}".format(width, height, dates, stations, work))
+        archive = make_archive(work, width, height, dates, stations)
+        day0 = pd.Timestamp('2021-01-05')
+        ctx = dict(config, work=work, metadata=archive['metadata'], aoi=archive['aoi'], verbose=verbose,
+                   start=str(day0), end=str(day0 + pd.Timedelta(days=7 * (dates - 1))))
+        rows = []
+        # one new process per step (spawned, not forked, so it starts with nothing in memory)
+        spawn = multiprocessing.get_context('spawn')
+        for stage in with_needs(stages):
+            with ProcessPoolExecutor(max_workers=1, mp_context=spawn) as pool:
+                seconds, peak_mb = pool.submit(measure, stage, ctx).result()
+            files = dates if stage != 'point_fetch' and stage != 'comparison' else None
+            station_dates = stations * dates if stage in ('point_fetch', 'point_extraction', 'comparison') else None
+            rows.append({'stage': stage, 'seconds': round(seconds, 3), 'peak_rss_mb': round(peak_mb, 1),
+                         'files_per_s': round(files / seconds, 2) if files else None,
+                         'station_dates_per_s': round(station_dates / seconds, 1) if station_dates else None})
+            print("{}: {:.2f} s".format(stage, seconds))
+    finally:
+        if tmp is not None:
+            tmp.cleanup()
+
+    run = {'time': datetime.now().isoformat(timespec='seconds'), 'commit': git_commit(),
+           'python': platform.python_version(), 'config': config, 'stages': rows}
+    table = pd.DataFrame(rows).set_index('stage')
+    last = previous_run(results, config)
+    if last is not None:
+        before = {row['stage']: row['seconds'] for row in last['stages']}
+        table['seconds_before'] = [before.get(stage) for stage in table.index]
+        change = table['seconds'] / table['seconds_before'] - 1
+        table['change'] = change.map(lambda c: '' if pd.isna(c) else '{:+.0%}'.format(c))
+        table['slower'] = (change > threshold).map({True: '<-- slower', False: ''})
+        print("Compared to commit {} ({})".format(last.get('commit'), last.get('time')))
+    print(table.to_string())
+    with open(results, 'a') as f:
+        f.write(json.dumps(run) + '\n')
+    return table
+
+
+# if name in main so that we can run the script by itself (main)
+# or, it can be used embedded (import esi_benchmark) within another script
+if __name__ in '__main__':
+    # This allows the --help to show the docstring
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    # all arguments are optional
+    parser.add_argument('--width', help="Grid width in pixels (0.05 degrees each). Default = 400", type=int, default=400, required=False)
+    parser.add_argument('--height', help="Grid height in pixels. Default = 300", type=int, default=300, required=False)
+    parser.add_argument('--dates', help="Number of weekly dates. Default = 52", type=int, default=52, required=False)
+    parser.add_argument('--stations', help="Number of stations. Default = 50", type=int, default=50, required=False)
+    parser.add_argument('--latency', help="Seconds each fake request takes. Default = 0.2", type=float, default=0.2, required=False)
+    parser.add_argument('--jitter', help="Random +/- seconds added to the latency. Default = 0", type=float, default=0.0, required=False)
+    parser.add_argument('--fail_rate', help="Share of fake requests that fail (and are retried). Default = 0", type=float, default=0.0, required=False)
+    parser.add_argument('-w', '--workers', help="Workers (requests or processes) used in each step. Default = 4", type=int, default=4, required=False)
+    parser.add_argument('-r', '--rate', help="Maximum number of new requests per second, 0 = no limit. Default = 0", type=float, default=0.0, required=False)
+    parser.add_argument('--stages', help="Steps to time: {}. Default = all".format(', '.join(STAGES)), nargs='+', choices=STAGES, default=STAGES, required=False)
+    parser.add_argument('--results', help="File the results are added to. Default = ./benchmark_results.jsonl", type=str, default='./benchmark_results.jsonl', required=False)
+    parser.add_argument('--threshold', help="Mark steps that are this much slower than the last run (0.2 = 20%%). Default = 0.2", type=float, default=0.2, required=False)
+    parser.add_argument('--workdir', help="Keep the archive and outputs in this directory. Default = a temporary directory", type=str, default=None, required=False)
+    parser.add_argument('-v', '--verbose', help="Show the output of the scripts", action='store_true')
+    # array for all arguments passed to the script
+    args = parser.parse_args()
+
+    # now you can access the arguments input by the user and apply to our function
+    esi_benchmark(args.width, args.height, args.dates, args.stations, args.latency, args.jitter, args.fail_rate,
+                  args.workers, args.rate, args.stages, args.results, args.threshold, args.workdir, args.verbose)
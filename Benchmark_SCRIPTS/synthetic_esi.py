@@ -0,0 +1,175 @@
+"""
+Description: Makes a synthetic ESI archive (weekly ESI-like .tif files, a station metadata file and an area
+ of interest GeoJSON), and a local stand-in for climateserv.api.request_data that answers from it,
+ so the scripts can be run and timed without the ClimateSERV server.
+
+File Name: synthetic_esi.py
+
+Usage example: python synthetic_esi.py ./synthetic/ --width 400 --height 300 --dates 52 --stations 50
+
+help: python synthetic_esi.py --help
+
+Output (in the output directory):
+    raw/<yyyymmdd>.tif: one tif per week, 0.05 degree pixels (like ClimateSERV ESI), nodata = -9999
+    metadata.csv: longitude, latitude, stationTriplet for the random stations
+    aoi.GeoJSON: a polygon inside the grid to clip to
+
+NOTES:
+    - The values are smooth in space and time with some noise, between about -3 and 3 like ESI.
+      A corner of the grid is nodata (like the ocean).
+    - FakeClimateSERV(archive) can be passed as request_func to get_ESI_select_pt.py, get_ESI_tif.py,
+      esi_pipeline.py or climateserv_client.py. Each call waits `latency` seconds (+/- jitter) and fails
+      with a probability of fail_rate, then:
+        'Average': returns the average of the pixels under the polygon for each date, in the same
+            nested dictionary form as ClimateSERV.
+        'Download': writes a zip file with the part of each date's tif under the box.
+    - Everything is made from a seed, so the same settings make the same archive.
+    - see GitHub for climateSERV_env.yml and other files
+        https://github.com/carol-rowe/ClimateSERV_ESI_data
+
+"""
+
+import argparse
+import json
+import math
+import os
+import random
+import tempfile
+import threading
+import time
+import zipfile
+from glob import glob
+from pathlib import Path
+import numpy as np
+import pandas as pd
+import rasterio as rs
+from rasterio.transform import from_origin
+from rasterio.windows import Window
+
+PIXEL = 0.05
+NODATA = -9999.0
+
+def make_archive(outdir, width=400, height=300, dates=52, stations=50, west=-90.0, north=36.0,
+                 start='2021-01-05', seed=0):
+    # write the synthetic tifs, metadata and area of interest; returns the paths
+    rng = np.random.default_rng(seed)
+    raw = os.path.join(outdir, 'raw', '')
+    Path(raw).mkdir(parents=True, exist_ok=True)
+    transform = from_origin(west, north, PIXEL, PIXEL)
+    yy, xx = np.mgrid[0:height, 0:width].astype('float32')
+    # nodata in one corner, like the ocean
+    ocean = (xx / width + (height - yy) / height) < 0.25
+    profile = {'driver': 'GTiff', 'height': height, 'width': width, 'count': 1, 'dtype': 'float32',
+               'crs': 'EPSG:4326', 'transform': transform, 'nodata': NODATA}
+    for i, day in enumerate(pd.date_range(start, periods=dates, freq='7D')):
+        season = np.sin(2 * np.pi * day.dayofyear / 365.25)
+        esi = (1.5 * np.sin(xx / 37.0 + i / 9.0) * np.cos(yy / 29.0 - i / 13.0) + season
+               + rng.normal(0, 0.3, size=(height, width))).astype('float32')
+        esi[ocean] = NODATA
+        with rs.open(raw + day.strftime('%Y%m%d') + '.tif', 'w', **profile) as dst:
+            dst.write(esi, 1)
+
+    # stations and the area of interest are in the middle of the grid (away from the edges)
+    east, south = west + width * PIXEL, north - height * PIXEL
+    x0, x1 = west + 0.2 * (east - west), west + 0.9 * (east - west)
+    y0, y1 = south + 0.1 * (north - south), south + 0.8 * (north - south)
+    meta = pd.DataFrame({'longitude': rng.uniform(x0, x1, stations).round(5),
+                         'latitude': rng.uniform(y0, y1, stations).round(5),
+                         'stationTriplet': ['{}:XX:SYN'.format(1000 + i) for i in range(stations)]})
+    metadata = os.path.join(outdir, 'metadata.csv')
+    meta.to_csv(metadata, index=False)
+    aoi = os.path.join(outdir, 'aoi.GeoJSON')
+    ring = [[x0 - 0.1, y1 + 0.1], [x1 + 0.1, y1 + 0.1], [x1 + 0.1, y0 - 0.1], [x0 - 0.1, y0 - 0.1], [x0 - 0.1, y1 + 0.1]]
+    with open(aoi, 'w') as f:
+        json.dump({'type': 'FeatureCollection',
+                   'features': [{'type': 'Feature', 'properties': {'name': 'aoi'},
+                                 'geometry': {'type': 'Polygon', 'coordinates': [ring]}}]}, f)
+    return {'raw': raw, 'metadata': metadata, 'aoi': aoi, 'box': (west, east, south, north)}
+
+
+class FakeClimateSERV:
+    # same arguments as climateserv.api.request_data, answered from the tifs in archive/raw/
+    def __init__(self, archive, latency=0.0, jitter=0.0, fail_rate=0.0, seed=0):
+        self.raw = os.path.join(archive, 'raw', '')
+        self.latency = latency
+        self.jitter = jitter
+        self.fail_rate = fail_rate
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.calls = 0
+        self.failures = 0
+
+    def files(self, start, end):
+        start, end = pd.Timestamp(start), pd.Timestamp(end)
+        return [f for f in sorted(glob(self.raw + '*.tif'))
+                if start <= pd.Timestamp(Path(f).stem) <= end]
+
+    def __call__(self, DatasetType, OperationType, EarliestDate, LatestDate, GeometryCoords,
+                 SeasonalEnsemble, SeasonalVariable, Outfile):
+        with self.lock:
+            self.calls += 1
+            wait = max(self.latency + self.random.uniform(-self.jitter, self.jitter), 0)
+            fail = self.random.random() < self.fail_rate
+            self.failures += fail
+        time.sleep(wait)
+        if fail:
+            raise ConnectionError("fake ClimateSERV error")
+        xs = [p[0] for p in GeometryCoords]
+        ys = [p[1] for p in GeometryCoords]
+        files = self.files(EarliestDate, LatestDate)
+        if OperationType == 'Download':
+            return self.download(files, min(xs), min(ys), max(xs), max(ys), Outfile)
+        return self.average(files, min(xs), min(ys), max(xs), max(ys))
+
+    def window(self, img, xmin, ymin, xmax, ymax):
+        # the pixels under the box (at least the one pixel a tiny polygon is in), cut to the grid
+        t = img.transform
+        col0 = min(max(int(math.floor((xmin - t.c) / t.a)), 0), img.width - 1)
+        row0 = min(max(int(math.floor((ymax - t.f) / t.e)), 0), img.height - 1)
+        col1 = min(max(int(math.ceil((xmax - t.c) / t.a)), col0 + 1), img.width)
+        row1 = min(max(int(math.ceil((ymin - t.f) / t.e)), row0 + 1), img.height)
+        return Window(col0, row0, col1 - col0, row1 - row0)
+
+    def average(self, files, xmin, ymin, xmax, ymax):
+        data = []
+        for f in files:
+            with rs.open(f) as img:
+                a = img.read(1, window=self.window(img, xmin, ymin, xmax, ymax)).astype(float)
+            a = a[a != NODATA]
+            day = pd.Timestamp(Path(f).stem)
+            data.append({'date': day.strftime('%m/%d/%Y'), 'workid': 'fake', 'epochTime': str(int(day.timestamp())),
+                         'value': {'avg': float(a.mean()) if a.size else NODATA}})
+        return {'data': data}
+
+    def download(self, files, xmin, ymin, xmax, ymax, outfile):
+        with tempfile.TemporaryDirectory() as tmp, zipfile.ZipFile(outfile, 'w') as z:
+            for f in files:
+                with rs.open(f) as img:
+                    w = self.window(img, xmin, ymin, xmax, ymax)
+                    a = img.read(1, window=w)
+                    profile = img.profile.copy()
+                    profile.update(transform=img.window_transform(w), width=a.shape[1], height=a.shape[0])
+                tif = os.path.join(tmp, Path(f).name)
+                with rs.open(tif, 'w', **profile) as dst:
+                    dst.write(a, 1)
+                z.write(tif, Path(f).name)
+
+
+# if name in main so that we can run the script by itself (main)
+# or, it can be used embedded (import synthetic_esi) within another script
+if __name__ in '__main__':
+    # This allows the --help to show the docstring
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    # First argument is mandatory
+    parser.add_argument('outdir', metavar='output_directory', help="Directory for the synthetic archive, i.e. './synthetic/'")
+    # optional
+    parser.add_argument('--width', help="Grid width in pixels. Default = 400", type=int, default=400, required=False)
+    parser.add_argument('--height', help="Grid height in pixels. Default = 300", type=int, default=300, required=False)
+    parser.add_argument('--dates', help="Number of weekly dates. Default = 52", type=int, default=52, required=False)
+    parser.add_argument('--stations', help="Number of stations. Default = 50", type=int, default=50, required=False)
+    parser.add_argument('--seed', help="Random seed. Default = 0", type=int, default=0, required=False)
+    # array for all arguments passed to the script
+    args = parser.parse_args()
+
+    # now you can access the arguments input by the user and apply to our function
+    print(make_archive(args.outdir, args.width, args.height, args.dates, args.stations, seed=args.seed))
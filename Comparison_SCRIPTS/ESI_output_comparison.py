@@ -2,88 +2,281 @@
 Description: Compare the output from our 2 methods of acquiring ESI data (polygon vs tif/row/col method.)
 Compare values across the 8 closest pixels (user can change that value).
 To get the closest pixels, I used centroids (or middle of the pixel) long/lats.
-NOTE TO SELF: I should change the distance comparison using the haversine method!!!
+The closest pixels are found using the haversine distance (dist_km column), for all stations at once.
+The row/col of each station comes straight from the grid of pixel centroids, so only the few pixels
+around each station are checked (all pixels are checked only if the centroids are not on a regular grid).
 
 File Name: get_ESI_tif.py
 Author: Carol A. Rowe
 Date Created: 2021-05-10
 
 Usage: python ESI_output_comparison.py SCAN_AL_metadata.csv poly_ESI_df.csv ESI_tif2select_pt.csv master_ESI_CLIP_xyz.csv
+Usage: python ESI_output_comparison.py SCAN_AL_metadata.csv poly_ESI_df.csv ESI_tif2select_pt.csv master_ESI_CLIP_xyz.csv --batch -o comparison_output.csv
+
+--batch compares every station and every date in one pass and writes a table (csv or parquet) with one row per
+station and date: the poly and tif values, the nearest pixel value, the mean/min/max/std of the nearest pixels,
+and the differences between them (nodata, -9999, is left empty). A per-station summary is printed.
+
+Any of the 3 ESI inputs can also be a store from esi_store.py (i.e. ./ESI.sqlite); the poly, tif and xyz values are
+then read from it.
+Usage: python ESI_output_comparison.py SCAN_AL_metadata.csv ESI.sqlite ESI.sqlite ESI.sqlite --batch
+
+--trace, --profile and --memory add the time of each step (read inputs, nearest pixels, pixel stats, write) to a
+trace file, see esi_instrument.py
 
 THIS IS IN PROGRESS....MAY NOT BE FUNCTIONAL AS A STAND-ALONE SCRIPT AS OF YET!!!!!!
 """
 
 __author__ = "Carol A. Rowe"
 
+import sys
 import pandas as pd
+import numpy as np
 import argparse
+from pathlib import Path
+
+# the shared helpers are in the scripts folder
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / 'scripts'))
+import esi_store
+import esi_instrument
+
+EARTH_RADIUS_KM = 6371.0
+
+def haversine(lon1, lat1, lon2, lat2):
+    # great circle distance in km between points in decimal degrees (numpy arrays broadcast)
+    lon1, lat1, lon2, lat2 = map(np.radians, (lon1, lat1, lon2, lat2))
+    a = np.sin((lat2 - lat1) / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2) ** 2
+    return 2 * EARTH_RADIUS_KM * np.arcsin(np.sqrt(a))
+
+def pixel_grid(px, py):
+    # if the pixel centroids are on a regular grid (they are for tifs), return the grid:
+    # (x0, y0, dx, dy, lookup) where lookup[row, col] is the index of that pixel in px/py (-1 if missing)
+    xs, ys = np.unique(px), np.unique(py)
+    if len(xs) < 2 or len(ys) < 2:
+        return None
+    dx, dy = np.diff(xs).min(), np.diff(ys).min()
+    cols = np.rint((px - xs[0]) / dx).astype(int)
+    rows = np.rint((py - ys[0]) / dy).astype(int)
+    # not a regular grid if the centroids are not (close to) whole numbers of pixels apart
+    if not (np.allclose(xs[0] + cols * dx, px, atol=dx * 1e-3) and np.allclose(ys[0] + rows * dy, py, atol=dy * 1e-3)):
+        return None
+    # not worth it (or not a grid) if the lookup would be much bigger than the number of pixels, i.e.
+    # centroids a hair apart make dx tiny; and two centroids in the same cell would hide one of them
+    nrows, ncols = int(rows.max()) + 1, int(cols.max()) + 1
+    if nrows * ncols > 16 * len(px) or len(np.unique(rows * ncols + cols)) < len(px):
+        return None
+    lookup = np.full((nrows, ncols), -1, dtype=int)
+    lookup[rows, cols] = np.arange(len(px))
+    return xs[0], ys[0], dx, dy, lookup
+
+def nearest_brute(px, py, sx, sy, k, chunk=256):
+    # haversine distance from every station to every (unique) pixel, a chunk of stations at a time
+    idx = np.empty((len(sx), k), dtype=int)
+    dist = np.empty((len(sx), k))
+    for i in range(0, len(sx), chunk):
+        d = haversine(sx[i:i + chunk, None], sy[i:i + chunk, None], px[None, :], py[None, :])
+        part = np.argpartition(d, k - 1, axis=1)[:, :k] if k < d.shape[1] else np.tile(np.arange(d.shape[1]), (d.shape[0], 1))
+        order = np.argsort(np.take_along_axis(d, part, axis=1), axis=1)
+        idx[i:i + chunk] = np.take_along_axis(part, order, axis=1)
+        dist[i:i + chunk] = np.take_along_axis(d, idx[i:i + chunk], axis=1)
+    return idx, dist
+
+def nearest_grid(lookup, x0, y0, dx, dy, px, py, sx, sy, k):
+    # row/col of each station straight from the grid (no searching)
+    r0 = np.rint((sy - y0) / dy).astype(int)
+    c0 = np.rint((sx - x0) / dx).astype(int)
+    # look in a square of pixels around each station, and make the square bigger until it is
+    # certain to hold the k nearest pixels (a pixel is shorter in longitude than in latitude)
+    r = int(np.ceil(np.sqrt(k) / 2)) + 1
+    while True:
+        off = np.arange(-r, r + 1)
+        rows = np.repeat(r0[:, None] + off[None, :], len(off), axis=1)
+        cols = np.tile(c0[:, None] + off[None, :], (1, len(off)))
+        inside = (rows >= 0) & (rows < lookup.shape[0]) & (cols >= 0) & (cols < lookup.shape[1])
+        cand = np.where(inside, lookup[np.clip(rows, 0, lookup.shape[0] - 1), np.clip(cols, 0, lookup.shape[1] - 1)], -1)
+        d = np.where(cand >= 0, haversine(sx[:, None], sy[:, None], px[np.maximum(cand, 0)], py[np.maximum(cand, 0)]), np.inf)
+        order = np.argsort(d, axis=1)[:, :k]
+        dist = np.take_along_axis(d, order, axis=1)
+        # any pixel outside of the square is at least (r - 0.5) pixels away in latitude or in longitude
+        lat_max = np.minimum(np.abs(sy) + (r + 0.5) * dy, 90)
+        reach = 0.99 * np.minimum(haversine(0, 0, 0, (r - 0.5) * dy),
+                                  haversine(0, lat_max, (r - 0.5) * dx, lat_max))
+        covers_grid = (r >= lookup.shape[0]) and (r >= lookup.shape[1])
+        if np.all(dist[:, -1] <= reach) or covers_grid:
+            return np.take_along_axis(cand, order, axis=1), dist
+        r *= 2
+
+def nearest_pixels(px, py, sx, sy, k):
+    # indices (into px/py) and haversine distances (km) of the k nearest pixel centroids
+    # for all stations at once. Both are arrays of shape (number of stations, k), nearest first.
+    px, py = np.asarray(px, dtype=float), np.asarray(py, dtype=float)
+    sx, sy = np.asarray(sx, dtype=float), np.asarray(sy, dtype=float)
+    k = min(k, len(px))
+    grid = pixel_grid(px, py)
+    if grid is None:
+        return nearest_brute(px, py, sx, sy, k)
+    x0, y0, dx, dy, lookup = grid
+    idx, dist = np.empty((len(sx), k), dtype=int), np.empty((len(sx), k))
+    # stations on the grid use the grid; stations off of the grid (rare) are checked against every pixel
+    on_grid = ((sx >= x0 - dx) & (sx <= x0 + lookup.shape[1] * dx) &
+               (sy >= y0 - dy) & (sy <= y0 + lookup.shape[0] * dy))
+    if on_grid.any():
+        idx[on_grid], dist[on_grid] = nearest_grid(lookup, x0, y0, dx, dy, px, py, sx[on_grid], sy[on_grid], k)
+    # a few missing pixels (i.e. nodata) can leave a station with fewer than k pixels in its square
+    redo = ~on_grid | np.isinf(dist).any(axis=1)
+    if redo.any():
+        idx[redo], dist[redo] = nearest_brute(px, py, sx[redo], sy[redo], k)
+    return idx, dist
 
 def ESI_output_comparison(metadata, poly_ESI, tif_ESI, xyz, date, num_nearest):
-    metad = pd.read_csv(metadata)
-    meta = metad[['longitude', 'latitude', 'stationTriplet']]
-    poly = pd.read_csv(poly_ESI)
-    tif = pd.read_csv(tif_ESI)
-    xyz = pd.read_csv(xyz)
-
-    # want the print statements into a txt file
-    with open("comparison_output.txt", "a") as f:
-        # for each station print out comparison of 8 closest pts in the centroids
-        for i in range(0,meta.shape[0]):
-            # Getting the actual lat/long coords
-            xx = meta.loc[i, 'longitude'].astype(float)
-            yy = meta.loc[i, 'latitude'].astype(float)
-            print('---------------------NEXT-------------------', file=f)
-            print('Actual location: {}', format(xx, yy), file=f)
-            # get station name
-            stn = meta.loc[i, 'stationTriplet']
-            print('Station is: {}'.format(stn), file=f)
-            # get the lat and long closest to the centroid lat/long (output from either merge_esi_csv.py or tif2xyz.sh)
-            # getting the 8 closest centroids using absolute value of subtracting the actual lat/long to centroid lat/long
-            # this returns a pd.Series with the index values of the 8 centroids
-            index_xyz = ( xyz['x'].sub(xx).abs() + xyz['y'].sub(yy).abs()).argsort()[:num_nearest]
-            # make a list of the index values of the 8 closest centroids
-            index_list = index_xyz.values.tolist()
-            # use index values to subset the xyz dataframe
-            xyz_mini = xyz.iloc[index_list, :]
-            # make a new column to show a proxy of dist between pt and centroid using absolute value of simple subtraction
-            xyz_mini['abs_min'] = ((xyz_mini['x']-xx).abs()) + ((xyz_mini['y']-yy).abs())
-
-            # get the ESI value from the poly csv file; apply that value to entire new column
-            poly_mini = poly[ (poly['station']==stn) & (poly['date']==date)]
-            poly_mini.reset_index(drop=True, inplace=True)
-            poly_vals = poly_mini.loc[0,'avg']
-            # add value to the output dataframe
-            xyz_mini['poly'] = poly_vals
-
-            # get the ESI value from the tif csv file; apply that value to entire new column
-            tif_mini = tif[ (tif['station']==stn) & (tif['Date']==date)]
-            tif_mini.reset_index(drop=True, inplace=True)
-            tif_vals = tif_mini.loc[0,'ESI']
-            # add value to the output dataframe
-            xyz_mini['tif'] = tif_vals
-
-            print(xyz_mini, file=f)
+    with esi_instrument.stage('read_inputs'):
+        metad = pd.read_csv(metadata)
+        meta = metad[['longitude', 'latitude', 'stationTriplet']]
+        poly = read_table(poly_ESI, 'poly', date)
+        tif = read_table(tif_ESI, 'tif', date)
+        xyz = read_table(xyz, 'xyz', date)
+        # master_ESI_CLIP_xyz.csv has every pixel for every date: only want this date
+        if 'Date' in xyz.columns:
+            xyz = xyz[xyz['Date'] == date]
+
+    # the closest pixel centroids (output from either merge_esi_csv.py or tif2xyz.sh) for all stations at once,
+    # using the haversine distance. Each pixel is only looked at once, not once per date.
+    with esi_instrument.stage('nearest_pixels', stations=meta.shape[0]):
+        pixels = xyz[['x', 'y']].drop_duplicates().reset_index(drop=True)
+        nearest, dist_km = nearest_pixels(pixels['x'], pixels['y'], meta['longitude'], meta['latitude'], num_nearest)
+
+    with esi_instrument.stage('write'):
+        # want the print statements into a txt file
+        with open("comparison_output.txt", "a") as f:
+            # for each station print out comparison of 8 closest pts in the centroids
+            for i in range(0,meta.shape[0]):
+                # Getting the actual lat/long coords
+                xx = float(meta.loc[i, 'longitude'])
+                yy = float(meta.loc[i, 'latitude'])
+                print('---------------------NEXT-------------------', file=f)
+                print('Actual location: {}, {}'.format(xx, yy), file=f)
+                # get station name
+                stn = meta.loc[i, 'stationTriplet']
+                print('Station is: {}'.format(stn), file=f)
+                # the rows of xyz for the 8 closest centroids, closest first
+                near = pixels.iloc[nearest[i]].copy()
+                # distance (km) between the station and each centroid
+                near['dist_km'] = dist_km[i]
+                xyz_mini = near.merge(xyz, on=['x', 'y'], how='left')
+
+                # get the ESI value from the poly csv file; apply that value to entire new column
+                poly_mini = poly[ (poly['station']==stn) & (poly['date']==date)]
+                poly_mini.reset_index(drop=True, inplace=True)
+                poly_vals = poly_mini.loc[0,'avg']
+                # add value to the output dataframe
+                xyz_mini['poly'] = poly_vals
+
+                # get the ESI value from the tif csv file; apply that value to entire new column
+                tif_mini = tif[ (tif['station']==stn) & (tif['Date']==date)]
+                tif_mini.reset_index(drop=True, inplace=True)
+                tif_vals = tif_mini.loc[0,'ESI']
+                # add value to the output dataframe
+                xyz_mini['tif'] = tif_vals
+
+                print(xyz_mini, file=f)
+
+def read_table(path, source=None, date=None):
+    # the inputs can be csv or parquet files, or a store (esi_store.py) holding the source's values
+    if esi_store.is_store(path):
+        return esi_store.read_table(path, source, date, date)
+    if str(path).endswith('.parquet'):
+        return pd.read_parquet(path)
+    return pd.read_csv(path)
+
+def batch_comparison(metadata, poly_ESI, tif_ESI, xyz, num_nearest, outfile='comparison_output.csv', nodata=-9999):
+    # compare the polygon values, the tif (row/col) values and the nearest pixels
+    # for every station and every date at once. Writes one row per station and date.
+    with esi_instrument.stage('read_inputs') as s:
+        meta = read_table(metadata)[['longitude', 'latitude', 'stationTriplet']]
+        poly = read_table(poly_ESI, 'poly').rename(columns={'date': 'Date', 'avg': 'poly'})[['Date', 'poly', 'station']]
+        tif = read_table(tif_ESI, 'tif').rename(columns={'ESI': 'tif'})[['Date', 'tif', 'station']]
+        xyz = read_table(xyz, 'xyz')
+        # the ESI value column of the xyz file (z from tif2xyz.sh / merge_esi_csv.py)
+        value_col = [col for col in xyz.columns if col not in ('x', 'y', 'Date')][0]
+        for df in (poly, tif, xyz):
+            df['Date'] = pd.to_datetime(df['Date'])
+        s.set(rows=poly.shape[0] + tif.shape[0] + xyz.shape[0])
+
+    # the nearest pixels of every station, found once for all dates
+    with esi_instrument.stage('nearest_pixels', stations=meta.shape[0]):
+        pixels = xyz[['x', 'y']].drop_duplicates().reset_index(drop=True)
+        nearest, dist_km = nearest_pixels(pixels['x'], pixels['y'], meta['longitude'], meta['latitude'], num_nearest)
+    with esi_instrument.stage('pixel_stats'):
+        k = nearest.shape[1]
+        near = pd.DataFrame({'station': np.repeat(meta['stationTriplet'].to_numpy(), k),
+                             'rank': np.tile(np.arange(k), meta.shape[0]),
+                             'x': pixels['x'].to_numpy()[nearest.ravel()],
+                             'y': pixels['y'].to_numpy()[nearest.ravel()],
+                             'dist_km': dist_km.ravel()})
+        # one merge gives the value of every nearest pixel for every date, then one groupby summarizes them
+        near = near.merge(xyz[['x', 'y', 'Date', value_col]], on=['x', 'y'])
+        near[value_col] = near[value_col].where(near[value_col] != nodata)
+        grouped = near.sort_values('rank').groupby(['station', 'Date'])[value_col]
+        pixel_stats = pd.DataFrame({'nearest': grouped.first(),
+                                    'nearest_mean': grouped.mean(),
+                                    'nearest_min': grouped.min(),
+                                    'nearest_max': grouped.max(),
+                                    'nearest_std': grouped.std(),
+                                    'n_pixels': grouped.count()}).reset_index()
+
+        table = poly.merge(tif, on=['station', 'Date'], how='outer').merge(pixel_stats, on=['station', 'Date'], how='left')
+        # nodata (-9999) is not an ESI value
+        for col in ('poly', 'tif'):
+            table[col] = table[col].where(table[col] != nodata)
+        table['poly_minus_tif'] = table['poly'] - table['tif']
+        table['poly_minus_nearest'] = table['poly'] - table['nearest']
+        table['tif_minus_nearest'] = table['tif'] - table['nearest']
+        table['poly_minus_nearest_mean'] = table['poly'] - table['nearest_mean']
+        table = table.sort_values(['station', 'Date']).reset_index(drop=True)
+        table = table[['station', 'Date'] + [col for col in table.columns if col not in ('station', 'Date')]]
+    with esi_instrument.stage('write', rows=table.shape[0]):
+        if str(outfile).endswith('.parquet'):
+            table.to_parquet(outfile, index=False)
+        else:
+            table.to_csv(outfile, index=False)
+
+    # summary of the differences for each station
+    summary = table.groupby('station').agg(dates=('Date', 'nunique'),
+                                           mean_abs_poly_minus_tif=('poly_minus_tif', lambda d: d.abs().mean()),
+                                           max_abs_poly_minus_tif=('poly_minus_tif', lambda d: d.abs().max()),
+                                           mean_abs_poly_minus_nearest_mean=('poly_minus_nearest_mean', lambda d: d.abs().mean()))
+    print(summary.to_string())
+    return table
 
 # if name in main so that we can run the script by itself (main)
 # or, it can be used embedded (import ESI_tf_clip.py) within another script
 if __name__ in '__main__':
     # This allows the --help to show the docstring
     parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
-    # Add the input arguments: 4 mandatory, 2 optional
+    # Add the input arguments: 4 mandatory, 4 optional
     parser.add_argument('metadata', metavar='metadata.csv', help="Enter the pathway and filename for your shapefile. i.e. './SCAN_metadata.csv'  File must contain columns: longitude, latitude, stationTriplet")
     parser.add_argument('poly_ESI', metavar='poly_ESI_df.csv', help="Enter the pathway and filename for your poly_ESI_df.csv file. This is the output file from script:get_ESI_select_pt.py")
     parser.add_argument('tif_ESI', metavar='ESI_tif2select_pt.csv', help="Enter the pathway and filename for your ESI_tif2select_pt.csv file. This is the output file from script: tif2select_pts.py")
     parser.add_argument('xyz', metavar='master_ESI_CLIP_xyz.csv', help="Enter the pathway and filename to your master_ESI_CLIP_xyz.csv or individual <date>_CLIP.csv file. Output from either tif2xyz.sh or merge_esi_csv.py")
 
-    # Next 2 arguments are optional
+    # Next 4 arguments are optional
     parser.add_argument('-d', '--date', help="Enter date of ESI file as yyyy-mm-dd", type=str,
                         default='2021-03-30', required=False)
     parser.add_argument('-n', '--num_nearest',
                         help="Enter the number of nearest centroids you want to compare to. Default = 8",
                         type=int, default=8, required=False)
+    parser.add_argument('-b', '--batch', help="Compare every station and every date (ignores --date) and write one table", action='store_true')
+    parser.add_argument('-o', '--outfile', help="Output file for --batch (.csv or .parquet). Default = comparison_output.csv",
+                        type=str, default='comparison_output.csv', required=False)
+    # --trace, --profile, --memory (see esi_instrument.py)
+    esi_instrument.add_arguments(parser)
 
     # array for all arguments passed to the script
     args = parser.parse_args()
 
     # now you can access the arguments input by the user and apply to our function
-    ESI_output_comparison(args.metadata, args.poly_ESI, args.tif_ESI, args.xyz, args.date, args.num_nearest)
+    with esi_instrument.run('ESI_output_comparison', args.trace, args.profile, args.memory):
+        if args.batch:
+            batch_comparison(args.metadata, args.poly_ESI, args.tif_ESI, args.xyz, args.num_nearest, args.outfile)
+        else:
+            ESI_output_comparison(args.metadata, args.poly_ESI, args.tif_ESI, args.xyz, args.date, args.num_nearest)
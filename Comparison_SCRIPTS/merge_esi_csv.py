@@ -1,21 +1,49 @@
+"""
+Description: Merges the <date>_CLIP.csv files from tif2xyz.sh into one file (master_ESI_CLIP_xyz.csv) with a Date column.
+ tif2xyz.py does both steps (tif to xyz, and the merge) and does not need tif2xyz.sh.
+
+Usage: python merge_esi_csv.py /path/to/tif2csv_files/
+
+NOTES:
+    - Each csv file is added to the end of the output as it is read, so memory use does not grow
+      with the number of files.
+    - --trace, --profile and --memory add the time of each csv file to a trace file, see esi_instrument.py
+"""
+
+import sys
+import argparse
 import pandas as pd
 from glob import glob
 from pathlib import Path
 
-directory = '/path/to/tif2csv_files/'
-master_df = pd.DataFrame()
-for filepath in glob(directory + "20*_CLIP.csv"):
-    base = Path(filepath).stem
-    print(base)
-    date = base.split('_')[0]
-    # will want the file basename to create the output filename
-    df = pd.read_csv(filepath)
-    df['Date'] =date
-    df['Date'] = df['Date'].apply(pd.to_datetime)
-    #print(df.shape[0])
-    master_df = master_df.append(df, ignore_index=True,sort=False)
-    #print(master_df.shape[0])
+# the shared helpers are in the scripts folder
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / 'scripts'))
+import esi_instrument
+
+def merge_esi_csv(directory):
+    outfile = directory + 'master_ESI_CLIP_xyz.csv'
+    rows = 0
+    header = True
+    with open(outfile, 'w', newline='') as f:
+        for filepath in sorted(glob(directory + "20*_CLIP.csv")):
+            base = Path(filepath).stem
+            print(base)
+            date = base.split('_')[0]
+            # will want the file basename to create the output filename
+            with esi_instrument.span('read_csv', file=filepath) as s:
+                df = pd.read_csv(filepath)
+                df['Date'] = pd.to_datetime(date)
+                df.to_csv(f, header=header, index=False)
+                s.set(rows=df.shape[0])
+            header = False
+            rows += df.shape[0]
+    print(rows)
+
 
-#master_df['Date'] = master_df['Date'].apply(pd.to_datetime)
-master_df.to_csv(directory + 'master_ESI_CLIP_xyz.csv', index=False)
-print(master_df.shape)
+if __name__ in '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('directory', metavar='directory_to_files', help="Enter the pathway to your <date>_CLIP.csv files. For example: '/path/to/tif2csv_files/'")
+    esi_instrument.add_arguments(parser)
+    args = parser.parse_args()
+    with esi_instrument.run('merge_esi_csv', args.trace, args.profile, args.memory):
+        merge_esi_csv(args.directory)
@@ -0,0 +1,78 @@
+"""
+Description: Writes the xyz data (pixel centroid longitude (x), latitude (y) and ESI value (z)) of all
+ clipped .tif files into one file with a Date column: master_ESI_CLIP_xyz.csv (or .parquet).
+ This replaces tif2xyz.sh + merge_esi_csv.py.
+
+File Name: tif2xyz.py
+
+Usage example: python tif2xyz.py /path/to/clipped_files/
+Usage example: python tif2xyz.py /path/to/clipped_files/ -o ./master_ESI_CLIP_xyz.parquet
+
+help: python tif2xyz.py --help
+
+NOTES:
+    - input tif files are expected to be named by date followed by '_CLIP.tif' (output of ESI_tif_clip.py).
+      A zip file of tifs can also be used; then all of the tifs in it are used.
+    - The centroid coordinates are computed once per grid from the tif's transform, not once per file.
+    - nodata pixels are skipped.
+    - Each tif file's rows are written to the output as soon as the file is read, so memory use
+      does not grow with the number of dates. Parquet output requires pyarrow.
+    - Use -o something.sqlite to add the values to a local store instead (see esi_store.py).
+    - see GitHub for climateSERV_env.yml and other files
+        https://github.com/carol-rowe/ClimateSERV_ESI_data
+
+"""
+
+import sys
+import argparse
+from pathlib import Path
+import numpy as np
+import pandas as pd
+import rasterio as rs
+
+# the shared helpers are in the scripts folder
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / 'scripts'))
+from esi_files import output_dir, file_date
+from tif2select_pts import tif_files, write_chunks
+
+def centroids(transform, width, height):
+    # longitude and latitude of the middle of every pixel, in the same order as img.read(1).ravel()
+    x = transform.c + (np.arange(width) + 0.5) * transform.a
+    y = transform.f + (np.arange(height) + 0.5) * transform.e
+    xx, yy = np.meshgrid(x, y)
+    return xx.ravel(), yy.ravel()
+
+def iter_xyz(filepaths):
+    # yields one dataframe (x, y, z, Date) per tif file
+    grids = {}
+    for filepath in filepaths:
+        with rs.open(filepath) as img:
+            key = (tuple(img.transform)[:6], img.width, img.height)
+            if key not in grids:
+                grids[key] = centroids(img.transform, img.width, img.height)
+            xx, yy = grids[key]
+            z = img.read(1).ravel()
+            keep = ~np.isnan(z) if img.nodata is None or np.isnan(img.nodata) else (z != img.nodata) & ~np.isnan(z)
+        yield pd.DataFrame({'x': xx[keep], 'y': yy[keep], 'z': z[keep],
+                            'Date': pd.Timestamp(file_date(filepath))})
+
+def tif2xyz(directory, outfile=None):
+    if outfile is None:
+        outfile = output_dir(directory) + 'master_ESI_CLIP_xyz.csv'
+    write_chunks(iter_xyz(tif_files(directory)), outfile, 'xyz')
+
+
+# if name in main so that we can run the script by itself (main)
+# or, it can be used embedded (import tif2xyz) within another script
+if __name__ in '__main__':
+    # This allows the --help to show the docstring
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    # First argument is mandatory
+    parser.add_argument('directory', metavar='directory_to_files', help="Enter the pathway to your clipped tif files (or zip file). For example: '/home/name/my_tif_files/clipped_files/'")
+    # optional
+    parser.add_argument('-o', '--outfile', help="Output file. Use a .parquet extension for parquet output, or .sqlite to add to the store (esi_store.py). Default = master_ESI_CLIP_xyz.csv in the tif directory", type=str, default=None, required=False)
+    # array for all arguments passed to the script
+    args = parser.parse_args()
+
+    # now you can access the arguments input by the user and apply to our function
+    tif2xyz(args.directory, args.outfile)
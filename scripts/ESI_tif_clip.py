@@ -4,6 +4,9 @@ Description: Clips all .tif files in the input directory to the geometry in the
 
 Usage example: python ESI_tif_clip.py /path/to/tif/files/ ./your_shapefile.GeoJSON
 Usage example: python ESI_tif_clip.py /path/to/tif/files/ /path/to/shapefile.shp
+Usage example: python ESI_tif_clip.py /path/to/tif/files/ /path/to/shapefile.shp --workers 8
+Usage example: python ESI_tif_clip.py /path/to/ESI_tif.zip /path/to/shapefile.shp
+Usage example: python ESI_tif_clip.py /path/to/ESI_tif.zip /path/to/shapefile.shp --cube ./ESI_cube.nc
 
 help: python ESI_tif_clip.py --help
 
@@ -15,6 +18,15 @@ NOTES:
     - This was designed for .tif files with ESI data that I had downloaded from https://climateserv.servirglobal.net/
     - However, this should also work for most any tif file.
     - Likewise, I used a shapefile with the extension .GeoJSON. This should also work with .shp files as well.
+    - The shapefile is read once, and the crop window and mask are computed once for each grid
+      (crs, transform and size) instead of once per tif. Only the crop window is read from each tif.
+    - Use --workers to clip the tif files in several processes at the same time.
+    - The input can also be the zip file from get_ESI_tif.py. The tifs are read straight from the
+      zip file (no need to unzip it), and the clipped files go to clipped_files/ next to the zip file.
+    - Use --cube ./ESI_cube.nc to write all of the clipped rasters into one compressed, chunked
+      NetCDF file with a time dimension instead of one <date>_CLIP.tif per date (see esi_cube.py).
+    - Use --trace ./trace.jsonl (and --profile, --memory) to record how long each file takes
+      (see esi_instrument.py).
     - see GitHub for raster_env.yml and other files
         https://github.com/carol-rowe/ClimateSERV_ESI_data
 
@@ -22,40 +34,135 @@ NOTES:
 """
 
 import argparse
+import os
 import rasterio as rs
 import fiona
-from rasterio.mask import mask
-from glob import glob
+from rasterio.mask import raster_geometry_mask
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
 from pathlib import Path
+from esi_files import tif_paths, output_dir, file_date
+import esi_instrument
 
 __author__ = "Carol A. Rowe"
 
-def tif_clip(directory, shapefile):
+# crop window and mask for each grid, set in each worker process by set_masks()
+_masks = {}
+
+def grid_signature(img):
+    # tifs with the same crs, transform and size are on the same grid, so they share one crop window and mask
+    return (img.crs.to_string() if img.crs else None, tuple(img.transform)[:6], img.width, img.height)
+
+def set_masks(masks):
+    _masks.update(masks)
+
+def clip_raster(filepath, signature):
+    # open the tif file to be clipped, read only the crop window and mask out everything outside the shapes
+    shape_mask, transform, window = _masks[signature]
+    with esi_instrument.span('clip_file', file=filepath) as s, rs.open(filepath, "r") as img:
+        clipped = img.read(window=window, out_shape=(img.count,) + shape_mask.shape, masked=True)
+        clipped.mask = clipped.mask | shape_mask
+        clipped = clipped.filled(img.nodata if img.nodata is not None else 0)
+        meta = img.meta.copy()
+        s.set(pixels=clipped.size)
+        esi_instrument.count('pixels', clipped.size)
+    meta.update({'transform': transform, 'height': clipped.shape[1], 'width': clipped.shape[2]})
+    return clipped, meta
+
+def clip_file(filepath, new_path, signature):
+    # now create the cropped file
+    clipped, meta = clip_raster(filepath, signature)
+    with rs.open(new_path, 'w', **meta) as dst:
+        dst.write(clipped)
+    return new_path
+
+def iter_clipped(jobs, workers=1):
+    # yields (filepath, (clipped, meta)) in the same (date) order as jobs. Only a few files per
+    # worker are in flight at a time, so memory stays flat no matter how many dates there are.
+    if workers <= 1:
+        for filepath, _, signature in jobs:
+            yield filepath, clip_raster(filepath, signature)
+        return
+    with ProcessPoolExecutor(max_workers=workers, initializer=set_masks, initargs=(_masks,)) as pool:
+        pending = deque()
+        for filepath, _, signature in jobs:
+            pending.append((filepath, pool.submit(clip_raster, filepath, signature)))
+            if len(pending) >= workers * 2:
+                filepath, future = pending.popleft()
+                yield filepath, future.result()
+        while pending:
+            filepath, future = pending.popleft()
+            yield filepath, future.result()
+
+def clip_to_cube(jobs, cube_path, workers=1):
+    # write the clipped rasters, in date order, into one NetCDF cube instead of one tif per date
+    # (only this process writes to the cube; the workers only clip)
+    from esi_cube import open_cube, append_date
+    nc = None
+    added = 0
+    try:
+        for filepath, (clipped, meta) in iter_clipped(jobs, workers):
+            if nc is None:
+                nc = open_cube(cube_path, meta['transform'], meta['width'], meta['height'],
+                               meta['crs'], meta['nodata'])
+            added += append_date(nc, file_date(filepath), clipped[0])
+    finally:
+        if nc is not None:
+            nc.close()
+    print("Added {} dates to {}.".format(added, cube_path))
+
+def tif_clip(directory, shapefile, workers=1, cube=None, names=None, outpath=None):
     # make a new subdirectory for the output files
-    outpath = directory + "clipped_files/"
-    # if subdirectory doesn't already exist, make it
-    Path(outpath).mkdir(parents=True, exist_ok=True)
+    # (directory can also be a zip file, i.e. ESI_tif.zip. Then the tifs are read straight from the zip.)
+    # names: only clip the tifs with these file names (without .tif), i.e. the new dates. Default is all.
+    # outpath: directory for the clipped files. Default is clipped_files/ in (or next to) directory
+    if outpath is None:
+        outpath = output_dir(directory) + "clipped_files/"
+    outpath = os.path.join(outpath, '')
+    # if subdirectory doesn't already exist, make it (not needed when writing to a cube)
+    if cube is None:
+        Path(outpath).mkdir(parents=True, exist_ok=True)
 
     # open the shapefile that we want to crop the tif to
     # and save the area of interest (aoi) geometry to a variable
+    # (read the features once: a fiona collection can only be looped over once per open)
     with fiona.open(shapefile) as f:
-        my_aoi = [feature['geometry'] for feature in f]
-        my_prop = [feature['properties'] for feature in f]
-    for filepath in glob(directory+"*.tif"):
-        # will want the file basename to create the output filename
-        base = Path(filepath).stem
-        new_file = base + '_CLIP.tif'
-        # open the tif file to be clipped
-        # clipping and converting to decimal lat/long
-        with rs.open(filepath, "r") as img:
-            clipped, transform = mask(img, my_aoi, crop=True)
-            # in clipping the area outside the clip has a different null value than within the clipped
-            #np.place(clipped, clipped == -9999, -9.9990000e+03)
-            # now create the cropped file
-            meta = img.meta.copy()
-            meta.update({'transform': transform, 'height': clipped.shape[1], 'width': clipped.shape[2]})
-            with rs.open(outpath + new_file , 'w', **meta) as dst:
-                dst.write(clipped)
+        features = list(f)
+    my_aoi = [feature['geometry'] for feature in features]
+    my_prop = [feature['properties'] for feature in features]
+
+    # the crop window and mask only depend on the grid, not on the values in the tif,
+    # so they are computed once per grid (all ClimateSERV ESI tifs in a download share one grid)
+    masks = {}
+    jobs = []
+    with esi_instrument.stage('masks'):
+        for filepath in tif_paths(directory):
+            # will want the file basename to create the output filename
+            base = Path(filepath).stem
+            if names is not None and base not in names:
+                continue
+            new_file = base + '_CLIP.tif'
+            with rs.open(filepath, "r") as img:
+                signature = grid_signature(img)
+                if signature not in masks:
+                    # the same as rasterio.mask.mask(img, my_aoi, crop=True), without reading the data:
+                    # (mask that is True outside of the aoi, transform of the crop, window to read)
+                    masks[signature] = raster_geometry_mask(img, my_aoi, crop=True)
+            jobs.append((filepath, outpath + new_file, signature))
+
+    with esi_instrument.stage('clip', files=len(jobs), workers=workers):
+        if cube is not None:
+            set_masks(masks)
+            clip_to_cube(jobs, cube, workers)
+        elif workers <= 1:
+            set_masks(masks)
+            for job in jobs:
+                clip_file(*job)
+        else:
+            # each worker process gets the masks once, then only reads, masks and writes tifs
+            with ProcessPoolExecutor(max_workers=workers, initializer=set_masks, initargs=(masks,)) as pool:
+                for _ in pool.map(clip_file, *zip(*jobs)):
+                    pass
 
 
 # if name in main so that we can run the script by itself (main)
@@ -64,10 +171,16 @@ if __name__ in '__main__':
     # This allows the --help to show the docstring
     parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
     # Add the input arguments (2), both of which are mandatory
-    parser.add_argument('directory', metavar='directory_to_files', help="Enter the pathway to your tif files. For example: '/home/name/my_tif_files/'")
+    parser.add_argument('directory', metavar='directory_to_files', help="Enter the pathway to your tif files (or zip file). For example: '/home/name/my_tif_files/' or './ESI_tif.zip'")
     parser.add_argument('shapefile', metavar='shapefile', help="Enter the pathway and filename for your shapefile. i.e. './AL_state.GeoJSON'")
+    # optional
+    parser.add_argument('-w', '--workers', help="Number of processes used to clip the tif files. Default = 1", type=int, default=1, required=False)
+    parser.add_argument('-c', '--cube', help="Write the clipped rasters into this NetCDF file (i.e. ./ESI_cube.nc) instead of one tif per date. New dates are added to an existing cube.", type=str, default=None, required=False)
+    # --trace, --profile, --memory (see esi_instrument.py)
+    esi_instrument.add_arguments(parser)
     # array for all arguments passed to the script
     args = parser.parse_args()
 
     # now you can access the arguments input by the user and apply to our function
-    tif_clip(args.directory, args.shapefile)
\ No newline at end of file
+    with esi_instrument.run('ESI_tif_clip', args.trace, args.profile, args.memory):
+        tif_clip(args.directory, args.shapefile, args.workers, args.cube)
@@ -0,0 +1,259 @@
+"""
+Description: Concurrent, rate-limited wrapper around climateserv.api.request_data.
+
+File Name: climateserv_client.py
+
+Not a stand-alone script. Used by get_ESI_select_pt.py and get_ESI_tif.py to send
+requests to https://climateserv.servirglobal.net/
+
+    - Runs requests in a pool of threads with a bounded number in flight.
+    - A token bucket limits how many requests are started per second (this replaces
+      the old time.sleep(4) between requests).
+    - Failed requests are retried with a jittered exponential backoff. A request that
+      still fails after all retries is reported back, but does not stop the other requests.
+    - request_func can be swapped for a fake request_data (same arguments) to test
+      without the ClimateSERV server, i.e. one that sleeps and raises errors at random.
+    - ResponseCache keeps every response on local disk, named by a hash of the full request
+      (dataset, operation, dates, geometry). Asking for the exact same thing again is read from
+      disk instead of the server. Old entries are removed by age, and the oldest entries are removed
+      whenever a new response makes the cache bigger than max_size_mb.
+
+NOTES:
+    - see GitHub for climateSERV_env.yml and other files
+        https://github.com/carol-rowe/ClimateSERV_ESI_data
+
+"""
+
+import hashlib
+import json
+import os
+import random
+import shutil
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+import esi_instrument
+
+
+class ClimateSERVError(Exception):
+    # raised when ClimateSERV does not return any usable data for a request
+    pass
+
+
+class TokenBucket:
+    # allows `rate` requests per second on average, with bursts of up to `burst` requests
+    def __init__(self, rate, burst=1):
+        self.rate = float(rate)
+        self.capacity = float(max(burst, 1))
+        self.tokens = self.capacity
+        self.last = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        # block until a token is available (rate <= 0 means no limit)
+        if self.rate <= 0:
+            return
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.last) * self.rate)
+                self.last = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+class ResponseCache:
+    # content-addressed cache of ClimateSERV responses on local disk
+    # Average/Min/Max responses are saved as <hash>.json, Download responses as <hash>.zip
+    def __init__(self, directory=None, max_age_days=30, max_size_mb=2048, refresh=False):
+        self.directory = directory or os.path.join(os.path.expanduser('~'), '.cache', 'climateserv_esi')
+        self.max_age = max_age_days * 24 * 3600
+        self.max_size = max_size_mb * 1024 * 1024
+        # refresh: always ask the server, and replace the cached responses with the new ones
+        self.refresh = refresh
+        # total size of the entries (set by evict(), then kept up to date by put())
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        os.makedirs(self.directory, exist_ok=True)
+        self.evict()
+
+    def path(self, params):
+        # the key is everything but the outfile name, so that the same download saved
+        # under a different name is still a hit
+        key = json.dumps([str(p) for p in params[:7]])
+        ext = '.json' if params[7] == 'memory_object' else '.zip'
+        return os.path.join(self.directory, hashlib.sha256(key.encode()).hexdigest() + ext)
+
+    def count(self, hit):
+        with self.lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+
+    def get(self, params):
+        # returns (True, response) on a hit and (False, None) on a miss
+        path = self.path(params)
+        if self.refresh or not os.path.isfile(path) or time.time() - os.path.getmtime(path) > self.max_age:
+            self.count(False)
+            return False, None
+        if params[7] == 'memory_object':
+            with open(path) as f:
+                response = json.load(f)
+        else:
+            # same as request_data: the download is written to the outfile and nothing is returned
+            shutil.copyfile(path, params[7])
+            response = None
+        self.count(True)
+        return True, response
+
+    def put(self, params, response):
+        path = self.path(params)
+        # write to a temporary file first so that other threads (or runs) never see half a file
+        tmp = '{}.{}.{}.tmp'.format(path, os.getpid(), threading.get_ident())
+        if params[7] == 'memory_object':
+            with open(tmp, 'w') as f:
+                json.dump(response, f)
+        else:
+            shutil.copyfile(params[7], tmp)
+        size = os.path.getsize(tmp)
+        os.replace(tmp, path)
+        with self.lock:
+            self.size += size
+            full = self.size > self.max_size
+        # checked after every new entry so a long run cannot grow the cache past max_size
+        if full:
+            self.evict()
+
+    def evict(self):
+        # remove entries older than max_age, then the oldest entries until under max_size
+        # (the cache can be shared with other runs, so files may disappear while this runs)
+        with self.lock:
+            now = time.time()
+            entries = []
+            for name in os.listdir(self.directory):
+                path = os.path.join(self.directory, name)
+                try:
+                    if name.endswith('.tmp') or not os.path.isfile(path):
+                        continue
+                    stat = os.stat(path)
+                    if now - stat.st_mtime > self.max_age:
+                        os.remove(path)
+                    else:
+                        entries.append((stat.st_mtime, stat.st_size, path))
+                except FileNotFoundError:
+                    pass
+            total = sum(size for _, size, _ in entries)
+            for _, size, path in sorted(entries):
+                if total <= self.max_size:
+                    break
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+                total -= size
+            self.size = total
+
+    def report(self):
+        print("Cache: {} hits, {} misses ({})".format(self.hits, self.misses, self.directory))
+
+
+def default_request_func():
+    # imported here so that the rest of this module can be used (and tested) without climateserv
+    import climateserv.api
+    return climateserv.api.request_data
+
+
+def request_params(DatasetType, OperationType, EarliestDate, LatestDate, GeometryCoords,
+                   SeasonalEnsemble='', SeasonalVariable='', Outfile='memory_object'):
+    # arguments in the same order as climateserv.api.request_data
+    return (DatasetType, OperationType, EarliestDate, LatestDate, GeometryCoords,
+            SeasonalEnsemble, SeasonalVariable, Outfile)
+
+
+def outfile_mtime(params):
+    # modification time of the download file (None if it is not there yet)
+    if params[7] != 'memory_object' and os.path.isfile(params[7]):
+        return os.path.getmtime(params[7])
+    return None
+
+
+def check_response(params, response, mtime_before=None):
+    # request_data does not raise when the server fails: it prints an error and returns
+    # nothing (or an empty dictionary). Turn that into an error so it can be retried.
+    if params[7] == 'memory_object':
+        if not (isinstance(response, dict) and response.get('data')):
+            raise ClimateSERVError("No data returned for request: {}".format(params[:5]))
+    elif outfile_mtime(params) is None or outfile_mtime(params) == mtime_before:
+        # a download must have (re)written the outfile
+        raise ClimateSERVError("Download failed for request: {}".format(params[:5]))
+    return response
+
+
+def response_bytes(params, response):
+    # size of the response: the download file, or the json of a memory_object response
+    if params[7] == 'memory_object':
+        return len(json.dumps(response))
+    return os.path.getsize(params[7])
+
+
+def request_with_retry(params, request_func=None, bucket=None, retries=3, backoff=2.0, cache=None):
+    with esi_instrument.span('request', dataset=params[0], operation=params[1],
+                             start_date=params[2], end_date=params[3]) as s:
+        # cached responses do not count against the rate limit
+        if cache is not None:
+            hit, response = cache.get(params)
+            s.set(cache='hit' if hit else 'miss')
+            if hit:
+                esi_instrument.count('cache_hits')
+                return response
+        request_func = request_func or default_request_func()
+        for attempt in range(retries + 1):
+            if bucket is not None:
+                bucket.acquire()
+            try:
+                esi_instrument.count('requests')
+                mtime_before = outfile_mtime(params)
+                response = check_response(params, request_func(*params), mtime_before)
+                if cache is not None:
+                    cache.put(params, response)
+                if esi_instrument.enabled():
+                    size = response_bytes(params, response)
+                    s.set(retries=attempt, bytes=size)
+                    esi_instrument.count('bytes', size)
+                return response
+            except Exception as e:
+                if attempt == retries:
+                    s.set(retries=attempt)
+                    esi_instrument.count('failures')
+                    raise
+                esi_instrument.count('retries')
+                # full jitter: wait a random time between 0 and backoff * 2^attempt seconds
+                wait = random.uniform(0, backoff * 2 ** attempt)
+                print("Request failed ({}). Retry {} of {} in {:.1f} s.".format(e, attempt + 1, retries, wait))
+                time.sleep(wait)
+
+
+def request_many(requests, request_func=None, workers=4, rate=1.0, burst=1, retries=3, backoff=2.0,
+                 cache=None):
+    # requests: dictionary of {key: params} where params is the tuple from request_params()
+    # returns two dictionaries: {key: response} for the requests that worked and
+    # {key: exception} for the requests that failed after all of the retries
+    request_func = request_func or default_request_func()
+    bucket = TokenBucket(rate, burst)
+    results, failures = {}, {}
+    with ThreadPoolExecutor(max_workers=max(workers, 1)) as pool:
+        futures = {key: pool.submit(request_with_retry, params, request_func, bucket, retries, backoff, cache)
+                   for key, params in requests.items()}
+        for key, future in futures.items():
+            try:
+                results[key] = future.result()
+            except Exception as e:
+                print("Request for {} failed: {}".format(key, e))
+                failures[key] = e
+    return results, failures
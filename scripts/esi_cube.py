@@ -0,0 +1,146 @@
+"""
+Description: Stacks clipped ESI rasters into one compressed, chunked NetCDF file (an ESI "cube")
+ with a time dimension, and reads point time series back out of it.
+
+File Name: esi_cube.py
+
+Usage example: python esi_cube.py /path/to/clipped_files/ ./ESI_cube.nc
+Usage example: python esi_cube.py /path/to/ESI_tif.zip ./ESI_cube.nc
+
+help: python esi_cube.py --help
+
+NOTES:
+    - Can be run on its own (to stack tifs that were already clipped), but it is mostly used
+      through ESI_tif_clip.py --cube, which writes the clipped rasters straight into the cube.
+    - The time dimension is unlimited, so new dates are appended to an existing cube.
+      Dates that are already in the cube are skipped.
+    - All rasters in a cube must be on the same grid (same crs, transform and size).
+      The grid is saved with the cube (crs_wkt and geotransform attributes).
+    - ESI values are stored compressed (zlib) in chunks of (time, y, x). Reading a point time
+      series only reads the chunks that contain that pixel, not every date's raster.
+    - Requires the netCDF4 package (see climateSERV_env.yml)
+    - see GitHub for climateSERV_env.yml and other files
+        https://github.com/carol-rowe/ClimateSERV_ESI_data
+
+"""
+
+import argparse
+import os
+import numpy as np
+import pandas as pd
+import rasterio as rs
+from affine import Affine
+from netCDF4 import Dataset
+from esi_files import tif_paths, file_date
+from tif2select_pts import station_rowcol
+
+TIME_UNITS = 'days since 1970-01-01'
+EPOCH = pd.Timestamp('1970-01-01')
+
+def create_cube(cube_path, transform, width, height, crs, nodata, chunks=(52, 64, 64)):
+    # new, empty cube on the grid of the (clipped) tif files
+    nc = Dataset(cube_path, 'w', format='NETCDF4')
+    nc.createDimension('time', None)
+    nc.createDimension('y', height)
+    nc.createDimension('x', width)
+    time = nc.createVariable('time', 'f8', ('time',))
+    time.units = TIME_UNITS
+    # pixel centroids (middle of the pixel boxes)
+    x = nc.createVariable('x', 'f8', ('x',))
+    y = nc.createVariable('y', 'f8', ('y',))
+    x[:] = transform.c + (np.arange(width) + 0.5) * transform.a
+    y[:] = transform.f + (np.arange(height) + 0.5) * transform.e
+    fill = np.float32(nodata if nodata is not None else -9999)
+    esi = nc.createVariable('ESI', 'f4', ('time', 'y', 'x'), zlib=True, complevel=4, fill_value=fill,
+                            chunksizes=(chunks[0], min(chunks[1], height), min(chunks[2], width)))
+    esi.long_name = 'Evaporative Stress Index'
+    nc.crs_wkt = crs.to_wkt() if crs else ''
+    nc.geotransform = np.array(transform.to_gdal(), dtype='f8')
+    return nc
+
+def cube_grid(nc):
+    # transform, width and height of the cube
+    return Affine.from_gdal(*nc.geotransform), len(nc.dimensions['x']), len(nc.dimensions['y'])
+
+def open_cube(cube_path, transform, width, height, crs, nodata):
+    # open an existing cube to append to (checking it is on the same grid), or make a new one
+    if not os.path.isfile(cube_path):
+        return create_cube(cube_path, transform, width, height, crs, nodata)
+    nc = Dataset(cube_path, 'a')
+    cube_transform, cube_width, cube_height = cube_grid(nc)
+    if (cube_width, cube_height) != (width, height) or not cube_transform.almost_equals(transform):
+        nc.close()
+        raise ValueError("{} is on a different grid than the rasters being added.".format(cube_path))
+    return nc
+
+def cube_dates(nc):
+    return EPOCH + pd.to_timedelta(np.asarray(nc.variables['time'][:], dtype=float), unit='D')
+
+def append_date(nc, date, data):
+    # add one date's raster (2D array) to the end of the cube, unless that date is already in it
+    days = (pd.Timestamp(date) - EPOCH).days
+    time = nc.variables['time']
+    if len(time) and days in time[:]:
+        return False
+    i = len(time)
+    time[i] = days
+    nc.variables['ESI'][i, :, :] = data
+    return True
+
+def tifs_to_cube(source, cube_path):
+    # stack (already clipped) tif files, in date order, into the cube
+    nc = None
+    added = 0
+    try:
+        for filepath in tif_paths(source):
+            with rs.open(filepath) as img:
+                if nc is None:
+                    nc = open_cube(cube_path, img.transform, img.width, img.height, img.crs, img.nodata)
+                added += append_date(nc, file_date(filepath), img.read(1))
+    finally:
+        if nc is not None:
+            nc.close()
+    print("Added {} dates to {}.".format(added, cube_path))
+
+def read_point_series(cube_path, meta, start=None, end=None):
+    # ESI time series for each station in the metadata (longitude, latitude, stationTriplet)
+    # returns the same columns as tif2select_pts.py: Date, ESI, station
+    xs = meta['longitude'].to_numpy(dtype=float)
+    ys = meta['latitude'].to_numpy(dtype=float)
+    stations = meta['stationTriplet'].to_numpy()
+    with Dataset(cube_path, 'r') as nc:
+        transform, width, height = cube_grid(nc)
+        dates = cube_dates(nc)
+        keep = np.ones(len(dates), dtype=bool)
+        if start is not None:
+            keep &= dates >= pd.Timestamp(start)
+        if end is not None:
+            keep &= dates <= pd.Timestamp(end)
+        t = np.flatnonzero(keep)
+        rows, cols, inside = station_rowcol(transform, xs, ys, height, width)
+        esi = nc.variables['ESI']
+        esi.set_auto_mask(False)
+        values = np.full((len(xs), len(t)), np.nan)
+        for i in np.flatnonzero(inside):
+            # only the chunks that hold this one pixel are read and decompressed
+            values[i] = esi[:, rows[i], cols[i]][t]
+    # same order as tif2select_pts.py: by date, then by station
+    order = np.argsort(dates[t], kind='stable')
+    return pd.DataFrame({'Date': np.repeat(dates[t][order], len(xs)),
+                         'ESI': values[:, order].T.ravel(),
+                         'station': np.tile(stations, len(t))})
+
+
+# if name in main so that we can run the script by itself (main)
+# or, it can be used embedded (import esi_cube) within another script
+if __name__ in '__main__':
+    # This allows the --help to show the docstring
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    # Add the input arguments (2), both of which are mandatory
+    parser.add_argument('directory', metavar='directory_to_files', help="Enter the pathway to your (clipped) tif files or zip file. For example: '/home/name/my_tif_files/clipped_files/'")
+    parser.add_argument('cube', metavar='cube.nc', help="Enter the pathway and filename of the NetCDF cube. New dates are added if it already exists. i.e. './ESI_cube.nc'")
+    # array for all arguments passed to the script
+    args = parser.parse_args()
+
+    # now you can access the arguments input by the user and apply to our function
+    tifs_to_cube(args.directory, args.cube)
@@ -0,0 +1,44 @@
+"""
+Description: Finds the ESI .tif files in a directory or directly inside a zip file (i.e. ESI_tif.zip
+ from get_ESI_tif.py), so the zip file does not have to be unpacked first.
+
+File Name: esi_files.py
+
+Not a stand-alone script. Used by ESI_tif_clip.py, tif2select_pts.py and get_ESI_select_pt.py.
+
+NOTES:
+    - tif files inside a zip file are returned as rasterio/GDAL '/vsizip/' paths. rasterio reads
+      them straight out of the zip file, so the raw tifs are never written to disk.
+    - see GitHub for climateSERV_env.yml and other files
+        https://github.com/carol-rowe/ClimateSERV_ESI_data
+
+"""
+
+import os
+import zipfile
+from fnmatch import fnmatch
+from glob import glob
+from pathlib import Path
+
+def is_zip(source):
+    return str(source).lower().endswith('.zip')
+
+def tif_paths(source, pattern="*.tif"):
+    # source is either a directory (ending in '/') or a zip file
+    # returned in sorted order, which is date order since the files are named by date
+    if is_zip(source):
+        zip_path = os.path.abspath(source)
+        with zipfile.ZipFile(zip_path) as z:
+            members = [name for name in z.namelist() if fnmatch(os.path.basename(name), pattern)]
+        return ['/vsizip/{}/{}'.format(zip_path, name) for name in sorted(members, key=os.path.basename)]
+    return sorted(glob(source + pattern))
+
+def output_dir(source):
+    # where to save the outputs: the directory itself, or the directory the zip (or cube) file is in
+    if is_zip(source) or str(source).endswith('.nc'):
+        return os.path.join(os.path.dirname(os.path.abspath(source)), '')
+    return source
+
+def file_date(path):
+    # the tif files are named by date, i.e. 20210330.tif or 20210330_CLIP.tif
+    return Path(path).stem.split('_')[0]
@@ -0,0 +1,220 @@
+"""
+Description: Timing spans, counters and optional cProfile / tracemalloc output for the ESI scripts,
+ written as JSON lines (one event per line) that can be read back with this script or fed into monitoring.
+
+File Name: esi_instrument.py
+
+Usage example: python get_ESI_select_pt.py ./SCAN_AL_metadata.csv --trace ./trace.jsonl
+Usage example: python ESI_tif_clip.py ./ESI_tif.zip ./AL_state.GeoJSON --trace ./trace.jsonl --profile --memory
+Usage example: python esi_instrument.py ./trace.jsonl    (summary of a trace file)
+
+help: python esi_instrument.py --help
+
+Flags (added to get_ESI_select_pt.py, get_ESI_tif.py, ESI_tif_clip.py, tif2select_pts.py,
+ESI_output_comparison.py, merge_esi_csv.py, esi_pipeline.py and esi_temporal.py):
+    --trace FILE: add the events of this run to FILE
+    --profile: run the script under cProfile. The stats go to FILE.prof (open with pstats or snakeviz)
+        and the top functions are added to FILE as a 'profile' event. Only the main thread of the main
+        process is profiled: the request threads of climateserv_client.request_many, the steps run in
+        the esi_pipeline.py thread pool and the worker processes (--workers) are not in the profile
+        (their time still shows up in their spans).
+    --memory: track python memory with tracemalloc. The peak and the top lines are added as a 'memory' event
+    (--profile and --memory without --trace write to <script>_trace.jsonl)
+
+Events (every event has: event, time (unix seconds), pid):
+    span: name, start, seconds, thread, error (if it raised), plus its own fields, i.e.
+        run: the whole script;  stage: one step of a script (step);  pipeline: one step of esi_pipeline.py (step);
+        request: one ClimateSERV request (operation, cache, retries, bytes);
+        read_tif / clip_file: one tif file (file, pixels);  read_csv: one csv file (file, rows)
+    counters: totals for one process, i.e. requests, retries, failures, cache_hits, bytes, pixels
+    profile, memory: see above
+
+NOTES:
+    - When tracing is off, span() and count() do nothing (no file is written).
+    - The trace file is opened in append mode and each event is written with a single write, so the
+      worker processes (--workers) and threads can all write to the same file. The ESI_TRACE environment
+      variable holds the file name, so worker processes (and any script run with ESI_TRACE set) trace too.
+    - Counters are written at the end of a run. Worker processes do not get to the end of the run,
+      so they write their counters each time one of their spans ends. The summary adds them all up.
+      A forked worker starts with no counts (the parent's are left to the parent).
+    - see GitHub for climateSERV_env.yml and other files
+        https://github.com/carol-rowe/ClimateSERV_ESI_data
+
+"""
+
+import argparse
+import cProfile
+import io
+import json
+import os
+import pstats
+import threading
+import time
+import tracemalloc
+from collections import Counter
+from contextlib import contextmanager
+
+# run_pid: the process that called run(); other processes (workers) write their counters after each span
+_trace = {'fd': None, 'path': None, 'run_pid': None}
+_counters = Counter()
+_lock = threading.Lock()
+
+def enabled():
+    return _trace['fd'] is not None
+
+def configure(path):
+    # start writing events to path (None: leave tracing as it is)
+    if path is None or _trace['path'] == os.path.abspath(path):
+        return
+    path = os.path.abspath(path)
+    _trace['fd'] = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+    _trace['path'] = path
+    # worker processes read this when they import this module
+    os.environ['ESI_TRACE'] = path
+
+def emit(event, **fields):
+    if not enabled():
+        return
+    record = {'event': event, 'time': round(time.time(), 6), 'pid': os.getpid()}
+    record.update(fields)
+    # one write per line, so lines from several processes/threads are never mixed
+    os.write(_trace['fd'], (json.dumps(record, default=str) + '\n').encode())
+
+def count(name, n=1):
+    if enabled():
+        with _lock:
+            _counters[name] += n
+
+def flush_counters():
+    with _lock:
+        counters = dict(_counters)
+        _counters.clear()
+    if counters:
+        emit('counters', counters=counters)
+
+def _after_fork():
+    # a forked worker starts with a copy of the parent's counters, which the parent writes itself
+    # (and a copy of the lock, which another thread may have been holding)
+    global _lock
+    _lock = threading.Lock()
+    _counters.clear()
+
+
+class span:
+    # with span('read_tif', file=filepath) as s:  ...  s.set(pixels=n)
+    def __init__(self, name, **fields):
+        self.name = name
+        self.fields = fields
+
+    def set(self, **fields):
+        self.fields.update(fields)
+
+    def __enter__(self):
+        if enabled():
+            self.start = time.time()
+            self.t0 = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if enabled() and hasattr(self, 't0'):
+            fields = dict(self.fields)
+            if exc is not None:
+                fields['error'] = repr(exc)
+            emit('span', name=self.name, start=round(self.start, 6),
+                 seconds=round(time.perf_counter() - self.t0, 6), thread=threading.get_ident(), **fields)
+            if _trace['run_pid'] != os.getpid():
+                flush_counters()
+        return False
+
+
+def stage(step, **fields):
+    return span('stage', step=step, **fields)
+
+def top_functions(profile, n=20):
+    # the n functions with the most cumulative time
+    stats = pstats.Stats(profile, stream=io.StringIO()).sort_stats('cumulative')
+    rows = []
+    for (filename, line, func), (cc, nc, tt, ct, callers) in stats.stats.items():
+        rows.append({'function': '{}:{}({})'.format(os.path.basename(filename), line, func),
+                     'calls': nc, 'tottime': round(tt, 6), 'cumtime': round(ct, 6)})
+    return sorted(rows, key=lambda row: -row['cumtime'])[:n]
+
+@contextmanager
+def run(name, trace=None, profile=False, memory=False):
+    # wraps a whole script: a 'run' span, plus the counters, profile and memory events at the end
+    if trace is None and (profile or memory):
+        trace = name + '_trace.jsonl'
+    configure(trace)
+    _trace['run_pid'] = os.getpid()
+    if memory:
+        tracemalloc.start()
+    prof = cProfile.Profile() if profile else None
+    if prof is not None:
+        prof.enable()
+    try:
+        with span('run', script=name):
+            yield
+    finally:
+        if prof is not None:
+            prof.disable()
+            prof_file = os.path.splitext(_trace['path'])[0] + '.prof'
+            prof.dump_stats(prof_file)
+            emit('profile', script=name, file=prof_file, top=top_functions(prof))
+        if memory:
+            current, peak = tracemalloc.get_traced_memory()
+            top = tracemalloc.take_snapshot().statistics('lineno')[:10]
+            tracemalloc.stop()
+            emit('memory', script=name, current_mb=round(current / 2 ** 20, 3), peak_mb=round(peak / 2 ** 20, 3),
+                 top=[{'line': str(stat.traceback), 'size_mb': round(stat.size / 2 ** 20, 3), 'count': stat.count}
+                      for stat in top])
+        flush_counters()
+
+def add_arguments(parser):
+    # the same three flags for every script
+    parser.add_argument('--trace', help="Add timing spans and counters (JSON lines) to this file, i.e. ./trace.jsonl", type=str, default=None, required=False)
+    parser.add_argument('--profile', help="Run under cProfile; stats go to <trace>.prof and the top functions to the trace", action='store_true')
+    parser.add_argument('--memory', help="Track python memory use with tracemalloc (peak and top lines go to the trace)", action='store_true')
+
+def summarize(trace):
+    # per span name: how many, total/mean/max seconds and the sum of their counts; plus the counters
+    import pandas as pd
+    with open(trace) as f:
+        events = [json.loads(line) for line in f if line.strip()]
+    spans = pd.DataFrame([e for e in events if e['event'] == 'span'])
+    if not spans.empty:
+        if 'step' in spans.columns:
+            spans['name'] = spans['name'].where(spans['step'].isna(), spans['name'] + ': ' + spans['step'].astype(str))
+        table = spans.groupby('name')['seconds'].agg(['count', 'sum', 'mean', 'max'])
+        for col in ('pixels', 'rows', 'bytes', 'retries'):
+            if col in spans.columns:
+                table[col] = spans.groupby('name')[col].sum(min_count=1)
+        print(table.sort_values('sum', ascending=False).to_string())
+    counters = Counter()
+    for e in events:
+        if e['event'] == 'counters':
+            counters.update(e['counters'])
+    if counters:
+        print('\n'.join('{}: {}'.format(k, v) for k, v in sorted(counters.items())))
+    for e in events:
+        if e['event'] == 'memory':
+            print("{} peak python memory: {} MB".format(e['script'], e['peak_mb']))
+
+
+# worker processes (and scripts run with ESI_TRACE set) write to the same trace file
+configure(os.environ.get('ESI_TRACE') or None)
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_after_fork)
+
+
+# if name in main so that we can run the script by itself (main)
+# or, it can be used embedded (import esi_instrument) within another script
+if __name__ in '__main__':
+    # This allows the --help to show the docstring
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    # First argument is mandatory
+    parser.add_argument('trace', metavar='trace.jsonl', help="Trace file written with --trace")
+    # array for all arguments passed to the script
+    args = parser.parse_args()
+
+    # now you can access the arguments input by the user and apply to our function
+    summarize(args.trace)
@@ -0,0 +1,311 @@
+"""
+Description: Runs the whole ESI workflow (see ESI_flowchart.pdf) in one go, and only re-runs the steps
+ whose inputs changed since the last run:
+
+    download (get_ESI_tif.py)  ->  clip (ESI_tif_clip.py)  ->  tif_pts (tif2select_pts.py)  ->  compare
+    poly (get_ESI_select_pt.py)                            ->  xyz (tif2xyz.py)             ->  (ESI_output_comparison.py --batch)
+
+File Name: esi_pipeline.py
+
+Usage example: python esi_pipeline.py ./SCAN_AL_metadata.csv ./AL_state.GeoJSON -d ./ESI_run/ -s 01/01/2021 -e 03/31/2021
+Usage example: python esi_pipeline.py ./SCAN_AL_metadata.csv ./AL_state.GeoJSON -d ./ESI_run/ --force poly
+
+help: python esi_pipeline.py --help
+
+Outputs (all in the --workdir directory):
+    ESI_tif.zip, clipped_files/<date>_CLIP.tif, poly_ESI_df.csv, ESI_tif2select_pt.csv,
+    master_ESI_CLIP_xyz.csv, comparison_output.csv
+    pipeline_state.json: what each step last ran with (the checkpoint)
+
+NOTES:
+    - Each step lists its input and output files. A step runs after the steps that make its inputs,
+      and steps that do not depend on each other (i.e. download and poly) run at the same time (--jobs).
+    - When a step is done, its parameters, the fingerprint of its inputs and the fingerprint of its
+      outputs are saved in pipeline_state.json. The next run skips the step if none of them changed.
+      A fingerprint is the size and modified time of each file, or its sha256 with --hash.
+    - If a run is stopped, the next run starts again from the steps that did not finish.
+    - clip only clips the dates that are new or changed in ESI_tif.zip (by the checksum of each tif in
+      the zip, and the shapefile), in batches, so a stopped clip also picks up where it left off.
+    - poly uses get_ESI_select_pt.py --update, so a later end date only requests the new dates.
+      It always uses --mode point (the polygon request this workflow compares against the tifs).
+      If another parameter of a step changes (i.e. --esi_Type), its old outputs are removed first.
+    - The bounding box for the download is the shapefile's bounds plus --pad degrees.
+    - --trace, --profile and --memory time each step (and the steps inside each script), see esi_instrument.py
+    - see GitHub for climateSERV_env.yml and other files
+        https://github.com/carol-rowe/ClimateSERV_ESI_data
+
+"""
+
+import sys
+import argparse
+import hashlib
+import json
+import os
+import shutil
+import threading
+import time
+import zipfile
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from datetime import datetime, date
+from pathlib import Path
+from dateutil.relativedelta import *
+import fiona
+from climateserv_client import ResponseCache
+import esi_instrument
+from get_ESI_tif import get_ESI_tif
+from get_ESI_select_pt import get_ESI_select_pt
+from ESI_tif_clip import tif_clip
+from tif2select_pts import tif2select_pts
+
+# the comparison scripts are in the Comparison_SCRIPTS folder
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / 'Comparison_SCRIPTS'))
+
+
+class Stage:
+    # one step of the pipeline: func(**params, **options) reads the inputs and writes the outputs
+    # params are part of the checkpoint (a change re-runs the step); options (workers, cache) are not.
+    # A change in any param other than the update_params also removes the old outputs first.
+    def __init__(self, name, func, inputs=(), outputs=(), params=None, options=None, update_params=()):
+        self.name = name
+        self.func = func
+        self.inputs = list(inputs)
+        self.outputs = list(outputs)
+        self.params = params or {}
+        self.options = options or {}
+        self.update_params = set(update_params)
+
+
+def file_hash(path):
+    sha = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            sha.update(block)
+    return sha.hexdigest()
+
+def fingerprint(path, content=False):
+    # size and modified time (or sha256) of a file, or of every file in a directory
+    if os.path.isdir(path):
+        return {name: fingerprint(os.path.join(path, name), content)
+                for name in sorted(os.listdir(path)) if os.path.isfile(os.path.join(path, name))}
+    if not os.path.exists(path):
+        return None
+    if content:
+        return file_hash(path)
+    stat = os.stat(path)
+    return [stat.st_size, stat.st_mtime_ns]
+
+def read_json(path):
+    if not os.path.isfile(path):
+        return {}
+    with open(path) as f:
+        return json.load(f)
+
+def write_json(path, data):
+    # write to a temporary file first so a stopped run never leaves half a file
+    tmp = '{}.{}.tmp'.format(path, os.getpid())
+    with open(tmp, 'w') as f:
+        json.dump(data, f, indent=1, default=str)
+    os.replace(tmp, path)
+
+def remove_path(path):
+    if os.path.isdir(path):
+        shutil.rmtree(path)
+    elif os.path.exists(path):
+        os.remove(path)
+
+def check_dag(stages):
+    # every output is made by one step, and the steps do not depend on each other in a loop
+    producers = {}
+    for stage in stages:
+        for out in stage.outputs:
+            assert out not in producers, "{} is an output of both {} and {}".format(out, producers[out], stage.name)
+            producers[out] = stage.name
+    deps = {stage.name: {producers[i] for i in stage.inputs if i in producers} for stage in stages}
+    done = set()
+    while len(done) < len(deps):
+        ready = [name for name in deps if name not in done and deps[name] <= done]
+        assert ready, "The steps depend on each other in a loop: {}".format(sorted(set(deps) - done))
+        done.update(ready)
+    return deps
+
+def run_pipeline(stages, state_path, jobs=2, content=False, force=()):
+    # run the steps in dependency order, jobs at a time, skipping the ones that are up to date
+    deps = check_dag(stages)
+    state = read_json(state_path)
+    lock = threading.Lock()
+
+    def run_stage(stage):
+        params_json = json.dumps(stage.params, sort_keys=True, default=str)
+        inputs = {path: fingerprint(path, content) for path in stage.inputs}
+        assert all(fp is not None for fp in inputs.values()), \
+            "{}: missing input {}".format(stage.name, [p for p, fp in inputs.items() if fp is None])
+        signature = hashlib.sha256(json.dumps([params_json, inputs], sort_keys=True).encode()).hexdigest()
+        with lock:
+            last = state.get(stage.name, {})
+        outputs_unchanged = last.get('outputs') == {path: fingerprint(path, content) for path in stage.outputs}
+        if stage.name not in force and last.get('signature') == signature and outputs_unchanged:
+            print("{}: up to date".format(stage.name))
+            return
+        # a change in a parameter that the step cannot add to (i.e. esi_Type) starts the outputs over
+        old_params = {k: v for k, v in json.loads(last.get('params', '{}')).items() if k not in stage.update_params}
+        new_params = {k: v for k, v in json.loads(params_json).items() if k not in stage.update_params}
+        if last and old_params != new_params:
+            for path in stage.outputs:
+                remove_path(path)
+        print("{}: running".format(stage.name))
+        t0 = time.time()
+        with esi_instrument.span('pipeline', step=stage.name):
+            stage.func(**stage.params, **stage.options)
+        outputs = {path: fingerprint(path, content) for path in stage.outputs}
+        assert all(fp is not None for fp in outputs.values()), \
+            "{}: did not write {}".format(stage.name, [p for p, fp in outputs.items() if fp is None])
+        # checkpoint: save as soon as the step is done, so a stopped run starts again from here
+        with lock:
+            state[stage.name] = {'signature': signature, 'params': params_json, 'outputs': outputs}
+            write_json(state_path, state)
+        print("{}: done in {:.1f} s".format(stage.name, time.time() - t0))
+
+    by_name = {stage.name: stage for stage in stages}
+    done, failed = set(), {}
+    running = {}
+    with ThreadPoolExecutor(max_workers=max(jobs, 1)) as pool:
+        while True:
+            for name, stage_deps in deps.items():
+                if name in done or name in failed or name in running.values():
+                    continue
+                if stage_deps & set(failed):
+                    failed[name] = None
+                    print("{}: skipped, because {} failed".format(name, ', '.join(sorted(stage_deps & set(failed)))))
+                elif stage_deps <= done:
+                    running[pool.submit(run_stage, by_name[name])] = name
+            if not running:
+                break
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in finished:
+                name = running.pop(future)
+                try:
+                    future.result()
+                    done.add(name)
+                except Exception as e:
+                    failed[name] = e
+                    print("{}: failed: {!r}".format(name, e))
+    errors = [e for e in failed.values() if e is not None]
+    if errors:
+        raise errors[0]
+
+def clip_new(zip_path, shapefile, outdir, manifest, workers=1, batch=50):
+    # clip only the tifs in the zip file that are new or changed since they were last clipped.
+    # manifest keeps the checksum (CRC) of each clipped tif in the zip, plus the shapefile's fingerprint
+    shape_files = sorted(str(p) for p in Path(shapefile).parent.glob(Path(shapefile).stem + '.*'))
+    shape_fp = hashlib.sha256(''.join(file_hash(p) for p in shape_files).encode()).hexdigest()
+    with zipfile.ZipFile(zip_path) as z:
+        members = {Path(info.filename).stem: '{}-{}-{}'.format(info.CRC, info.file_size, shape_fp)
+                   for info in z.infolist() if info.filename.lower().endswith('.tif')}
+    clipped = read_json(manifest)
+    Path(outdir).mkdir(parents=True, exist_ok=True)
+    # dates that are no longer in the zip file
+    for name in set(clipped) - set(members):
+        remove_path(os.path.join(outdir, name + '_CLIP.tif'))
+        del clipped[name]
+    todo = sorted(name for name, fp in members.items()
+                  if clipped.get(name) != fp or not os.path.isfile(os.path.join(outdir, name + '_CLIP.tif')))
+    print("clip: {} new or changed dates, {} up to date".format(len(todo), len(members) - len(todo)))
+    for i in range(0, len(todo), batch):
+        names = todo[i:i + batch]
+        tif_clip(zip_path, shapefile, workers, names=set(names), outpath=outdir)
+        clipped.update({name: members[name] for name in names})
+        write_json(manifest, clipped)
+    write_json(manifest, clipped)
+
+def tif_xyz(directory, outfile):
+    from tif2xyz import tif2xyz
+    tif2xyz(directory, outfile)
+
+def compare(metadata, poly_ESI, tif_ESI, xyz, num_nearest, outfile):
+    from ESI_output_comparison import batch_comparison
+    batch_comparison(metadata, poly_ESI, tif_ESI, xyz, num_nearest, outfile)
+
+def shapefile_box(shapefile, pad=0.05):
+    with fiona.open(shapefile) as f:
+        xmin, ymin, xmax, ymax = f.bounds
+    return xmin - pad, xmax + pad, ymin - pad, ymax + pad
+
+def esi_stages(metadata, shapefile, workdir, startDate, endDate, esi_Type='ESI_4', precision=0.00001,
+               num_nearest=8, pad=0.05, workers=4, cache=None, request_func=None):
+    # the steps of ESI_flowchart.pdf, with their input and output files
+    workdir = os.path.join(os.path.abspath(workdir), '')
+    metadata, shapefile = os.path.abspath(metadata), os.path.abspath(shapefile)
+    zip_path = workdir + 'ESI_tif.zip'
+    clipped = workdir + 'clipped_files/'
+    poly, tif_pts = workdir + 'poly_ESI_df.csv', workdir + 'ESI_tif2select_pt.csv'
+    xyz, comparison = workdir + 'master_ESI_CLIP_xyz.csv', workdir + 'comparison_output.csv'
+    xmin, xmax, ymin, ymax = shapefile_box(shapefile, pad)
+    return [
+        Stage('download', get_ESI_tif, [], [zip_path],
+              dict(xmin=xmin, xmax=xmax, ymin=ymin, ymax=ymax, esi_Type=esi_Type,
+                   startDate=startDate, endDate=endDate, outfile=zip_path),
+              dict(cache=cache, workers=workers, request_func=request_func)),
+        Stage('poly', get_ESI_select_pt, [metadata], [poly],
+              dict(metadata=metadata, precision=precision, esi_Type=esi_Type, startDate=startDate,
+                   endDate=endDate, update=True, outfile=poly, mode='point'),
+              dict(cache=cache, workers=workers, request_func=request_func), update_params=('startDate', 'endDate')),
+        Stage('clip', clip_new, [zip_path, shapefile], [clipped],
+              dict(zip_path=zip_path, shapefile=shapefile, outdir=clipped, manifest=workdir + 'clipped_files.json'),
+              dict(workers=workers), update_params=('zip_path', 'shapefile', 'outdir', 'manifest')),
+        Stage('tif_pts', tif2select_pts, [clipped, metadata], [tif_pts],
+              dict(directory=clipped, metadata=metadata, outfile=tif_pts), dict(workers=workers)),
+        Stage('xyz', tif_xyz, [clipped], [xyz], dict(directory=clipped, outfile=xyz)),
+        Stage('compare', compare, [metadata, poly, tif_pts, xyz], [comparison],
+              dict(metadata=metadata, poly_ESI=poly, tif_ESI=tif_pts, xyz=xyz, num_nearest=num_nearest,
+                   outfile=comparison)),
+    ]
+
+def esi_pipeline(metadata, shapefile, workdir, startDate, endDate, esi_Type='ESI_4', precision=0.00001,
+                 num_nearest=8, pad=0.05, workers=4, jobs=2, content=False, force=(), cache=None,
+                 request_func=None):
+    Path(workdir).mkdir(parents=True, exist_ok=True)
+    stages = esi_stages(metadata, shapefile, workdir, startDate, endDate, esi_Type, precision,
+                        num_nearest, pad, workers, cache, request_func)
+    unknown = set(force) - {stage.name for stage in stages}
+    assert not unknown, "Unknown step(s): {}".format(', '.join(sorted(unknown)))
+    run_pipeline(stages, os.path.join(workdir, 'pipeline_state.json'), jobs, content, set(force))
+
+def invalid_date(s):
+    try:
+        return datetime.strptime(s, '%m/%d/%Y')
+    except ValueError:
+        raise argparse.ArgumentTypeError('Invalid date. Date format should be: mm/dd/yyyy')
+
+
+# if name in main so that we can run the script by itself (main)
+# or, it can be used embedded (import esi_pipeline) within another script
+if __name__ in '__main__':
+    # This allows the --help to show the docstring
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    # First 2 arguments are mandatory
+    parser.add_argument('metadata', metavar='metadata.csv', help="Enter the pathway and filename for your metadata file. i.e. './SCAN_metadata.csv'  File must contain columns: longitude, latitude, stationTriplet")
+    parser.add_argument('shapefile', metavar='shapefile', help="Enter the pathway and filename for your shapefile. i.e. './AL_state.GeoJSON'")
+    # optional
+    parser.add_argument('-d', '--workdir', help="Directory for all of the outputs. Default = ./ESI_run/", type=str, default='./ESI_run/', required=False)
+    parser.add_argument('-t', '--esi_Type', help="ESI data type either: ESI_4 or ESI_12. Default = ESI_4", type=str, default='ESI_4', required=False)
+    parser.add_argument('-s', '--start', help="Start date in form of: mm/dd/yyyy. Default = one month previous to today's date", type=invalid_date, default=(date.today() - relativedelta(months=1)).strftime('%m/%d/%Y'), required=False)
+    parser.add_argument('-e', '--end', help="End date in form of: mm/dd/yyyy. Default = today's date", type=invalid_date, default=datetime.now().strftime('%m/%d/%Y'), required=False)
+    parser.add_argument('-p', '--precision', help="Area around the point location to make the polygon (get_ESI_select_pt.py). Default = 0.00001", type=float, default=0.00001, required=False)
+    parser.add_argument('-n', '--num_nearest', help="Number of nearest pixels to compare to. Default = 8", type=int, default=8, required=False)
+    parser.add_argument('--pad', help="Degrees added around the shapefile's bounds for the download. Default = 0.05", type=float, default=0.05, required=False)
+    parser.add_argument('-w', '--workers', help="Requests / processes used within a step. Default = 4", type=int, default=4, required=False)
+    parser.add_argument('-j', '--jobs', help="Number of steps run at the same time. Default = 2", type=int, default=2, required=False)
+    parser.add_argument('--hash', help="Compare files by their sha256 instead of their size and modified time", action='store_true')
+    parser.add_argument('-f', '--force', help="Re-run these steps even if they are up to date: download, poly, clip, tif_pts, xyz, compare", nargs='+', default=[], required=False)
+    parser.add_argument('--cache_dir', help="Directory for the local cache of ClimateSERV responses. Default = ~/.cache/climateserv_esi", type=str, default=None, required=False)
+    parser.add_argument('--refresh', help="Ask ClimateSERV again instead of using the cached responses, and replace them in the cache", action='store_true')
+    # --trace, --profile, --memory (see esi_instrument.py)
+    esi_instrument.add_arguments(parser)
+    # array for all arguments passed to the script
+    args = parser.parse_args()
+
+    # now you can access the arguments input by the user and apply to our function
+    with esi_instrument.run('esi_pipeline', args.trace, args.profile, args.memory):
+        esi_pipeline(args.metadata, args.shapefile, args.workdir, args.start, args.end, args.esi_Type, args.precision,
+                     args.num_nearest, args.pad, args.workers, args.jobs, args.hash, args.force,
+                     cache=ResponseCache(args.cache_dir, refresh=args.refresh))
@@ -0,0 +1,187 @@
+"""
+Description: Local SQLite store for extracted ESI values, indexed by (station, date) and by pixel,
+ so a station or date range can be looked up without reading every csv file.
+
+File Name: esi_store.py
+
+Usage example: python esi_store.py ./ESI.sqlite --load poly_ESI_df.csv --source poly
+Usage example: python esi_store.py ./ESI.sqlite --load ESI_tif2select_pt.csv --source tif
+Usage example: python esi_store.py ./ESI.sqlite --load master_ESI_CLIP_xyz.csv --source xyz
+Usage example: python esi_store.py ./ESI.sqlite --station 2057:AL:SCAN --start 2021-01-01 --end 2021-03-30
+
+help: python esi_store.py --help
+
+NOTES:
+    - Station values (poly_ESI_df.csv, ESI_tif2select_pt.csv, poly_zonal_ESI_df.csv) go in the
+      'points' table with a source name (poly, tif, zonal, ...). Its primary key (source, station, date)
+      is the index used for lookups. Pixel values (master_ESI_CLIP_xyz.csv) go in the 'pixels' table,
+      indexed by (x, y, date).
+    - get_ESI_select_pt.py, tif2select_pts.py, zonal_stats.py and tif2xyz.py write straight to
+      the store when their -o/--outfile ends in .sqlite or .db. ESI_output_comparison.py can read
+      its inputs from the store.
+    - Writing the same (source, station, date) again replaces the old value.
+    - Only the avg column of poly_zonal_ESI_df.csv is stored (not min and max).
+    - The database uses write-ahead logging (WAL) and each write is a single transaction, so several
+      jobs can write to the same store at the same time (they wait for each other) while others read.
+    - sqlite3 comes with python, nothing to install.
+    - see GitHub for climateSERV_env.yml and other files
+        https://github.com/carol-rowe/ClimateSERV_ESI_data
+
+"""
+
+import argparse
+import sqlite3
+import pandas as pd
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS points (
+    source TEXT NOT NULL,
+    station TEXT NOT NULL,
+    date TEXT NOT NULL,
+    value REAL,
+    PRIMARY KEY (source, station, date)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS points_date ON points (source, date);
+CREATE TABLE IF NOT EXISTS pixels (
+    x REAL NOT NULL,
+    y REAL NOT NULL,
+    date TEXT NOT NULL,
+    value REAL,
+    PRIMARY KEY (x, y, date)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS pixels_date ON pixels (date);
+"""
+
+# columns of each csv file, by source name: (date column, value column)
+COLUMNS = {'poly': ('date', 'avg'), 'zonal': ('date', 'avg'), 'tif': ('Date', 'ESI')}
+
+def is_store(path):
+    return str(path).endswith(('.sqlite', '.db'))
+
+def connect(store):
+    # wait up to a minute for other writers instead of failing right away
+    conn = sqlite3.connect(store, timeout=60)
+    conn.execute('PRAGMA journal_mode=WAL')
+    conn.execute('PRAGMA synchronous=NORMAL')
+    conn.executescript(SCHEMA)
+    return conn
+
+def iso_dates(dates):
+    # dates are stored as yyyy-mm-dd text, which sorts the same as the dates
+    return pd.to_datetime(dates).dt.strftime('%Y-%m-%d')
+
+def write_points(store, df, source, date_col=None, value_col=None, station_col='station'):
+    # add (or replace) station values in the store, all in one transaction
+    default_date, default_value = COLUMNS.get(source, ('date', 'avg'))
+    date_col = date_col or default_date
+    value_col = value_col or default_value
+    rows = zip([source] * df.shape[0], df[station_col].astype(str), iso_dates(df[date_col]),
+               df[value_col].astype(float).where(df[value_col].notna(), None))
+    conn = connect(store)
+    try:
+        with conn:
+            conn.executemany('INSERT OR REPLACE INTO points VALUES (?, ?, ?, ?)', rows)
+    finally:
+        conn.close()
+
+def write_pixels(store, df, value_col='z'):
+    # add (or replace) pixel values (x, y, z, Date) in the store, all in one transaction
+    rows = zip(df['x'].astype(float), df['y'].astype(float), iso_dates(df['Date']),
+               df[value_col].astype(float).where(df[value_col].notna(), None))
+    conn = connect(store)
+    try:
+        with conn:
+            conn.executemany('INSERT OR REPLACE INTO pixels VALUES (?, ?, ?, ?)', rows)
+    finally:
+        conn.close()
+
+def date_filter(start, end):
+    sql, params = '', []
+    if start is not None:
+        sql += ' AND date >= ?'
+        params.append(pd.Timestamp(start).strftime('%Y-%m-%d'))
+    if end is not None:
+        sql += ' AND date <= ?'
+        params.append(pd.Timestamp(end).strftime('%Y-%m-%d'))
+    return sql, params
+
+def query_points(store, source=None, station=None, start=None, end=None):
+    # station values as a dataframe (source, station, date, value), using the (source, station, date) index
+    sql, params = 'SELECT source, station, date, value FROM points WHERE 1=1', []
+    if source is not None:
+        sql += ' AND source = ?'
+        params.append(source)
+    if station is not None:
+        stations = [station] if isinstance(station, str) else list(station)
+        sql += ' AND station IN ({})'.format(', '.join('?' * len(stations)))
+        params += stations
+    date_sql, date_params = date_filter(start, end)
+    conn = connect(store)
+    try:
+        df = pd.read_sql_query(sql + date_sql + ' ORDER BY source, station, date', conn,
+                               params=params + date_params)
+    finally:
+        conn.close()
+    df['date'] = pd.to_datetime(df['date'])
+    return df
+
+def query_pixels(store, xmin=None, xmax=None, ymin=None, ymax=None, start=None, end=None):
+    # pixel values as a dataframe (x, y, z, Date) inside a box and date range
+    sql, params = 'SELECT x, y, value AS z, date AS Date FROM pixels WHERE 1=1', []
+    for col, op, val in (('x', '>=', xmin), ('x', '<=', xmax), ('y', '>=', ymin), ('y', '<=', ymax)):
+        if val is not None:
+            sql += ' AND {} {} ?'.format(col, op)
+            params.append(float(val))
+    date_sql, date_params = date_filter(start, end)
+    conn = connect(store)
+    try:
+        df = pd.read_sql_query(sql + date_sql, conn, params=params + date_params)
+    finally:
+        conn.close()
+    df['Date'] = pd.to_datetime(df['Date'])
+    return df
+
+def write_table(store, df, source):
+    # a dataframe with the same columns as the source's output file: xyz rows go in the pixels table
+    if source == 'xyz':
+        write_pixels(store, df)
+    else:
+        write_points(store, df, source)
+
+def read_table(store, source, start=None, end=None):
+    # the source's rows with the same columns as its output file, i.e. (date, avg, station) for poly
+    if source == 'xyz':
+        return query_pixels(store, start=start, end=end)
+    date_col, value_col = COLUMNS.get(source, ('date', 'avg'))
+    df = query_points(store, source, start=start, end=end)
+    return df.rename(columns={'date': date_col, 'value': value_col})[[date_col, value_col, 'station']]
+
+def load_file(store, filepath, source):
+    # load an existing output file (csv or parquet) into the store
+    df = pd.read_parquet(filepath) if filepath.endswith('.parquet') else pd.read_csv(filepath)
+    write_table(store, df, source)
+    print("Loaded {} rows from {} into {}.".format(df.shape[0], filepath, store))
+
+
+# if name in main so that we can run the script by itself (main)
+# or, it can be used embedded (import esi_store) within another script
+if __name__ in '__main__':
+    # This allows the --help to show the docstring
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    # First argument is mandatory
+    parser.add_argument('store', metavar='store.sqlite', help="Enter the pathway and filename of the store. i.e. './ESI.sqlite'")
+    # load a file into the store
+    parser.add_argument('-l', '--load', help="csv or parquet file to load into the store", type=str, default=None, required=False)
+    parser.add_argument('--source', help="What the file is: poly (get_ESI_select_pt.py), tif (tif2select_pts.py), zonal (zonal_stats.py) or xyz (tif2xyz.py). Default = poly", type=str, default='poly', required=False)
+    # or look up station values
+    parser.add_argument('--station', help="Station to look up", type=str, default=None, required=False)
+    parser.add_argument('-s', '--start', help="First date to look up, yyyy-mm-dd", type=str, default=None, required=False)
+    parser.add_argument('-e', '--end', help="Last date to look up, yyyy-mm-dd", type=str, default=None, required=False)
+    # array for all arguments passed to the script
+    args = parser.parse_args()
+
+    # now you can access the arguments input by the user and apply to our function
+    if args.load:
+        load_file(args.store, args.load, args.source)
+    else:
+        print(query_points(args.store, None, args.station, args.start, args.end).to_string(index=False))
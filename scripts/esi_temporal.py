@@ -0,0 +1,307 @@
+"""
+Description: Rolling multi-week means, a day-of-year climatology and standardized anomalies of every pixel,
+ from the clipped .tif files (or an ESI cube), computed block by block so the whole archive is never in memory.
+
+File Name: esi_temporal.py
+
+Usage example: python esi_temporal.py /path/to/clipped_files/
+Usage example: python esi_temporal.py /path/to/clipped_files/ --weeks 8 --workers 4
+Usage example: python esi_temporal.py ./ESI_cube.nc --products climatology anomaly --doy_window 7
+
+help: python esi_temporal.py --help
+
+Output (in temporal_files/ next to the input, or --outdir), all on the same grid as the input (ESI_tif_clip.py output):
+    rolling: <date>_ROLL<weeks>.tif: mean of the dates in the --weeks weeks ending on that date
+    climatology: climatology_mean.tif and climatology_std.tif, 366 bands (band 1 = Jan 1, band 60 = Feb 29,
+        band 61 = Mar 1, ..., band 366 = Dec 31; the band descriptions are mm-dd): mean and standard deviation
+        of all dates (all years) within --doy_window days of that day of the year
+    anomaly: <date>_ANOM.tif: (value - climatology mean) / climatology std for the date's day of year
+
+NOTES:
+    - The grid is cut into square blocks of pixels. For each block, the whole time series of its pixels is
+      read (only that window of each tif, or only those chunks of the cube) and every product is computed
+      from it, so memory use depends on the block size and the number of dates, not on the grid size.
+      The block size comes from --memory_mb (per process) unless --block is given.
+    - Use --workers to compute several blocks at the same time (in separate processes). Only a few blocks
+      per worker are in flight at a time, and only this process writes the output files.
+    - The blocks are written into one tiled file per product that stays open for the whole run
+      (ROLL<weeks>_stack.tif and ANOM_stack.tif, one band per date). At the end those are split into the
+      per-date tifs, one date at a time, and removed.
+    - Days of the year are matched by month and day (counted as in a leap year), so Mar 1 is day 61 in
+      every year (day 60, Feb 29, is only a date in leap years).
+    - The rolling window is by date, not by number of files, so missing weeks are not filled in.
+      A rolling mean needs at least --min_periods values (default: all --weeks of them), otherwise it is nodata.
+    - Each year gives one value per day of year with the default --doy_window of 3 days (weekly ESI).
+      A climatology with fewer than --min_years values is nodata, and so are the anomalies that use it.
+    - nodata pixels (-9999) are left out of every mean and standard deviation.
+    - Use --trace ./trace.jsonl (and --profile, --memory) to record how long each block takes
+      (see esi_instrument.py).
+    - see GitHub for climateSERV_env.yml and other files
+        https://github.com/carol-rowe/ClimateSERV_ESI_data
+
+"""
+
+import argparse
+import math
+import os
+from collections import deque
+from contextlib import ExitStack
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+import numpy as np
+import pandas as pd
+import rasterio as rs
+from rasterio.crs import CRS
+from rasterio.windows import Window
+from esi_files import output_dir, file_date
+from tif2select_pts import tif_files
+import esi_instrument
+
+PRODUCTS = ['rolling', 'climatology', 'anomaly']
+DAYS = 366
+
+# the input (files or cube), dates and settings, set in each worker process by set_job()
+_job = {}
+
+def set_job(job):
+    _job.update(job)
+
+def source_grid(source):
+    # dates, tif paths (None for a cube) and the grid (crs, transform, width, height, nodata) of the input
+    if str(source).endswith('.nc'):
+        from netCDF4 import Dataset
+        from esi_cube import cube_grid, cube_dates
+        with Dataset(source, 'r') as nc:
+            transform, width, height = cube_grid(nc)
+            crs = CRS.from_wkt(nc.crs_wkt) if nc.crs_wkt else None
+            return cube_dates(nc), None, (crs, transform, width, height, float(nc.variables['ESI']._FillValue))
+    paths = tif_files(source)
+    assert paths, "No tif files in {}".format(source)
+    grid = None
+    for filepath in paths:
+        with rs.open(filepath) as img:
+            if grid is None:
+                grid = (img.crs, img.transform, img.width, img.height,
+                        img.nodata if img.nodata is not None else -9999.0)
+            elif (img.width, img.height) != grid[2:4] or not img.transform.almost_equals(grid[1]):
+                raise ValueError("{} is on a different grid than {}.".format(filepath, paths[0]))
+    dates = pd.DatetimeIndex([pd.Timestamp(file_date(p)) for p in paths])
+    return dates, paths, grid
+
+def block_size(ndates, memory_mb):
+    # side of a square block whose time series (and the products made from it) fit in memory_mb:
+    # about 64 bytes per pixel per date plus 6 arrays of 366 days, in float64
+    per_pixel = 64 * ndates + 6 * 8 * DAYS
+    side = int(math.sqrt(memory_mb * 2 ** 20 / per_pixel))
+    # a multiple of 16 so the blocks line up with the tiles of the output files
+    return max(16, side // 16 * 16)
+
+def blocks(width, height, block):
+    for row in range(0, height, block):
+        for col in range(0, width, block):
+            yield Window(col, row, min(block, width - col), min(block, height - row))
+
+def read_block(window):
+    # (dates, rows, cols) array of one block, nodata as NaN
+    if _job['paths'] is None:
+        from netCDF4 import Dataset
+        with Dataset(_job['source'], 'r') as nc:
+            esi = nc.variables['ESI']
+            esi.set_auto_mask(False)
+            # only the chunks holding this block are read
+            data = esi[:, window.row_off:window.row_off + window.height,
+                       window.col_off:window.col_off + window.width].astype('f8')
+        # dates can be added to a cube in any order
+        data = data[_job['order']]
+    else:
+        data = np.empty((len(_job['paths']), window.height, window.width))
+        for i, filepath in enumerate(_job['paths']):
+            with rs.open(filepath) as img:
+                data[i] = img.read(1, window=window)
+    data[data == _job['nodata']] = np.nan
+    return data
+
+def rolling_mean(data, days, weeks, min_periods):
+    # mean of the dates in the window (day - 7 * weeks, day] for every date, from running sums
+    valid = ~np.isnan(data)
+    sums = np.concatenate([np.zeros((1,) + data.shape[1:]), np.cumsum(np.where(valid, data, 0), axis=0)])
+    counts = np.concatenate([np.zeros((1,) + data.shape[1:]), np.cumsum(valid, axis=0)])
+    first = np.searchsorted(days, days - 7 * weeks, side='right')
+    n = counts[1:] - counts[first]
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mean = (sums[1:] - sums[first]) / n
+    return np.where(n >= min_periods, mean, np.nan)
+
+def calendar_doy(dates):
+    # day of year by month and day, counted as in a leap year (Feb 29 = 60, Mar 1 = 61, Dec 31 = 366),
+    # so a calendar day has the same number in every year
+    return np.asarray(pd.to_datetime(pd.DataFrame({'year': 2000, 'month': dates.month, 'day': dates.day})).dt.dayofyear)
+
+def doy_weights(doys, doy_window):
+    # (366, dates): 1 where the date is within doy_window days of that day of year (around new year too)
+    gap = np.abs(np.arange(1, DAYS + 1)[:, None] - doys[None, :])
+    return (np.minimum(gap, DAYS - gap) <= doy_window).astype('f8')
+
+def climatology(data, weights, min_years):
+    # mean and standard deviation (366, rows, cols) of the dates around each day of year
+    flat = data.reshape(data.shape[0], -1)
+    valid = ~np.isnan(flat)
+    values = np.where(valid, flat, 0)
+    n = weights @ valid
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mean = (weights @ values) / n
+        var = ((weights @ values ** 2) - n * mean ** 2) / (n - 1)
+    enough = n >= max(min_years, 2)
+    mean = np.where(enough, mean, np.nan)
+    std = np.where(enough, np.sqrt(np.maximum(var, 0)), np.nan)
+    shape = (DAYS,) + data.shape[1:]
+    return mean.reshape(shape), std.reshape(shape)
+
+def block_products(window):
+    # every product for one block: {product: array}, NaN where there is no value
+    with esi_instrument.span('block', row=window.row_off, col=window.col_off) as s:
+        data = read_block(window)
+        s.set(pixels=data.size)
+        esi_instrument.count('pixels', data.size)
+        out = {}
+        if 'rolling' in _job['products']:
+            out['rolling'] = rolling_mean(data, _job['days'], _job['weeks'], _job['min_periods'])
+        if 'climatology' in _job['products'] or 'anomaly' in _job['products']:
+            mean, std = climatology(data, _job['weights'], _job['min_years'])
+            if 'climatology' in _job['products']:
+                out['climatology_mean'] = mean
+                out['climatology_std'] = std
+            if 'anomaly' in _job['products']:
+                doy = _job['doys'] - 1
+                with np.errstate(invalid='ignore', divide='ignore'):
+                    anom = (data - mean[doy]) / std[doy]
+                out['anomaly'] = np.where(np.isfinite(anom), anom, np.nan)
+    return window, out
+
+def iter_blocks(windows, workers=1):
+    # yields (window, products) for each block; with workers, only a few blocks per worker are in flight
+    if workers <= 1:
+        for window in windows:
+            yield block_products(window)
+        return
+    with ProcessPoolExecutor(max_workers=workers, initializer=set_job, initargs=(_job,)) as pool:
+        pending = deque()
+        for window in windows:
+            pending.append(pool.submit(block_products, window))
+            if len(pending) >= workers * 2:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+def output_files(outdir, dates, products, weeks):
+    # {product: (file the blocks are written into, per-date files it is split into at the end or None)}
+    # the climatology files are written directly (366 bands each)
+    files = {}
+    names = [d.strftime('%Y%m%d') for d in dates]
+    if 'rolling' in products:
+        files['rolling'] = (outdir + 'ROLL{}_stack.tif'.format(weeks),
+                            [outdir + '{}_ROLL{}.tif'.format(name, weeks) for name in names])
+    if 'climatology' in products:
+        files['climatology_mean'] = (outdir + 'climatology_mean.tif', None)
+        files['climatology_std'] = (outdir + 'climatology_std.tif', None)
+    if 'anomaly' in products:
+        files['anomaly'] = (outdir + 'ANOM_stack.tif', [outdir + '{}_ANOM.tif'.format(name) for name in names])
+    return files
+
+def open_outputs(stack, files, grid, block, ndates):
+    # one tiled file per product (one band per date, or per day of year), open for the whole run,
+    # so each block is a single write per product
+    crs, transform, width, height, nodata = grid
+    profile = {'driver': 'GTiff', 'dtype': 'float32', 'crs': crs, 'transform': transform, 'width': width,
+               'height': height, 'nodata': nodata, 'tiled': True, 'blockxsize': block, 'blockysize': block,
+               'interleave': 'band', 'BIGTIFF': 'IF_SAFER'}
+    datasets = {}
+    for product, (filepath, _) in files.items():
+        count = DAYS if product.startswith('climatology') else ndates
+        dst = stack.enter_context(rs.open(filepath, 'w', count=count, **profile))
+        if product.startswith('climatology'):
+            for band, day in enumerate(pd.date_range('2000-01-01', periods=DAYS), start=1):
+                dst.set_band_description(band, day.strftime('%m-%d'))
+        datasets[product] = dst
+    return datasets
+
+def write_block(datasets, window, out, nodata):
+    for product, values in out.items():
+        values = np.where(np.isnan(values), nodata, values).astype('float32')
+        datasets[product].write(values, window=window)
+
+def split_stack(stack_path, paths):
+    # one tif per date (same grid and profile as the ESI_tif_clip.py output), one band in memory at a time
+    with rs.open(stack_path) as src:
+        profile = {'driver': 'GTiff', 'dtype': 'float32', 'crs': src.crs, 'transform': src.transform,
+                   'width': src.width, 'height': src.height, 'count': 1, 'nodata': src.nodata}
+        for band, filepath in enumerate(paths, start=1):
+            with rs.open(filepath, 'w', **profile) as dst:
+                dst.write(src.read(band), 1)
+    os.remove(stack_path)
+
+def esi_temporal(source, outdir=None, products=PRODUCTS, weeks=4, min_periods=None, doy_window=3, min_years=3,
+                 workers=1, block=None, memory_mb=256):
+    # source: clipped tif files (directory or zip file) or an ESI cube (.nc)
+    with esi_instrument.stage('grid'):
+        dates, paths, grid = source_grid(source)
+    order = np.argsort(dates, kind='stable')
+    assert paths is None or np.all(order == np.arange(len(dates))), "tif files are not in date order"
+    assert len(set(dates)) == len(dates), "{} has the same date more than once".format(source)
+    dates = dates[order]
+    if outdir is None:
+        outdir = output_dir(source) + 'temporal_files/'
+    Path(outdir).mkdir(parents=True, exist_ok=True)
+    block = block or block_size(len(dates), memory_mb)
+    assert block % 16 == 0, "block must be a multiple of 16"
+    days = np.asarray((dates - pd.Timestamp('1970-01-01')).days)
+    doys = calendar_doy(dates)
+    set_job({'source': source, 'paths': paths, 'order': order, 'nodata': grid[4], 'products': products, 'days': days, 'doys': doys,
+             'weeks': weeks, 'min_periods': min_periods or weeks, 'min_years': min_years,
+             'weights': doy_weights(doys, doy_window)})
+
+    files = output_files(outdir, dates, products, weeks)
+    crs, transform, width, height, nodata = grid
+    windows = list(blocks(width, height, block))
+    print("{} dates, {} x {} pixels in {} blocks of {} x {}".format(len(dates), width, height, len(windows), block, block))
+    with esi_instrument.stage('blocks', blocks=len(windows), workers=workers), ExitStack() as stack:
+        datasets = open_outputs(stack, files, grid, block, len(dates))
+        for i, (window, out) in enumerate(iter_blocks(windows, workers)):
+            write_block(datasets, window, out, nodata)
+            print("block {} out of {}".format(i + 1, len(windows)))
+    # the per-date products are split into one tif per date, in one pass over the dates
+    with esi_instrument.stage('split'):
+        for stack_path, paths in files.values():
+            if paths is not None:
+                split_stack(stack_path, paths)
+    outputs = {product: paths or [stack_path] for product, (stack_path, paths) in files.items()}
+    print("Wrote {} files to {}".format(sum(len(paths) for paths in outputs.values()), outdir))
+    return outputs
+
+
+# if name in main so that we can run the script by itself (main)
+# or, it can be used embedded (import esi_temporal) within another script
+if __name__ in '__main__':
+    # This allows the --help to show the docstring
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    # First argument is mandatory
+    parser.add_argument('directory', metavar='directory_to_files', help="Enter the pathway to your clipped tif files, zip file or ESI cube. For example: '/home/name/my_tif_files/clipped_files/'")
+    # optional
+    parser.add_argument('-o', '--outdir', help="Directory for the output tifs. Default = temporal_files/ next to the input", type=str, default=None, required=False)
+    parser.add_argument('--products', help="What to make: rolling, climatology, anomaly. Default = all", nargs='+', choices=PRODUCTS, default=PRODUCTS, required=False)
+    parser.add_argument('--weeks', help="Length of the rolling window in weeks. Default = 4", type=int, default=4, required=False)
+    parser.add_argument('--min_periods', help="Fewest values for a rolling mean. Default = --weeks", type=int, default=None, required=False)
+    parser.add_argument('--doy_window', help="Days on each side of a day of year used for its climatology. Default = 3", type=int, default=3, required=False)
+    parser.add_argument('--min_years', help="Fewest values for a climatology (and its anomalies). Default = 3", type=int, default=3, required=False)
+    parser.add_argument('-w', '--workers', help="Number of processes computing blocks at the same time. Default = 1", type=int, default=1, required=False)
+    parser.add_argument('-b', '--block', help="Block size in pixels (a multiple of 16). Default = from --memory_mb", type=int, default=None, required=False)
+    parser.add_argument('-m', '--memory_mb', help="About how much memory (MB) each process may use for one block. Default = 256", type=float, default=256, required=False)
+    # --trace, --profile, --memory (see esi_instrument.py)
+    esi_instrument.add_arguments(parser)
+    # array for all arguments passed to the script
+    args = parser.parse_args()
+
+    # now you can access the arguments input by the user and apply to our function
+    with esi_instrument.run('esi_temporal', args.trace, args.profile, args.memory):
+        esi_temporal(args.directory, args.outdir, args.products, args.weeks, args.min_periods, args.doy_window,
+                     args.min_years, args.workers, args.block, args.memory_mb)
@@ -11,18 +11,38 @@ Required input (1):
     metadata file. A csv file containing latitude, longitude, and stationTriplet columns.
         latitude and longitude should be in decimal degrees
 
-Optional inputs (4):
+Optional inputs (15):
     precision: degrees around point location to create a polygon. i.e. 0.0001
         any value >= 0.001 will return the same ESI value
     ESI_type: global ESI 4 week (ESI_4) or global ESI 12 week (ESI_12)
     start: start date. Defualt is toady's date minus one month
     end: end date. Defualt is today's date.
+    workers: number of station requests to run at the same time. Default is 4
+    rate: maximum number of new requests started per second. Default is 1.0
+    retries: number of times a failed request is retried. Default is 3
+    cache_dir: directory for the local cache of responses. Default is ~/.cache/climateserv_esi
+    refresh: ask ClimateSERV again instead of using the cached responses (the cache is updated)
+    update: read the existing output file and only request the dates missing for each station.
+        The new rows are added to the end of the output file.
+    outfile: output file. Default is ./poly_ESI_df.csv
+        A .sqlite (or .db) file adds the values to a local store instead (see esi_store.py).
+    mode: point, bulk or auto. Default is auto
+        point: one polygon 'Average' request per station
+        bulk: one 'Download' request (see get_ESI_tif.py) for the bounding box of all stations.
+            The value of the pixel under each station is then read from the tif files (nodata is left empty).
+            With --update, one 'Download' per range in the union of the missing date ranges of the stations.
+        auto: bulk when there are 10 or more stations within 50 square degrees, otherwise point
+    trace, profile, memory: timing / profiling output (per request and per step), see esi_instrument.py
 
-Output: poly_ESI_df.csv
+Output: poly_ESI_df.csv (or the --outfile name)
 
 See help: python get_ESI_select_pt.py --help
 
 NOTES:
+    - Requests are sent through climateserv_client.py (in this same folder). A station whose
+      request still fails after all of the retries is reported and left out of the output.
+    - Responses are cached on local disk (--cache_dir), so running the same request again is
+      read from disk. Use --refresh to ask ClimateSERV again.
     - see GitHub for raster_env.yml and other files
         https://github.com/carol-rowe/ClimateSERV_ESI_data
 
@@ -30,82 +50,194 @@ NOTES:
 
 import pandas as pd
 import argparse
+import os
+import tempfile
 from datetime import datetime, date
 from dateutil.relativedelta import *
-import time
-import climateserv.api
+from climateserv_client import ResponseCache, request_params, request_many
+from get_ESI_tif import get_ESI_tif
+from tif2select_pts import sample_tif
+from esi_files import tif_paths, file_date
+from esi_store import is_store, read_table, write_table
+import esi_instrument
 
 __author__ = "Carol A. Rowe"
 
-def get_ESI_select_pt(metadata, precision, esi_Type, startDate, endDate):
-    # the dates get a timestamp attached to the end. Remove the time.
-    startDate = startDate.strftime('%m/%d/%Y')
-    endDate = endDate.strftime('%m/%d/%Y')
-    # This file contains the station name, and corresponding longitudes and latitudes (and other data that we don't need)
-    meta = pd.read_csv(metadata)
-    # loop through all rows in the meta file:
-    df_master = pd.DataFrame()
+def station_polygon(x, y, precision):
+    # create the polygon around the station location
+    return [[x - precision, y + precision], [x + precision, y + precision],
+            [x + precision, y - precision], [x - precision, y - precision],
+            [x - precision, y + precision]]
+
+def esi_to_df(esi, stn):
+    # convert the nested dictionaries of esi into a dataframe
+    # this results in a single column which contains another dictionary
+    esi2 = pd.DataFrame.from_dict(esi)
+    # convert the esi output to a dataframe - this will take two steps
+    # this first step results in all data as a single 'data' column which contains a dictionary
+    df = pd.concat([esi2.drop(['data'], axis=1), esi2['data'].apply(pd.Series)], axis=1)
+    # there is one remaining dictionary to split
+    df = pd.concat([df.drop(['value'], axis=1), df['value'].apply(pd.Series)], axis=1)
+    # add station name to the dataframe
+    df['station'] = stn
+    return df
+
+def missing_ranges(dates, startDate, endDate, step_days=7):
+    # dates: the dates we already have for one station
+    # returns the (start, end) date ranges within startDate - endDate that still need to be requested
+    # ESI is weekly, so a range is only missing if it is at least one week (step_days) long
+    step = pd.Timedelta(days=step_days)
+    one_day = pd.Timedelta(days=1)
+    startDate, endDate = pd.Timestamp(startDate), pd.Timestamp(endDate)
+    dates = sorted(d for d in pd.to_datetime(pd.Series(dates)).dropna() if startDate <= d <= endDate)
+    if not dates:
+        return [(startDate, endDate)]
+    ranges = []
+    if dates[0] - startDate >= step:
+        ranges.append((startDate, dates[0] - one_day))
+    for before, after in zip(dates[:-1], dates[1:]):
+        if after - before > step:
+            ranges.append((before + one_day, after - one_day))
+    if endDate - dates[-1] >= step:
+        ranges.append((dates[-1] + one_day, endDate))
+    return ranges
+
+def merge_ranges(ranges):
+    # the union of (start, end) date ranges: overlapping or touching ranges become one range
+    one_day = pd.Timedelta(days=1)
+    merged = []
+    for start, end in sorted((pd.Timestamp(s), pd.Timestamp(e)) for s, e in ranges):
+        if merged and start <= merged[-1][1] + one_day:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+        else:
+            merged.append((start, end))
+    return merged
+
+def choose_mode(meta, bulk_min_stations=10, bulk_max_area=50.0):
+    # one Download of the stations' bounding box is cheaper than one request per station
+    # when there are many stations close together. Area is in square decimal degrees.
+    xs, ys = meta['longitude'], meta['latitude']
+    area = (xs.max() - xs.min()) * (ys.max() - ys.min())
+    if meta.shape[0] >= bulk_min_stations and area <= bulk_max_area:
+        return 'bulk'
+    return 'point'
+
+def bulk_ESI(meta, esi_Type, ranges, cache=None, pad=0.05, request_func=None):
+    # download the tif files for the bounding box of all the stations (one request per date range)
+    # and get the value of the pixel under each station from every tif file
+    # ranges: list of (start, end) date ranges, i.e. the merged missing ranges of all stations
+    xs = meta['longitude'].to_numpy(dtype=float)
+    ys = meta['latitude'].to_numpy(dtype=float)
+    stations = meta['stationTriplet'].to_numpy()
+    frames = []
+    with tempfile.TemporaryDirectory() as tmp:
+        for i, (startDate, endDate) in enumerate(ranges):
+            zip_path = os.path.join(tmp, 'ESI_tif_{}.zip'.format(i))
+            # pad the box by about one ESI pixel so that stations on the edge are inside the tifs
+            get_ESI_tif(xs.min() - pad, xs.max() + pad, ys.min() - pad, ys.max() + pad,
+                        esi_Type, startDate, endDate, cache=cache, outfile=zip_path,
+                        request_func=request_func)
+            # the tif files are named by date. Read them straight from the zip file.
+            # nodata (-9999) pixels are left empty (NaN), like stations outside of the tifs
+            for filepath in tif_paths(zip_path):
+                frames.append(pd.DataFrame({'date': pd.to_datetime(file_date(filepath)),
+                                            'avg': sample_tif(filepath, xs, ys, mask_nodata=True),
+                                            'station': stations}))
+    if not frames:
+        return None
+    return pd.concat(frames, ignore_index=True)
+
+def point_ESI(meta, precision, esi_Type, windows, workers=4, rate=1.0, retries=3,
+              request_func=None, cache=None):
+    # windows: {station: [(start, end), ...]} the date ranges to request for each station
+    # one request per station (or per date range of a station):
+    # the average value from the polygon (vs. min or max)
+    # SeasonalEnsemble and SeasonalVariable are not needed for ESI, so they are left as ''
+    # and the output is kept in memory ('memory_object') rather than written to a file
+    requests = {}
     for i in range(0, meta.shape[0]):
-        print("index {} out of {}.".format(i, meta.shape[0]))
-        # assing longitude, latitude, and station to variables
         x = meta.loc[i, 'longitude']
         y = meta.loc[i, 'latitude']
         stn = meta.loc[i, 'stationTriplet']
-        # factor for which we will add/sub. to form the polygon
-        precision = precision
-        # create the polygon around the station location
-        GeometryCoords = [[x - precision, y + precision], [x + precision, y + precision],
-                          [x + precision, y - precision], [x - precision, y - precision],
-                          [x - precision, y + precision]]
-        # assign values to the other needed variables to run the climateserve.api
-        # Getting the ESI 4-week data
-        DatasetType = str(esi_Type)
-        assert (DatasetType == 'ESI_4') or (DatasetType == 'ESI_12'), "esi_Type must be 'ESI_4' or 'ESI_12'"
-        # get the average value from the polyogn (vs. min or max)
-        OperationType = 'Average'
-        # enter dates of interest
-        EarliestDate = str(startDate)
-        #print(EarliestDate)
-        LatestDate = str(endDate)
-        #print(LatestDate)
-        # next two variables are not needed for the ESI-4, but still need to assign the '' value to them
-        SeasonalEnsemble = ''
-        SeasonalVariable = ''
-        # we are going to save this to a variable (esi in this case), so use the 'memory_object' as the outfile
-        Outfile = 'memory_object'
-        # Call the climateserv api
-        esi = climateserv.api.request_data(DatasetType, OperationType,
-                                           EarliestDate, LatestDate,
-                                           GeometryCoords,
-                                           SeasonalEnsemble,
-                                           SeasonalVariable,
-                                           Outfile)
-        # convert the nested dictionaries of esi into a dataframe
-        # this results in a single column which contains another dictionary
-        esi2 = pd.DataFrame.from_dict(esi)
-        # convert the esi output to a dataframe - this will take two steps
-        # this first step results in all data as a single 'data' column which contains a dictionary
-        df = pd.concat([esi2.drop(['data'], axis=1), esi2['data'].apply(pd.Series)], axis=1)
-        # Check to see if there is any data in the dataframe
-        assert df.shape[0] > 0, "There is no data. Please try using other dates."
-        # there is one remaining dictionary to split
-        df = pd.concat([df.drop(['value'], axis=1), df['value'].apply(pd.Series)], axis=1)
-        # add station name to the dataframe
-        df['station'] = stn
-        # append each station's data to the master dataframe
-        df_master = df_master.append(df)
-        # print statement so you can see the size of the master dataframe as it grows...
-        print(df_master.shape)
-        # not sure if this sleep time is needed. First time I ran the full script, it crashed. I added this and it worked.
-        # in past web-scraping experience, adding the time-out can keep a user from getting blocked-out from too many reuquest. However, I don't think that should be an issue for this website
-        time.sleep(4)
-
+        for start, end in windows[stn]:
+            # the dates get a timestamp attached to the end. Remove the time.
+            requests[(stn, start.strftime('%m/%d/%Y'))] = request_params(
+                esi_Type, 'Average', start.strftime('%m/%d/%Y'), end.strftime('%m/%d/%Y'),
+                station_polygon(x, y, precision))
+    # Call the climateserv api for all stations, a few at a time, without going over the rate limit
+    print("Sending {} requests for {} stations.".format(len(requests), len(set(key[0] for key in requests))))
+    results, failures = request_many(requests, request_func=request_func, workers=workers,
+                                     rate=rate, retries=retries, cache=cache)
+    if cache is not None:
+        cache.report()
+    if failures:
+        print("No data for {} request(s): {}".format(len(failures), ', '.join(map(str, failures))))
+    if not results:
+        return None
+    # keep the stations in the same order as the metadata file
+    df_master = pd.concat([esi_to_df(results[key], key[0]) for key in requests if key in results])
+    print(df_master.shape)
     # I prefer the date as per the ISO standard: yyyy-mm-dd
     df_master['date'] = df_master['date'].apply(pd.to_datetime)
     # don't need the workid or the epochtime. Just select desired columns
-    df_master1 = df_master[['date', 'avg', 'station']]
-    # Finally, make sure you save the final dataframe!!!!
-    df_master1.to_csv('./poly_ESI_df.csv', index=False)
+    return df_master[['date', 'avg', 'station']]
+
+def get_ESI_select_pt(metadata, precision, esi_Type, startDate, endDate,
+                      workers=4, rate=1.0, retries=3, request_func=None, cache=None,
+                      update=False, outfile='./poly_ESI_df.csv', mode='auto'):
+    # Getting the ESI 4-week or 12-week data
+    DatasetType = str(esi_Type)
+    assert (DatasetType == 'ESI_4') or (DatasetType == 'ESI_12'), "esi_Type must be 'ESI_4' or 'ESI_12'"
+    assert mode in ('auto', 'point', 'bulk'), "mode must be 'auto', 'point' or 'bulk'"
+    # This file contains the station name, and corresponding longitudes and latitudes (and other data that we don't need)
+    meta = pd.read_csv(metadata)
+    # in update mode, only ask for the dates that are not already in the output file
+    existing = None
+    windows = {stn: [(startDate, endDate)] for stn in meta['stationTriplet']}
+    if update and is_store(outfile):
+        existing = read_table(outfile, 'poly')
+    elif update and os.path.isfile(outfile):
+        existing = pd.read_csv(outfile, parse_dates=['date'])
+    if existing is not None:
+        existing_dates = existing.groupby('station')['date'].apply(list).to_dict()
+        windows = {stn: missing_ranges(existing_dates.get(stn, []), startDate, endDate)
+                   for stn in meta['stationTriplet']}
+        if not any(windows.values()):
+            print("{} is already up to date.".format(outfile))
+            return
+
+    if mode == 'auto':
+        mode = choose_mode(meta)
+    if mode == 'bulk':
+        # one download for each range in the union of the missing ranges of all stations
+        ranges = merge_ranges([r for station_ranges in windows.values() for r in station_ranges])
+        print("Downloading tifs for {} stations ({} date ranges).".format(meta.shape[0], len(ranges)))
+        with esi_instrument.stage('bulk', stations=meta.shape[0], ranges=len(ranges)):
+            df_master1 = bulk_ESI(meta, DatasetType, ranges, cache=cache, request_func=request_func)
+    else:
+        with esi_instrument.stage('point', stations=meta.shape[0], workers=workers):
+            df_master1 = point_ESI(meta, precision, DatasetType, windows, workers, rate, retries,
+                                   request_func, cache)
+    # Check to see if there is any data at all (in update mode, there may just be no new dates yet)
+    assert df_master1 is not None or existing is not None, "There is no data. Please try using other dates."
+    if df_master1 is None:
+        print("No new dates for {}.".format(outfile))
+        return
+
+    with esi_instrument.stage('write', rows=df_master1.shape[0]):
+        if is_store(outfile):
+            # the store replaces any (station, date) it already has, so every row can be written
+            write_table(outfile, df_master1, 'poly')
+            print("Saved {} rows to {}.".format(df_master1.shape[0], outfile))
+        elif existing is None:
+            # Finally, make sure you save the final dataframe!!!!
+            df_master1.to_csv(outfile, index=False)
+        else:
+            # only add the (station, date) rows that are new. The rows already in the file are left alone.
+            old = pd.MultiIndex.from_frame(existing[['station', 'date']])
+            new_rows = df_master1[~pd.MultiIndex.from_frame(df_master1[['station', 'date']]).isin(old)]
+            new_rows.to_csv(outfile, mode='a', header=False, index=False)
+            print("Added {} new rows to {}.".format(new_rows.shape[0], outfile))
 
 def invalid_date(s):
     try:
@@ -125,8 +257,22 @@ if __name__ in '__main__':
     parser.add_argument('-t','--esi_Type', help="ESI data type either: ESI_4 or ESI_12. Default = ESI_4", type=str, default='ESI_4', required=False)
     parser.add_argument('-s','--start', help="Start date for query in form of: mm/dd/yyyy. Default = one month previous to today's date", type=invalid_date, default=(date.today() - relativedelta(months=1)).strftime('%m/%d/%Y'), required=False)
     parser.add_argument('-e', '--end', help="End date for query in form of: mm/dd/yyyy. Default = today's date", type=invalid_date, default=datetime.now().strftime('%m/%d/%Y'), required=False)
-    
+    parser.add_argument('-w', '--workers', help="Number of requests to run at the same time. Default = 4", type=int, default=4, required=False)
+    parser.add_argument('-r', '--rate', help="Maximum number of new requests per second. Default = 1.0", type=float, default=1.0, required=False)
+    parser.add_argument('--retries', help="Number of times to retry a failed request. Default = 3", type=int, default=3, required=False)
+    parser.add_argument('--cache_dir', help="Directory for the local cache of ClimateSERV responses. Default = ~/.cache/climateserv_esi", type=str, default=None, required=False)
+    parser.add_argument('--refresh', help="Ask ClimateSERV again instead of using the cached responses, and replace them in the cache", action='store_true')
+    parser.add_argument('-u', '--update', help="Only request the dates (per station) that are missing from the output file, and add them to it", action='store_true')
+    parser.add_argument('-o', '--outfile', help="Output file, or a .sqlite store (see esi_store.py). Default = ./poly_ESI_df.csv", type=str, default='./poly_ESI_df.csv', required=False)
+    parser.add_argument('-m', '--mode', help="point: one request per station. bulk: download the tifs for all stations at once and read the values locally. auto: pick one from the number of stations and how spread out they are. Default = auto", type=str, choices=['auto', 'point', 'bulk'], default='auto', required=False)
+    # --trace, --profile, --memory (see esi_instrument.py)
+    esi_instrument.add_arguments(parser)
+
     # Array for all arguments passed to script:
     args = parser.parse_args()
     # Now, we can access the arguments input by the user (or use defaults), and apply to our function
-    get_ESI_select_pt(args.metadata, args.precision, args.esi_Type, args.start, args.end)
+    with esi_instrument.run('get_ESI_select_pt', args.trace, args.profile, args.memory):
+        get_ESI_select_pt(args.metadata, args.precision, args.esi_Type, args.start, args.end,
+                          args.workers, args.rate, args.retries,
+                          cache=ResponseCache(args.cache_dir, refresh=args.refresh),
+                          update=args.update, outfile=args.outfile, mode=args.mode)
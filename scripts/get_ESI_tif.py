@@ -12,49 +12,135 @@ Required inputs (4):
     If interested, from the web I found a site with the min/max lat and longs for each U.S. state:
         https://anthonylouisdagostino.com/bounding-boxes-for-all-us-states/
 
-Optional inputs (3):
+Optional inputs (13):
     ESI_type: global ESI 4 week (ESI_4) or global ESI 12 week (ESI_12)
     start: start date. Defualt is toady's date minus one month
     end: end date. Defualt is today's date.
+    cache_dir: directory for the local cache of downloads. Default is ~/.cache/climateserv_esi
+    refresh: download from ClimateSERV again instead of using the cached zip file (the cache is updated)
+    outfile: output zip file. Default is ESI_tif.zip
+    max_deg: largest tile, in degrees of longitude or latitude, sent in one request. Default is 5.0
+    max_days: longest date range sent in one request. Default is 365
+    workers: number of tiles downloaded at the same time. Default is 4
+    rate: maximum number of new requests started per second. Default is 1.0
+    trace, profile, memory: timing / profiling output, see esi_instrument.py
 
-Output: ESI_tif.zip
+Output: ESI_tif.zip (or the --outfile name)
 
 See help: python get_ESI_tif.py --help
 
 NOTES:
+    - The download goes through climateserv_client.py (in this same folder), which retries
+      failed downloads and keeps a copy of each zip file in the local cache.
+    - Big boxes and long date ranges are split into tiles (see max_deg and max_days) that are
+      downloaded at the same time. The tiles of each date are then mosaicked back into one tif,
+      so the output zip file looks the same as for a single request.
+    - Use --trace ./trace.jsonl (and --profile, --memory) to record the time of each request and step
+      (see esi_instrument.py).
     - see GitHub for climateSERV_env.yml and other files
         https://github.com/carol-rowe/ClimateSERV_ESI_data
 
 """
 
 import argparse
-from datetime import datetime, date
+import math
+import os
+import tempfile
+import zipfile
+from datetime import datetime, date, timedelta
 from dateutil.relativedelta import *
-import climateserv.api
+import rasterio as rs
+from rasterio.merge import merge
+from climateserv_client import ResponseCache, request_params, request_with_retry, request_many
+from esi_files import tif_paths, file_date
+import esi_instrument
 
 __author__ = "Carol A. Rowe"
 
-def get_ESI_tif(xmin,xmax, ymin, ymax, esi_Type, startDate, endDate):
-    # the dates get a timestamp attached to the end. Remove the time.
-    startDate = startDate.strftime('%m/%d/%Y')
-    endDate = endDate.strftime('%m/%d/%Y')
+def box_coords(xmin, xmax, ymin, ymax):
     # make a box around the area of interest uisng the lat min and max, and the long min and max
-    GeometryCoords = [[xmin, ymax], [xmax, ymax], [xmax, ymin], [xmin, ymin], [xmin, ymax]]
-    # assign values to the other needed variables to run the climateserve.api
+    return [[xmin, ymax], [xmax, ymax], [xmax, ymin], [xmin, ymin], [xmin, ymax]]
+
+def plan_tiles(xmin, xmax, ymin, ymax, startDate, endDate, max_deg=5.0, max_days=365):
+    # split the bounding box into sub-boxes no bigger than max_deg x max_deg degrees
+    # and the dates into windows no longer than max_days. Returns a list of (box, start, end).
+    nx = max(1, int(math.ceil((xmax - xmin) / max_deg)))
+    ny = max(1, int(math.ceil((ymax - ymin) / max_deg)))
+    xs = [xmin + (xmax - xmin) * i / nx for i in range(nx + 1)]
+    ys = [ymin + (ymax - ymin) * j / ny for j in range(ny + 1)]
+    windows = []
+    start = startDate
+    while start <= endDate:
+        end = min(start + timedelta(days=max_days - 1), endDate)
+        windows.append((start, end))
+        start = end + timedelta(days=1)
+    return [((xs[i], xs[i + 1], ys[j], ys[j + 1]), start, end)
+            for start, end in windows for j in range(ny) for i in range(nx)]
+
+def mosaic_tiles(tile_zips, outfile):
+    # put the tiles of each date back together into one tif per date, saved in the outfile zip
+    by_date = {}
+    for tile_zip in tile_zips:
+        for filepath in tif_paths(tile_zip):
+            by_date.setdefault(file_date(filepath), []).append(filepath)
+    with tempfile.TemporaryDirectory() as tmp, zipfile.ZipFile(outfile, 'w', zipfile.ZIP_DEFLATED) as z:
+        for day in sorted(by_date):
+            sources = [rs.open(filepath) for filepath in by_date[day]]
+            try:
+                mosaic, transform = merge(sources)
+                meta = sources[0].meta.copy()
+            finally:
+                for src in sources:
+                    src.close()
+            meta.update({'driver': 'GTiff', 'transform': transform,
+                         'height': mosaic.shape[1], 'width': mosaic.shape[2]})
+            name = os.path.basename(by_date[day][0])
+            with rs.open(os.path.join(tmp, name), 'w', **meta) as dst:
+                dst.write(mosaic)
+            z.write(os.path.join(tmp, name), name)
+            os.remove(os.path.join(tmp, name))
+    print("Mosaicked {} dates into {}.".format(len(by_date), outfile))
+
+def get_ESI_tif(xmin,xmax, ymin, ymax, esi_Type, startDate, endDate, cache=None, outfile='ESI_tif.zip',
+                request_func=None, max_deg=5.0, max_days=365, workers=4, rate=1.0):
     # Assign ESI 4-week or 12-week
     DatasetType = str(esi_Type)
     assert (DatasetType == 'ESI_4') or (DatasetType == 'ESI_12'), "esi_Type must be 'ESI_4' or 'ESI_12'"
-    # get the average value from the polyogn (vs. min or max)
+    # download the tif files (rather than the average, min or max for the box)
     OperationType = 'Download'
     # next two variables are not needed for the ESI-4, but still need to assign the '' value to them
     SeasonalEnsemble = ''
     SeasonalVariable = ''
-    # we are going to save this to a variable (esi in this case), so use the 'memory_object' as the outfile
-    Outfile = 'ESI_tif.zip'
-    # Call the climateserv api
-    climateserv.api.request_data(DatasetType, OperationType,
-                                 startDate, endDate, GeometryCoords,
-                                 SeasonalEnsemble, SeasonalVariable, Outfile)
+    # ClimateSERV does not take boxes that are too big, and long date ranges are one long download,
+    # so big requests are split into tiles that are downloaded at the same time
+    tiles = plan_tiles(xmin, xmax, ymin, ymax, startDate, endDate, max_deg, max_days)
+    if len(tiles) == 1:
+        # the dates get a timestamp attached to the end. Remove the time.
+        # the tif files are downloaded into a zip file
+        # Call the climateserv api (or copy the zip file from the cache if we already downloaded it)
+        with esi_instrument.stage('download', tiles=1):
+            request_with_retry(request_params(DatasetType, OperationType,
+                                              startDate.strftime('%m/%d/%Y'), endDate.strftime('%m/%d/%Y'),
+                                              box_coords(xmin, xmax, ymin, ymax),
+                                              SeasonalEnsemble, SeasonalVariable, outfile),
+                               request_func, cache=cache)
+    else:
+        print("Splitting the request into {} tiles.".format(len(tiles)))
+        with tempfile.TemporaryDirectory() as tmp:
+            requests = {}
+            for i, (box, start, end) in enumerate(tiles):
+                requests[i] = request_params(DatasetType, OperationType,
+                                             start.strftime('%m/%d/%Y'), end.strftime('%m/%d/%Y'),
+                                             box_coords(*box), SeasonalEnsemble, SeasonalVariable,
+                                             os.path.join(tmp, 'tile_{}.zip'.format(i)))
+            with esi_instrument.stage('download', tiles=len(tiles), workers=workers):
+                results, failures = request_many(requests, request_func=request_func, workers=workers,
+                                                 rate=rate, cache=cache)
+            assert not failures, "{} of {} tiles could not be downloaded.".format(len(failures), len(tiles))
+            with esi_instrument.stage('mosaic', tiles=len(tiles)):
+                mosaic_tiles([requests[i][7] for i in sorted(requests)], outfile)
+    if cache is not None:
+        cache.report()
 
 def invalid_date(s):
     try:
@@ -76,8 +162,20 @@ if __name__ in '__main__':
     parser.add_argument('-t','--esi_Type', help="ESI data type either: ESI_4 or ESI_12. Default = ESI_4", type=str, default='ESI_4', required=False)
     parser.add_argument('-s','--start', help="Start date for query in form of: mm/dd/yyyy. Default = one month previous to today's date", type=invalid_date, default=(date.today() - relativedelta(months=1)).strftime('%m/%d/%Y'), required=False)
     parser.add_argument('-e', '--end', help="End date for query in form of: mm/dd/yyyy. Default = today's date", type=invalid_date, default=datetime.now().strftime('%m/%d/%Y'), required=False)
+    parser.add_argument('--cache_dir', help="Directory for the local cache of ClimateSERV downloads. Default = ~/.cache/climateserv_esi", type=str, default=None, required=False)
+    parser.add_argument('--refresh', help="Ask ClimateSERV again instead of using the cached downloads, and replace them in the cache", action='store_true')
+    parser.add_argument('-o', '--outfile', help="Output zip file. Default = ESI_tif.zip", type=str, default='ESI_tif.zip', required=False)
+    parser.add_argument('--max_deg', help="Largest tile (degrees of longitude or latitude) sent in one request. Default = 5.0", type=float, default=5.0, required=False)
+    parser.add_argument('--max_days', help="Longest date range sent in one request. Default = 365", type=int, default=365, required=False)
+    parser.add_argument('-w', '--workers', help="Number of tiles to download at the same time. Default = 4", type=int, default=4, required=False)
+    parser.add_argument('-r', '--rate', help="Maximum number of new requests per second. Default = 1.0", type=float, default=1.0, required=False)
+    # --trace, --profile, --memory (see esi_instrument.py)
+    esi_instrument.add_arguments(parser)
 
     # Array for all arguments passed to script:
     args = parser.parse_args()
     # Now, we can access the arguments input by the user (or use defaults), and apply to our function
-    get_ESI_tif(args.xmin, args.xmax,args.ymin,args.ymax, args.esi_Type, args.start, args.end)
+    with esi_instrument.run('get_ESI_tif', args.trace, args.profile, args.memory):
+        get_ESI_tif(args.xmin, args.xmax,args.ymin,args.ymax, args.esi_Type, args.start, args.end,
+                    cache=ResponseCache(args.cache_dir, refresh=args.refresh), outfile=args.outfile,
+                    max_deg=args.max_deg, max_days=args.max_days, workers=args.workers, rate=args.rate)
@@ -7,6 +7,9 @@ Description: Uses output .tif files from ESI_tif_clip.py to extract ESI values f
 
 Usage example: python tif2select_pt.py /path/to/tif/files/ ./metadata.csv
 Usage example: python tif2select_pt.py /path/to/tif/files/ /path/to/metadata.csv
+Usage example: python tif2select_pt.py /path/to/tif/files/ ./metadata.csv --workers 8 -o ./ESI_tif2select_pt.parquet
+Usage example: python tif2select_pt.py /path/to/ESI_tif.zip ./metadata.csv
+Usage example: python tif2select_pt.py ./ESI_cube.nc ./metadata.csv
 
 help: python tif2select_pt.py --help
 
@@ -19,6 +22,18 @@ NOTES:
     - You can easily modify this script to read in .tif files without the "_CLIP"
     - Since the .tif file contains a date in its name, I made the final dataframe
       to contain a datetime column as headed "Date".
+    - Each tif file is opened and read only once (just the window covering the stations).
+      The row/col for all stations is computed in one step from the tif's transform.
+      Stations outside of the tif extent get an empty (NaN) ESI value.
+    - Use --workers to spread the tif files across several processes. Rows are written to the
+      output file as each tif file is done, in date order, so memory use stays flat.
+      Parquet output (-o something.parquet) requires pyarrow.
+    - Use -o something.sqlite to add the values to a local store instead (see esi_store.py).
+    - The input can also be a zip file of tifs, i.e. ESI_tif.zip from get_ESI_tif.py. All of the
+      tifs are read straight from the zip file (no need to unzip or clip them first).
+    - The input can also be a NetCDF cube from ESI_tif_clip.py --cube (see esi_cube.py).
+    - Use --trace ./trace.jsonl (and --profile, --memory) to record how long each file takes
+      (see esi_instrument.py).
     - metadata.csv input file must contain columns labeled:
         longitude
         latitude
@@ -29,54 +44,127 @@ NOTES:
 """
 
 import pandas as pd
-import glob
-from pathlib import Path
+import numpy as np
+from esi_files import is_zip, tif_paths, output_dir, file_date
 import rasterio as rs
+from rasterio.transform import rowcol
+from rasterio.windows import Window
 import argparse
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+import esi_instrument
 
 __author__ = "Carol A. Rowe"
 
-def tif2select_pts(directory, metadata):
-    tif_Counter = len(glob.glob1(directory, '*.tif'))
-    meta = pd.read_csv(metadata)
-    num_pts = meta.shape[0]
-    upper_range = tif_Counter * num_pts
-
-    # function to go through each tif file and extract the date, esi, and station name
-    def tif_to_esi(meta, directory, upper_range, num_pts):
-        table = pd.DataFrame(index=range(0,upper_range),columns=['Date', 'ESI', 'station'])
-        # i counts from 0 through number of lines in the output dataframe (the upper_range)
-        i=0
-        # in case other files in folder, want those where last 4 chars are .tif
-        for filepath in glob.glob(directory + "*_CLIP.tif"):
-            base = Path(filepath).stem
-            date = base.split('_')[0]
-            # ind counts 1 - 18 since there are 18 stations
-            ind = 0
-            dataset = rs.open(filepath)
-            for ind in range(0,num_pts):
-                x = meta.loc[ind,'longitude']
-                y = meta.loc[ind, 'latitude']
-                stn = meta.loc[ind, 'stationTriplet']
-                row, col = dataset.index(x,y)
-                data_array = dataset.read(1)
-                # copy data to Date col
-                table['Date'].loc[i] = date
-                # get esi
-                table['ESI'].loc[i] = data_array[int(row), int(col)]
-                # add the station name
-                table['station'].loc[i] = stn
-                ind += 1
-                i += 1
-                # using print statements so you can see what is happeining with the two variables
-                #print(ind)
-                #print(i)
-        table['Date'] = table['Date'].apply(pd.to_datetime)
-        return table
-
-    my_df = tif_to_esi(meta, directory, upper_range, num_pts)
-    my_df.to_csv(directory + 'ESI_tif2select_pt.csv', index='False')
+def station_rowcol(transform, xs, ys, height, width):
+    # all of the clipped tifs share one grid, so the row/col of every station can be
+    # computed in a single vectorized step from the transform (same math as dataset.index)
+    rows, cols = rowcol(transform, xs, ys)
+    rows = np.asarray(rows, dtype=int)
+    cols = np.asarray(cols, dtype=int)
+    # stations that fall outside of the raster get no value (NaN) instead of an IndexError
+    inside = (rows >= 0) & (rows < height) & (cols >= 0) & (cols < width)
+    return rows, cols, inside
+
+def sample_tif(filepath, xs, ys, mask_nodata=False):
+    # returns one ESI value per station (same order as xs/ys) from a single tif file
+    # mask_nodata: NaN instead of the tif's nodata value (i.e. -9999)
+    values = np.full(len(xs), np.nan)
+    with esi_instrument.span('read_tif', file=filepath) as s, rs.open(filepath) as dataset:
+        rows, cols, inside = station_rowcol(dataset.transform, xs, ys, dataset.height, dataset.width)
+        if not inside.any():
+            s.set(pixels=0)
+            return values
+        # only read the window that covers the stations, and only read it once
+        row_off, col_off = rows[inside].min(), cols[inside].min()
+        window = Window(col_off, row_off,
+                        cols[inside].max() - col_off + 1,
+                        rows[inside].max() - row_off + 1)
+        data = dataset.read(1, window=window)
+        values[inside] = data[rows[inside] - row_off, cols[inside] - col_off]
+        if mask_nodata and dataset.nodata is not None:
+            values[values == dataset.nodata] = np.nan
+        s.set(pixels=data.size)
+        esi_instrument.count('pixels', data.size)
+    return values
+
+def tif_files(directory):
+    # in case other files in folder, want those ending in _CLIP.tif
+    # sorted so the output is always in date order (file names start with the date)
+    # a zip file (i.e. ESI_tif.zip) is read directly, using all of the tifs inside it
+    if is_zip(directory):
+        return tif_paths(directory)
+    return tif_paths(directory, "*_CLIP.tif")
+
+def file_to_esi(filepath, xs, ys, stations):
+    # the rows (date, esi, station) for one tif file
+    return pd.DataFrame({'Date': pd.to_datetime(np.repeat(file_date(filepath), len(xs))),
+                         'ESI': sample_tif(filepath, xs, ys),
+                         'station': stations})
 
+def iter_esi(meta, filepaths, workers=1):
+    # yields one dataframe per tif file, always in the same (date) order as filepaths
+    xs = meta['longitude'].to_numpy(dtype=float)
+    ys = meta['latitude'].to_numpy(dtype=float)
+    stations = meta['stationTriplet'].to_numpy()
+    func = partial(file_to_esi, xs=xs, ys=ys, stations=stations)
+    if workers <= 1:
+        for filepath in filepaths:
+            yield func(filepath)
+        return
+    # spread the files across a pool of processes. Only a few files per worker are in
+    # flight at a time so that memory stays flat no matter how many files there are.
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        pending = deque()
+        for filepath in filepaths:
+            pending.append(pool.submit(func, filepath))
+            if len(pending) >= workers * 2:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+def write_chunks(chunks, outfile, source='tif'):
+    # write each chunk (dataframe) to the output as soon as it is ready
+    # .parquet output needs pyarrow; .sqlite/.db goes in the store (esi_store.py) under source;
+    # anything else is written as csv
+    if outfile.endswith(('.sqlite', '.db')):
+        from esi_store import write_table
+        for chunk in chunks:
+            write_table(outfile, chunk, source)
+    elif outfile.endswith('.parquet'):
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+        writer = None
+        try:
+            for chunk in chunks:
+                table = pa.Table.from_pandas(chunk, preserve_index=False)
+                if writer is None:
+                    writer = pq.ParquetWriter(outfile, table.schema)
+                writer.write_table(table)
+        finally:
+            if writer is not None:
+                writer.close()
+    else:
+        header = True
+        with open(outfile, 'w', newline='') as f:
+            for chunk in chunks:
+                chunk.to_csv(f, header=header, index=False)
+                header = False
+
+def tif2select_pts(directory, metadata, workers=1, outfile=None):
+    meta = pd.read_csv(metadata)
+    if outfile is None:
+        outfile = output_dir(directory) + 'ESI_tif2select_pt.csv'
+    if directory.endswith('.nc'):
+        # a NetCDF cube from ESI_tif_clip.py --cube: read each station's time series from the cube
+        from esi_cube import read_point_series
+        with esi_instrument.stage('read_cube'):
+            write_chunks([read_point_series(directory, meta)], outfile)
+        return
+    # stream the rows of each tif file to the output instead of building the whole table in memory
+    with esi_instrument.stage('extract', workers=workers):
+        write_chunks(iter_esi(meta, tif_files(directory), workers), outfile)
 
 
 # if name in main so that we can run the script by itself (main)
@@ -85,10 +173,16 @@ if __name__ in '__main__':
     # This allows the --help to show the docstring
     parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
     # Add the input arguments (2), both of which are mandatory
-    parser.add_argument('directory', metavar='directory_to_files', help="Enter the pathway to your tif files. For example: '/home/name/my_tif_files/'")
+    parser.add_argument('directory', metavar='directory_to_files', help="Enter the pathway to your tif files (or zip file). For example: '/home/name/my_tif_files/' or './ESI_tif.zip'")
     parser.add_argument('metadata', metavar='metadata.csv', help="Enter the pathway and filename for your shapefile. i.e. './SCAN_metadata.csv'  File must contain columns: longitude, latitude, stationTriplet")
+    # Next 2 arguments are optional
+    parser.add_argument('-w', '--workers', help="Number of processes used to read the tif files. Default = 1", type=int, default=1, required=False)
+    parser.add_argument('-o', '--outfile', help="Output file. Use a .parquet extension for parquet output, or .sqlite to add to the store (esi_store.py). Default = ESI_tif2select_pt.csv in the tif directory (or next to the zip file)", type=str, default=None, required=False)
+    # --trace, --profile, --memory (see esi_instrument.py)
+    esi_instrument.add_arguments(parser)
     # array for all arguments passed to the script
     args = parser.parse_args()
 
     # now you can access the arguments input by the user and apply to our function
-    tif2select_pts(args.directory, args.metadata)
\ No newline at end of file
+    with esi_instrument.run('tif2select_pts', args.trace, args.profile, args.memory):
+        tif2select_pts(args.directory, args.metadata, args.workers, args.outfile)
@@ -0,0 +1,161 @@
+"""
+Description: Computes the average, min and max ESI value of many polygons (zones) for every date, locally,
+ from the clipped .tif files (or an ESI cube), instead of one ClimateSERV 'Average' request per polygon.
+
+File Name: zonal_stats.py
+
+Usage example: python zonal_stats.py /path/to/clipped_files/ --metadata ./SCAN_AL_metadata.csv
+Usage example: python zonal_stats.py /path/to/clipped_files/ --metadata ./SCAN_AL_metadata.csv --precision 0.05
+Usage example: python zonal_stats.py ./ESI_cube.nc --shapefile ./AL_counties.shp --id_field NAME
+
+help: python zonal_stats.py --help
+
+Zones (one of):
+    metadata: a csv file with longitude, latitude and stationTriplet columns. Each zone is the same
+        polygon get_ESI_select_pt.py sends to ClimateSERV: +/- precision degrees around the station.
+    shapefile: a .shp or .GeoJSON file of polygons, i.e. counties or HUC units. The id_field column
+        is used as the zone name (default: the feature number).
+
+Output: poly_zonal_ESI_df.csv with the same columns as poly_ESI_df.csv (date, avg, station) plus min and max.
+    The station column holds the zone name. Use -o something.sqlite to add the values to a local store
+    instead (see esi_store.py).
+
+NOTES:
+    - The zones are rasterized once per grid into a list of (pixel, zone) pairs, so zones can overlap.
+      Each date's raster is then read once, and the average, min and max of every zone come from
+      numpy bincount/reduceat over those pairs (no loop over the zones).
+    - A pixel is in a zone if the polygon touches it (all_touched), so a polygon smaller than a pixel
+      gets the value of the pixel it is in, like the ClimateSERV 'Average' of a small polygon.
+    - nodata pixels are left out. A zone with no data for a date gets an empty avg/min/max.
+    - The polygons must be in the same coordinate system as the tif files (decimal degrees for ESI).
+    - see GitHub for climateSERV_env.yml and other files
+        https://github.com/carol-rowe/ClimateSERV_ESI_data
+
+"""
+
+import argparse
+import math
+import numpy as np
+import pandas as pd
+import rasterio as rs
+import fiona
+from affine import Affine
+from rasterio.features import geometry_mask, bounds
+from esi_files import output_dir, file_date
+from tif2select_pts import tif_files, write_chunks
+
+def station_zones(metadata, precision):
+    # the same polygons as get_ESI_select_pt.py, named by station
+    from get_ESI_select_pt import station_polygon
+    meta = pd.read_csv(metadata)
+    shapes = [{'type': 'Polygon', 'coordinates': [station_polygon(x, y, precision)]}
+              for x, y in zip(meta['longitude'], meta['latitude'])]
+    return meta['stationTriplet'].tolist(), shapes
+
+def shapefile_zones(shapefile, id_field=None):
+    # read the features once; name each zone by id_field (or by its feature number)
+    with fiona.open(shapefile) as f:
+        features = list(f)
+    names = [feature['properties'][id_field] if id_field else i for i, feature in enumerate(features)]
+    return names, [feature['geometry'] for feature in features]
+
+def zone_pixels(shapes, transform, width, height):
+    # rasterize the zones on the grid: returns the flat pixel index and zone number of every
+    # (pixel, zone) pair, sorted by zone, and where each zone starts in those arrays
+    pix, zon = [], []
+    for z, shape in enumerate(shapes):
+        # only rasterize the part of the grid under the polygon's bounding box
+        minx, miny, maxx, maxy = bounds(shape)
+        col0 = max(int(math.floor((minx - transform.c) / transform.a)), 0)
+        col1 = min(int(math.floor((maxx - transform.c) / transform.a)), width - 1)
+        row0 = max(int(math.floor((maxy - transform.f) / transform.e)), 0)
+        row1 = min(int(math.floor((miny - transform.f) / transform.e)), height - 1)
+        if col1 < col0 or row1 < row0:
+            continue
+        inside = geometry_mask([shape], out_shape=(row1 - row0 + 1, col1 - col0 + 1),
+                               transform=transform * Affine.translation(col0, row0),
+                               all_touched=True, invert=True)
+        rows, cols = np.nonzero(inside)
+        pix.append((rows + row0) * width + cols + col0)
+        zon.append(np.full(len(rows), z))
+    pix = np.concatenate(pix) if pix else np.zeros(0, dtype=int)
+    zon = np.concatenate(zon) if zon else np.zeros(0, dtype=int)
+    starts = np.searchsorted(zon, np.arange(len(shapes)))
+    return pix, zon, starts
+
+def zone_stats(data, nodata, pix, zon, starts, nzones):
+    # average, min and max of every zone for one date's raster
+    v = data.ravel()[pix].astype(float)
+    if nodata is not None:
+        v[v == nodata] = np.nan
+    valid = ~np.isnan(v)
+    count = np.bincount(zon[valid], minlength=nzones)
+    total = np.bincount(zon[valid], weights=v[valid], minlength=nzones)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        avg = np.where(count > 0, total / count, np.nan)
+    mins = np.full(nzones, np.nan)
+    maxs = np.full(nzones, np.nan)
+    # zones with at least one pixel; fmin/fmax skip nodata (NaN)
+    has_pixels = np.flatnonzero(np.bincount(zon, minlength=nzones) > 0)
+    if len(has_pixels):
+        with np.errstate(invalid='ignore'):
+            mins[has_pixels] = np.fmin.reduceat(v, starts[has_pixels])
+            maxs[has_pixels] = np.fmax.reduceat(v, starts[has_pixels])
+    return avg, mins, maxs
+
+def iter_rasters(source):
+    # (date, 2D array, transform, nodata) for each date, from tif files / zip file or a NetCDF cube
+    if str(source).endswith('.nc'):
+        from netCDF4 import Dataset
+        from esi_cube import cube_grid, cube_dates
+        with Dataset(source, 'r') as nc:
+            transform, width, height = cube_grid(nc)
+            esi = nc.variables['ESI']
+            esi.set_auto_mask(False)
+            for i, day in enumerate(cube_dates(nc)):
+                yield day, esi[i, :, :], transform, esi._FillValue
+    else:
+        for filepath in tif_files(source):
+            with rs.open(filepath) as img:
+                yield pd.Timestamp(file_date(filepath)), img.read(1), img.transform, img.nodata
+
+def iter_zonal(source, names, shapes):
+    # yields one dataframe (date, avg, station, min, max) per date
+    grids = {}
+    for day, data, transform, nodata in iter_rasters(source):
+        key = (tuple(transform)[:6], data.shape)
+        if key not in grids:
+            grids[key] = zone_pixels(shapes, transform, data.shape[1], data.shape[0])
+        pix, zon, starts = grids[key]
+        avg, mins, maxs = zone_stats(data, nodata, pix, zon, starts, len(names))
+        yield pd.DataFrame({'date': day, 'avg': avg, 'station': names, 'min': mins, 'max': maxs})
+
+def zonal_stats(source, metadata=None, shapefile=None, id_field=None, precision=0.00001, outfile=None):
+    assert (metadata is None) != (shapefile is None), "Use either metadata or shapefile for the zones"
+    if metadata is not None:
+        names, shapes = station_zones(metadata, precision)
+    else:
+        names, shapes = shapefile_zones(shapefile, id_field)
+    if outfile is None:
+        outfile = output_dir(source) + 'poly_zonal_ESI_df.csv'
+    write_chunks(iter_zonal(source, names, shapes), outfile, 'zonal')
+
+
+# if name in main so that we can run the script by itself (main)
+# or, it can be used embedded (import zonal_stats) within another script
+if __name__ in '__main__':
+    # This allows the --help to show the docstring
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    # First argument is mandatory
+    parser.add_argument('directory', metavar='directory_to_files', help="Enter the pathway to your clipped tif files, zip file or ESI cube. For example: '/home/name/my_tif_files/clipped_files/'")
+    # zones: either the metadata or a shapefile
+    parser.add_argument('-m', '--metadata', help="csv file with longitude, latitude, stationTriplet columns. i.e. './SCAN_metadata.csv'", type=str, default=None, required=False)
+    parser.add_argument('-p', '--precision', help="Degrees around each station for its polygon (same as get_ESI_select_pt.py). Default = 0.00001", type=float, default=0.00001, required=False)
+    parser.add_argument('-s', '--shapefile', help="Shapefile of the zones, i.e. './AL_counties.shp'", type=str, default=None, required=False)
+    parser.add_argument('-i', '--id_field', help="Shapefile column with the zone names. Default = feature number", type=str, default=None, required=False)
+    parser.add_argument('-o', '--outfile', help="Output file (.csv, .parquet or a .sqlite store, see esi_store.py). Default = poly_zonal_ESI_df.csv in the tif directory", type=str, default=None, required=False)
+    # array for all arguments passed to the script
+    args = parser.parse_args()
+
+    # now you can access the arguments input by the user and apply to our function
+    zonal_stats(args.directory, args.metadata, args.shapefile, args.id_field, args.precision, args.outfile)
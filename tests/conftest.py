@@ -0,0 +1,7 @@
+import sys
+from pathlib import Path
+
+# the scripts are run from their folders, not installed: make them importable for the tests
+REPO = Path(__file__).resolve().parent.parent
+for folder in ('scripts', 'Comparison_SCRIPTS', 'Benchmark_SCRIPTS'):
+    sys.path.insert(0, str(REPO / folder))
@@ -0,0 +1,85 @@
+import numpy as np
+import pytest
+from ESI_output_comparison import nearest_brute, nearest_grid, nearest_pixels, pixel_grid
+
+
+def grid_centroids(x0, y0, dx, dy, ncols, nrows, drop=0.0, seed=0):
+    # pixel centroids of a regular grid (like tif2xyz output), optionally with some pixels missing (nodata)
+    rng = np.random.default_rng(seed)
+    xx, yy = np.meshgrid(x0 + (np.arange(ncols) + 0.5) * dx, y0 - (np.arange(nrows) + 0.5) * dy)
+    keep = rng.random(xx.size) >= drop
+    return xx.ravel()[keep], yy.ravel()[keep]
+
+
+def random_stations(px, py, n, seed=1):
+    rng = np.random.default_rng(seed)
+    xmin, xmax, ymin, ymax = px.min(), px.max(), py.min(), py.max()
+    sx = rng.uniform(xmin, xmax, n)
+    sy = rng.uniform(ymin, ymax, n)
+    # stations right on the edges and corners of the grid, and just outside of it
+    edge_x = np.array([xmin, xmax, xmin, xmax, xmin - 0.01, xmax + 0.03, (xmin + xmax) / 2, xmin + 0.001])
+    edge_y = np.array([ymin, ymax, ymax, ymin, (ymin + ymax) / 2, ymax + 0.02, ymin - 0.04, ymax - 0.001])
+    return np.concatenate([sx, edge_x]), np.concatenate([sy, edge_y])
+
+
+def assert_same_nearest(px, py, sx, sy, k):
+    idx, dist = nearest_pixels(px, py, sx, sy, k)
+    idx_b, dist_b = nearest_brute(px, py, sx, sy, min(k, len(px)))
+    np.testing.assert_allclose(dist, dist_b, rtol=1e-12, atol=1e-9)
+    # same pixels (the order can only differ between pixels at the same distance)
+    for i in range(len(sx)):
+        assert set(idx[i]) == set(idx_b[i])
+
+
+@pytest.mark.parametrize('k', [1, 8, 30, 200])
+@pytest.mark.parametrize('lat', [33.0, 62.0])
+def test_grid_search_matches_brute_force(k, lat):
+    px, py = grid_centroids(-90.0, lat, 0.05, 0.05, 70, 50)
+    sx, sy = random_stations(px, py, 60)
+    assert pixel_grid(px, py) is not None
+    assert_same_nearest(px, py, sx, sy, k)
+
+
+@pytest.mark.parametrize('k', [8, 200])
+def test_grid_search_with_missing_pixels(k):
+    # nodata pixels are not in the xyz file, so the grid has holes
+    px, py = grid_centroids(-88.0, 35.0, 0.05, 0.05, 60, 40, drop=0.3, seed=3)
+    sx, sy = random_stations(px, py, 40, seed=4)
+    assert_same_nearest(px, py, sx, sy, k)
+
+
+def test_k_larger_than_the_first_ring():
+    # the first square searched holds 11 x 11 pixels for k = 50, so it has to grow
+    px, py = grid_centroids(-90.0, 36.0, 0.05, 0.05, 40, 40)
+    x0, y0, dx, dy, lookup = pixel_grid(px, py)
+    sx, sy = random_stations(px, py, 10, seed=5)
+    inside = (sx >= px.min()) & (sx <= px.max()) & (sy >= py.min()) & (sy <= py.max())
+    k = 150
+    idx, dist = nearest_grid(lookup, x0, y0, dx, dy, px, py, sx[inside], sy[inside], k)
+    idx_b, dist_b = nearest_brute(px, py, sx[inside], sy[inside], k)
+    np.testing.assert_allclose(dist, dist_b, rtol=1e-12, atol=1e-9)
+
+
+def test_k_larger_than_the_grid():
+    px, py = grid_centroids(-90.0, 36.0, 0.05, 0.05, 4, 3)
+    sx, sy = random_stations(px, py, 5)
+    idx, dist = nearest_pixels(px, py, sx, sy, 50)
+    assert idx.shape == (len(sx), len(px))
+    assert_same_nearest(px, py, sx, sy, 50)
+
+
+def test_near_duplicate_centroids():
+    # the same pixels twice, one a hair (about one ulp) apart: dx would be ~1e-12 and the lookup terabytes
+    px, py = grid_centroids(-90.0, 36.0, 0.05, 0.05, 30, 20)
+    px, py = np.concatenate([px, px + 1e-12]), np.concatenate([py, py])
+    assert pixel_grid(px, py) is None
+    sx, sy = random_stations(px, py, 20, seed=6)
+    assert_same_nearest(px, py, sx, sy, 8)
+
+
+def test_sparse_points_are_not_a_grid():
+    # a few pixels far apart on a fine grid: the lookup would be mostly empty
+    px, py = grid_centroids(-90.0, 36.0, 0.001, 0.001, 2000, 2000, drop=0.9999, seed=7)
+    assert pixel_grid(px, py) is None
+    sx, sy = random_stations(px, py, 10, seed=8)
+    assert_same_nearest(px, py, sx, sy, 3)
@@ -0,0 +1,49 @@
+import json
+import numpy as np
+import pytest
+import rasterio as rs
+from rasterio.mask import mask
+from rasterio.transform import from_origin
+from ESI_tif_clip import tif_clip
+
+# two polygons (one not convex), partly outside of the raster
+SHAPES = [{'type': 'Polygon', 'coordinates': [[[-89.33, 35.71], [-88.02, 35.52], [-88.41, 34.63],
+                                               [-88.97, 35.02], [-89.61, 34.38], [-89.33, 35.71]]]},
+          {'type': 'Polygon', 'coordinates': [[[-87.64, 34.91], [-86.5, 34.9], [-86.52, 34.02],
+                                               [-87.63, 34.05], [-87.64, 34.91]]]}]
+
+
+def write_tif(path, seed):
+    rng = np.random.default_rng(seed)
+    data = rng.normal(0, 1.5, size=(60, 80)).astype('float32')
+    data[:10, :12] = -9999
+    profile = {'driver': 'GTiff', 'height': 60, 'width': 80, 'count': 1, 'dtype': 'float32',
+               'crs': 'EPSG:4326', 'transform': from_origin(-90.0, 36.0, 0.05, 0.05), 'nodata': -9999}
+    with rs.open(path, 'w', **profile) as dst:
+        dst.write(data, 1)
+
+
+@pytest.mark.parametrize('workers', [1, 2])
+def test_clip_matches_rasterio_mask(tmp_path, workers):
+    raw = tmp_path / 'raw'
+    raw.mkdir()
+    for i, day in enumerate(['20210105', '20210112', '20210119']):
+        write_tif(raw / (day + '.tif'), i)
+    shapefile = tmp_path / 'aoi.GeoJSON'
+    shapefile.write_text(json.dumps({'type': 'FeatureCollection', 'features': [
+        {'type': 'Feature', 'properties': {'name': str(i)}, 'geometry': shape} for i, shape in enumerate(SHAPES)]}))
+
+    tif_clip(str(raw) + '/', str(shapefile), workers)
+
+    for day in ['20210105', '20210112', '20210119']:
+        with rs.open(raw / (day + '.tif')) as img:
+            expected, expected_transform = mask(img, SHAPES, crop=True)
+            nodata = img.nodata
+        with rs.open(raw / 'clipped_files' / (day + '_CLIP.tif')) as clipped:
+            assert clipped.transform.almost_equals(expected_transform)
+            assert clipped.nodata == nodata
+            got = clipped.read()
+        assert got.shape == expected.shape
+        np.testing.assert_array_equal(got, expected)
+        # the clip really removed something, and kept something
+        assert (got == nodata).any() and (got != nodata).any()
@@ -0,0 +1,129 @@
+import threading
+import time
+import pytest
+import climateserv_client
+from climateserv_client import (ClimateSERVError, ResponseCache, TokenBucket, request_many,
+                                request_params, request_with_retry)
+
+RESPONSE = {'data': [{'date': '01/05/2021', 'value': {'avg': 0.5}}]}
+
+
+class FakeRequest:
+    # stands in for climateserv.api.request_data: fails `fail` times (or always for the keys in
+    # fail_keys), otherwise returns RESPONSE. Records the time of every call.
+    def __init__(self, fail=0, fail_keys=()):
+        self.fail = fail
+        self.fail_keys = set(fail_keys)
+        self.calls = []
+        self.lock = threading.Lock()
+
+    def __call__(self, *params):
+        with self.lock:
+            self.calls.append((time.monotonic(), params))
+            n = len(self.calls)
+        if params[0] in self.fail_keys or n <= self.fail:
+            raise ConnectionError("fake error")
+        return RESPONSE
+
+
+def params(key='ESI_4'):
+    return request_params(key, 'Average', '01/01/2021', '01/31/2021', [[-86, 32], [-86, 33], [-85, 33]])
+
+
+@pytest.fixture
+def sleeps(monkeypatch):
+    # record the backoff waits instead of sleeping
+    waits = []
+    monkeypatch.setattr(climateserv_client.time, 'sleep', waits.append)
+    return waits
+
+
+def test_retries_then_works(sleeps):
+    fake = FakeRequest(fail=2)
+    assert request_with_retry(params(), fake, retries=3, backoff=0.5) == RESPONSE
+    assert len(fake.calls) == 3
+    assert len(sleeps) == 2
+
+
+def test_raises_after_all_retries(sleeps):
+    fake = FakeRequest(fail=100)
+    with pytest.raises(ConnectionError):
+        request_with_retry(params(), fake, retries=3, backoff=0.5)
+    # the first try plus 3 retries, with a wait before each retry
+    assert len(fake.calls) == 4
+    assert len(sleeps) == 3
+
+
+def test_empty_response_is_retried(sleeps):
+    # request_data prints an error and returns nothing when the server fails
+    with pytest.raises(ClimateSERVError):
+        request_with_retry(params(), lambda *p: {}, retries=2, backoff=0.5)
+    assert len(sleeps) == 2
+
+
+def test_backoff_is_jittered_within_bounds(sleeps):
+    backoff, retries = 0.5, 6
+    for _ in range(20):
+        with pytest.raises(ConnectionError):
+            request_with_retry(params(), FakeRequest(fail=100), retries=retries, backoff=backoff)
+    assert len(sleeps) == 20 * retries
+    for i, wait in enumerate(sleeps):
+        # full jitter: between 0 and backoff * 2^attempt
+        assert 0 <= wait <= backoff * 2 ** (i % retries)
+    # jittered, not a fixed schedule
+    assert len(set(sleeps)) > retries
+
+
+def test_token_bucket_caps_rate_with_many_workers():
+    rate, n = 20.0, 21
+    fake = FakeRequest()
+    requests = {i: params() for i in range(n)}
+    results, failures = request_many(requests, fake, workers=8, rate=rate, burst=1)
+    assert len(results) == n and not failures
+    starts = sorted(t for t, _ in fake.calls)
+    # after the first (burst) request, no more than `rate` requests start per second
+    assert starts[-1] - starts[0] >= (n - 1) / rate * 0.95
+    for i in range(n - int(rate)):
+        assert starts[i + int(rate)] - starts[i] >= 0.95
+
+
+def test_token_bucket_no_limit():
+    bucket = TokenBucket(0)
+    t0 = time.monotonic()
+    for _ in range(1000):
+        bucket.acquire()
+    assert time.monotonic() - t0 < 0.5
+
+
+def test_request_many_reports_failures(sleeps):
+    fake = FakeRequest(fail_keys={'bad'})
+    requests = {'a': params('ESI_4'), 'b': params('ESI_12'), 'c': params('bad')}
+    results, failures = request_many(requests, fake, workers=3, rate=0, retries=2, backoff=0.1)
+    assert results == {'a': RESPONSE, 'b': RESPONSE}
+    assert list(failures) == ['c']
+    assert isinstance(failures['c'], ConnectionError)
+    # the failing request was tried 1 + 2 times, the others once
+    assert len(fake.calls) == 2 + 3
+
+
+def cache_size(directory):
+    return sum(f.stat().st_size for f in directory.iterdir())
+
+
+def test_cache_stays_under_max_size(tmp_path):
+    cache = ResponseCache(str(tmp_path), max_size_mb=2000 / 2 ** 20)
+    response = {'data': [{'date': '01/05/2021', 'value': {'avg': 0.5}}] * 5}
+    for i in range(20):
+        cache.put(params('ESI_{}'.format(i)), response)
+        assert cache_size(tmp_path) <= 2000
+    # the newest responses are kept
+    assert cache.get(params('ESI_19')) == (True, response)
+    assert cache.get(params('ESI_0')) == (False, None)
+
+
+def test_cache_refresh_asks_again_and_replaces(tmp_path, sleeps):
+    request_with_retry(params(), lambda *p: {'data': ['old']}, cache=ResponseCache(str(tmp_path)))
+    refresh = ResponseCache(str(tmp_path), refresh=True)
+    assert request_with_retry(params(), lambda *p: {'data': ['new']}, cache=refresh) == {'data': ['new']}
+    assert refresh.misses == 1 and refresh.hits == 0
+    assert ResponseCache(str(tmp_path)).get(params()) == (True, {'data': ['new']})
@@ -0,0 +1,52 @@
+import json
+import os
+import zipfile
+from collections import Counter
+import pytest
+import esi_instrument
+from synthetic_esi import make_archive
+from tif2select_pts import tif2select_pts
+
+
+@pytest.fixture
+def trace(tmp_path, monkeypatch):
+    # a fresh trace file, and the module left as it was afterwards
+    monkeypatch.setenv('ESI_TRACE', '')
+    saved = dict(esi_instrument._trace)
+    path = str(tmp_path / 'trace.jsonl')
+    esi_instrument.configure(path)
+    yield path
+    os.close(esi_instrument._trace['fd'])
+    esi_instrument._trace.update(saved)
+    esi_instrument._counters.clear()
+
+
+def read_events(path):
+    with open(path) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+@pytest.mark.parametrize('workers', [1, 2])
+def test_worker_counters_are_not_counted_twice(tmp_path, trace, workers):
+    archive = make_archive(str(tmp_path) + '/', width=60, height=40, dates=12, stations=5)
+    tifs = str(tmp_path / 'ESI_tif.zip')
+    with zipfile.ZipFile(tifs, 'w') as z:
+        for name in sorted(os.listdir(tmp_path / 'raw')):
+            z.write(tmp_path / 'raw' / name, name)
+
+    with esi_instrument.run('tif2select_pts', trace):
+        # counts the parent has not written yet when the workers are forked
+        esi_instrument.count('requests', 100)
+        tif2select_pts(tifs, archive['metadata'], workers=workers, outfile=str(tmp_path / 'out.csv'))
+
+    events = read_events(trace)
+    counters = Counter()
+    for e in events:
+        if e['event'] == 'counters':
+            counters.update(e['counters'])
+    reads = [e for e in events if e['event'] == 'span' and e['name'] == 'read_tif']
+    assert len(reads) == 12
+    assert counters['requests'] == 100
+    assert counters['pixels'] == sum(e['pixels'] for e in reads)
+    if workers > 1:
+        assert {e['pid'] for e in reads} != {os.getpid()}
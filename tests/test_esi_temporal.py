@@ -0,0 +1,94 @@
+import warnings
+import numpy as np
+import pandas as pd
+import pytest
+import rasterio as rs
+from esi_temporal import calendar_doy, esi_temporal
+from synthetic_esi import make_archive
+
+NODATA = -9999.0
+
+
+@pytest.fixture(scope='module')
+def archive(tmp_path_factory):
+    # 3+ years of weekly ESI (across the 2024 leap year), renamed to <date>_CLIP.tif, with random nodata holes
+    tmp = tmp_path_factory.mktemp('temporal')
+    make_archive(str(tmp) + '/', width=40, height=30, dates=170, stations=2, start='2022-01-04')
+    clipped = tmp / 'clipped_files'
+    clipped.mkdir()
+    rng = np.random.default_rng(7)
+    stack = []
+    for path in sorted((tmp / 'raw').glob('*.tif')):
+        with rs.open(path) as src:
+            data, profile = src.read(1), src.profile
+        data[rng.random(data.shape) < 0.05] = NODATA
+        with rs.open(clipped / (path.stem + '_CLIP.tif'), 'w', **profile) as dst:
+            dst.write(data, 1)
+        stack.append(data)
+    dates = pd.to_datetime([p.stem for p in sorted((tmp / 'raw').glob('*.tif'))])
+    values = np.stack(stack).astype(float)
+    values[values == NODATA] = np.nan
+    return tmp, clipped, dates, values
+
+
+def read(path):
+    with rs.open(path) as src:
+        data = src.read().astype(float)
+    data[data == NODATA] = np.nan
+    return data
+
+
+def reference(dates, values, weeks=4, doy_window=3, min_years=3):
+    # the same products, pixel by pixel, with pandas and plain numpy
+    rows, cols = values.shape[1:]
+    rolling = np.full(values.shape, np.nan)
+    for r in range(rows):
+        for c in range(cols):
+            series = pd.Series(values[:, r, c], index=dates)
+            rolling[:, r, c] = series.rolling('{}D'.format(7 * weeks), min_periods=weeks).mean()
+    doys = np.array([pd.Timestamp(2000, d.month, d.day).dayofyear for d in dates])
+    mean = np.full((366, rows, cols), np.nan)
+    std = np.full((366, rows, cols), np.nan)
+    for day in range(1, 367):
+        gap = np.abs(doys - day)
+        near = values[np.minimum(gap, 366 - gap) <= doy_window]
+        n = np.sum(~np.isnan(near), axis=0)
+        with warnings.catch_warnings():
+            # all-NaN pixels: mean of empty slice
+            warnings.simplefilter('ignore', RuntimeWarning)
+            m = np.nanmean(near, axis=0)
+            s = np.nanstd(near, axis=0, ddof=1)
+        mean[day - 1] = np.where(n >= min_years, m, np.nan)
+        std[day - 1] = np.where(n >= min_years, s, np.nan)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        anomaly = (values - mean[doys - 1]) / std[doys - 1]
+    anomaly[~np.isfinite(anomaly)] = np.nan
+    return rolling, mean, std, anomaly
+
+
+@pytest.mark.parametrize('block, workers', [(None, 1), (16, 2)])
+def test_products_match_reference(archive, block, workers):
+    tmp, clipped, dates, values = archive
+    outdir = tmp / 'out_{}_{}'.format(block, workers)
+    files = esi_temporal(str(clipped) + '/', str(outdir) + '/', workers=workers, block=block)
+    rolling, mean, std, anomaly = reference(dates, values)
+
+    assert len(files['rolling']) == len(dates) == len(files['anomaly'])
+    got_rolling = np.concatenate([read(f) for f in files['rolling']])
+    got_anomaly = np.concatenate([read(f) for f in files['anomaly']])
+    np.testing.assert_allclose(got_rolling, rolling, rtol=1e-5, atol=1e-5, equal_nan=True)
+    np.testing.assert_allclose(read(files['climatology_mean'][0]), mean, rtol=1e-5, atol=1e-5, equal_nan=True)
+    np.testing.assert_allclose(read(files['climatology_std'][0]), std, rtol=1e-4, atol=1e-4, equal_nan=True)
+    np.testing.assert_allclose(got_anomaly, anomaly, rtol=1e-3, atol=1e-3, equal_nan=True)
+    # something was computed, and the minimums left some pixels empty
+    assert np.isfinite(got_anomaly).mean() > 0.5 and np.isnan(got_rolling).any()
+
+    # the outputs are on the grid of the clipped tifs, and the stacks are gone
+    with rs.open(files['rolling'][0]) as out, rs.open(sorted(clipped.glob('*_CLIP.tif'))[0]) as src:
+        assert out.transform == src.transform and out.crs == src.crs and out.shape == src.shape
+    assert not list(outdir.glob('*_stack.tif'))
+
+
+def test_day_of_year_by_month_and_day():
+    dates = pd.to_datetime(['2023-02-28', '2023-03-01', '2024-02-29', '2024-03-01', '2023-12-31', '2024-12-31'])
+    assert list(calendar_doy(dates)) == [59, 61, 60, 61, 366, 366]
@@ -0,0 +1,78 @@
+from datetime import datetime
+import pandas as pd
+import pytest
+from get_ESI_select_pt import get_ESI_select_pt, merge_ranges, missing_ranges
+from synthetic_esi import FakeClimateSERV, make_archive
+
+T = pd.Timestamp
+
+
+def weekly(start, periods):
+    return list(pd.date_range(start, periods=periods, freq='7D'))
+
+
+def test_no_dates_means_the_whole_window():
+    assert missing_ranges([], '2021-01-01', '2021-03-31') == [(T('2021-01-01'), T('2021-03-31'))]
+
+
+def test_complete_weekly_series_has_nothing_missing():
+    dates = weekly('2021-01-05', 12)
+    assert missing_ranges(dates, '2021-01-01', '2021-03-25') == []
+
+
+def test_leading_and_trailing_gaps_need_a_full_week():
+    dates = weekly('2021-01-12', 4)  # Jan 12 - Feb 2
+    # 6 days before the first date and 6 days after the last date: no ESI date can be in there
+    assert missing_ranges(dates, '2021-01-06', '2021-02-08') == []
+    # 7 days or more is a missing week
+    assert missing_ranges(dates, '2021-01-05', '2021-02-09') == [(T('2021-01-05'), T('2021-01-11')),
+                                                                 (T('2021-02-03'), T('2021-02-09'))]
+
+
+def test_internal_gap_longer_than_a_week():
+    dates = weekly('2021-01-05', 3) + weekly('2021-02-02', 3)  # Jan 19 -> Feb 2 is two weeks
+    assert missing_ranges(dates, '2021-01-05', '2021-02-16') == [(T('2021-01-20'), T('2021-02-01'))]
+    # gaps of exactly one week are the normal cadence
+    assert missing_ranges(weekly('2021-01-05', 6), '2021-01-05', '2021-02-09') == []
+
+
+def test_dates_outside_of_the_window_are_ignored():
+    dates = weekly('2020-06-02', 10) + weekly('2021-06-01', 3)
+    assert missing_ranges(dates, '2021-01-01', '2021-03-31') == [(T('2021-01-01'), T('2021-03-31'))]
+
+
+def test_merge_ranges():
+    ranges = [('2021-02-01', '2021-02-05'), ('2021-01-01', '2021-01-10'), ('2021-01-11', '2021-01-20'),
+              ('2021-01-03', '2021-01-04'), ('2021-02-07', '2021-02-09')]
+    # touching (Jan 10 / Jan 11) and overlapping ranges become one; Feb 5 / Feb 7 leaves a day between them
+    assert merge_ranges(ranges) == [(T('2021-01-01'), T('2021-01-20')), (T('2021-02-01'), T('2021-02-05')),
+                                    (T('2021-02-07'), T('2021-02-09'))]
+    assert merge_ranges([]) == []
+
+
+@pytest.mark.parametrize('mode', ['point', 'bulk'])
+def test_update_adds_only_missing_rows(tmp_path, mode):
+    archive = make_archive(str(tmp_path) + '/', width=60, height=40, dates=12, stations=5)
+    fake = FakeClimateSERV(str(tmp_path))
+    outfile = str(tmp_path / 'poly_ESI_df.csv')
+    start, end = datetime(2021, 1, 5), datetime(2021, 2, 9)
+    get_ESI_select_pt(archive['metadata'], 0.00001, 'ESI_4', start, end, rate=0, request_func=fake,
+                      outfile=outfile, mode=mode)
+    first = pd.read_csv(outfile)
+    # take out one date of one station and every row of another station
+    stations = first['station'].unique()
+    keep = ~(((first['station'] == stations[0]) & (first['date'] == '2021-01-19')) | (first['station'] == stations[1]))
+    first[keep].to_csv(outfile, index=False)
+
+    get_ESI_select_pt(archive['metadata'], 0.00001, 'ESI_4', start, datetime(2021, 3, 23), rate=0,
+                      request_func=fake, outfile=outfile, mode=mode, update=True)
+    updated = pd.read_csv(outfile)
+    assert not updated.duplicated(['station', 'date']).any()
+
+    # the same rows as asking for everything at once
+    full = str(tmp_path / 'full.csv')
+    get_ESI_select_pt(archive['metadata'], 0.00001, 'ESI_4', start, datetime(2021, 3, 23), rate=0,
+                      request_func=fake, outfile=full, mode=mode)
+    key = ['station', 'date']
+    pd.testing.assert_frame_equal(updated.sort_values(key).reset_index(drop=True),
+                                  pd.read_csv(full).sort_values(key).reset_index(drop=True))
@@ -0,0 +1,60 @@
+import zipfile
+from datetime import datetime
+import numpy as np
+import pandas as pd
+import pytest
+import rasterio as rs
+from get_ESI_tif import get_ESI_tif, plan_tiles
+from synthetic_esi import FakeClimateSERV, make_archive
+
+
+@pytest.fixture(scope='module')
+def archive(tmp_path_factory):
+    tmp = tmp_path_factory.mktemp('tiles')
+    make_archive(str(tmp) + '/', width=60, height=40, dates=12, stations=2)
+    return tmp
+
+
+def read_zip(path):
+    # {member name: (shape, transform, values)} for every tif in the zip
+    with zipfile.ZipFile(path) as z:
+        names = z.namelist()
+    out = {}
+    for name in names:
+        with rs.open('/vsizip/{}/{}'.format(path, name)) as img:
+            out[name] = (img.shape, img.transform, img.read(1))
+    return names, out
+
+
+def test_plan_tiles_covers_every_day_once():
+    tiles = plan_tiles(-89.0, -87.0, 34.0, 35.0, datetime(2021, 1, 5), datetime(2021, 3, 23), 0.7, 20)
+    boxes = sorted({box for box, start, end in tiles})
+    windows = sorted({(start, end) for box, start, end in tiles})
+    assert len(tiles) == len(boxes) * len(windows) == 6 * 4
+    days = [day for start, end in windows for day in pd.date_range(start, end)]
+    assert days == list(pd.date_range('2021-01-05', '2021-03-23'))
+
+
+@pytest.mark.parametrize('box', [(-89.513, -87.271, 34.207, 35.688),   # tile edges between pixel edges
+                                 (-89.5, -88.5, 34.5, 35.5)])          # tile edges on pixel edges
+@pytest.mark.parametrize('max_days', [14, 20, 365])
+def test_tiles_mosaic_like_a_single_download(archive, box, max_days):
+    fake = FakeClimateSERV(str(archive))
+    start, end = datetime(2021, 1, 5), datetime(2021, 3, 23)
+    single, tiled = str(archive / 'single.zip'), str(archive / 'tiled_{}.zip'.format(max_days))
+    get_ESI_tif(*box, 'ESI_4', start, end, outfile=single, request_func=fake, max_deg=10, max_days=1000, rate=0)
+    calls = fake.calls
+    get_ESI_tif(*box, 'ESI_4', start, end, outfile=tiled, request_func=fake, max_deg=0.5, max_days=max_days,
+                workers=3, rate=0)
+    assert fake.calls - calls == len(plan_tiles(*box, start, end, 0.5, max_days)) > 1
+
+    single_names, single_tifs = read_zip(single)
+    tiled_names, tiled_tifs = read_zip(tiled)
+    # every date once, none lost or repeated at the ends of the date windows
+    assert sorted(tiled_names) == sorted(single_names)
+    assert len(set(tiled_names)) == len(tiled_names) == 12
+    for name in single_names:
+        shape, transform, values = single_tifs[name]
+        assert tiled_tifs[name][0] == shape
+        assert tiled_tifs[name][1].almost_equals(transform)
+        np.testing.assert_array_equal(tiled_tifs[name][2], values)
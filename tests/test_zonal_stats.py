@@ -0,0 +1,108 @@
+import json
+import os
+import zipfile
+from datetime import datetime
+import numpy as np
+import pandas as pd
+import pytest
+import rasterio as rs
+from get_ESI_select_pt import get_ESI_select_pt
+from synthetic_esi import NODATA, PIXEL, FakeClimateSERV, make_archive
+from zonal_stats import zonal_stats
+
+WEST, NORTH = -90.0, 36.0
+
+# rectangles (xmin, xmax, ymin, ymax), none of their edges on a pixel edge
+RECTANGLES = {
+    'inside': (-89.513, -88.871, 35.207, 35.688),
+    'overlaps_inside': (-89.012, -88.437, 35.011, 35.503),
+    'off_the_corner': (-90.3, -89.713, 35.8, 36.4),
+    'off_the_grid': (-91.2, -90.6, 35.0, 35.5),
+    'all_nodata': (-89.99, -89.93, 34.01, 34.07),
+    'some_nodata': (-89.987, -89.487, 34.013, 34.613),
+    'sub_pixel_on_corner': (-88.502, -88.497, 35.248, 35.252),
+}
+# a triangle inside the pixel of row 10, col 20
+TRIANGLE = [[-88.99, 35.46], [-88.96, 35.46], [-88.975, 35.49], [-88.99, 35.46]]
+
+
+@pytest.fixture(scope='module')
+def archive(tmp_path_factory):
+    tmp = tmp_path_factory.mktemp('zonal')
+    paths = make_archive(str(tmp) + '/', width=60, height=40, dates=6, stations=8)
+    tifs = str(tmp / 'ESI_tif.zip')
+    with zipfile.ZipFile(tifs, 'w') as z:
+        for name in sorted(os.listdir(paths['raw'])):
+            z.write(paths['raw'] + name, name)
+    return tmp, paths, tifs
+
+
+def rectangle_pixels(xmin, xmax, ymin, ymax, width, height):
+    # every pixel whose square overlaps the rectangle (all_touched), the slow way
+    pixels = []
+    for row in range(height):
+        top = NORTH - row * PIXEL
+        for col in range(width):
+            left = WEST + col * PIXEL
+            if left < xmax and left + PIXEL > xmin and top > ymin and top - PIXEL < ymax:
+                pixels.append((row, col))
+    return pixels
+
+
+def read_rasters(raw):
+    for name in sorted(os.listdir(raw)):
+        with rs.open(raw + name) as img:
+            data = img.read(1).astype(float)
+        data[data == NODATA] = np.nan
+        yield pd.Timestamp(name[:8]), data
+
+
+@pytest.mark.parametrize('precision', [0.00001, 0.05])
+def test_station_zones_match_point_requests(archive, precision):
+    tmp, paths, tifs = archive
+    zonal = str(tmp / 'zonal_{}.csv'.format(precision))
+    poly = str(tmp / 'poly_{}.csv'.format(precision))
+    zonal_stats(tifs, metadata=paths['metadata'], precision=precision, outfile=zonal)
+    get_ESI_select_pt(paths['metadata'], precision, 'ESI_4', datetime(2021, 1, 5), datetime(2021, 2, 9),
+                      rate=0, request_func=FakeClimateSERV(str(tmp)), outfile=poly, mode='point')
+    z = pd.read_csv(zonal, parse_dates=['date'])
+    p = pd.read_csv(poly, parse_dates=['date'])
+    both = z.merge(p, on=['station', 'date'], suffixes=('_zonal', '_point'))
+    assert len(both) == len(p) == 6 * 8
+    np.testing.assert_allclose(both['avg_zonal'], both['avg_point'], rtol=1e-6)
+
+
+def test_shapefile_zones_match_brute_force(archive):
+    tmp, paths, tifs = archive
+    features = [{'type': 'Feature', 'properties': {'name': name},
+                 'geometry': {'type': 'Polygon', 'coordinates': [[[x0, y1], [x1, y1], [x1, y0], [x0, y0], [x0, y1]]]}}
+                for name, (x0, x1, y0, y1) in RECTANGLES.items()]
+    features.append({'type': 'Feature', 'properties': {'name': 'sub_pixel_triangle'},
+                     'geometry': {'type': 'Polygon', 'coordinates': [TRIANGLE]}})
+    shapefile = str(tmp / 'zones.GeoJSON')
+    with open(shapefile, 'w') as f:
+        json.dump({'type': 'FeatureCollection', 'features': features}, f)
+    outfile = str(tmp / 'zonal_shapes.csv')
+    zonal_stats(tifs, shapefile=shapefile, id_field='name', outfile=outfile)
+    out = pd.read_csv(outfile, parse_dates=['date']).set_index(['station', 'date'])
+
+    zones = {name: rectangle_pixels(*box, 60, 40) for name, box in RECTANGLES.items()}
+    zones['sub_pixel_triangle'] = [(10, 20)]
+    assert zones['off_the_grid'] == [] and len(zones['sub_pixel_on_corner']) == 4
+    expected = []
+    for day, data in read_rasters(paths['raw']):
+        for name, pixels in zones.items():
+            values = np.array([data[r, c] for r, c in pixels])
+            values = values[~np.isnan(values)]
+            expected.append({'station': name, 'date': day,
+                             'avg': values.mean() if values.size else np.nan,
+                             'min': values.min() if values.size else np.nan,
+                             'max': values.max() if values.size else np.nan})
+    expected = pd.DataFrame(expected).set_index(['station', 'date'])
+    assert len(out) == len(expected)
+    out = out.loc[expected.index]
+    for col in ('avg', 'min', 'max'):
+        np.testing.assert_allclose(out[col], expected[col], rtol=1e-6)
+    # empty and all-nodata zones still get a (blank) row for every date
+    assert out.loc['off_the_grid', 'avg'].isna().all() and out.loc['all_nodata', 'avg'].isna().all()
+    assert out.loc['some_nodata', 'avg'].notna().all()